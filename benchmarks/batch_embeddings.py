@@ -0,0 +1,96 @@
+"""Throughput of image embedding by batch size, on CPU.
+
+Makes seeded synthetic FlowCam-style vignettes (16-bit greyscale, low values, varied sizes),
+then for each batch size prepares and embeds them all with prepare_batch and batch_embeddings,
+reporting images/sec with the time split between preparation and the forward pass.
+Batch size 1 is the old one-image-per-forward-pass behaviour.
+Model weights don't affect speed, so the ResNets are built untrained rather than downloaded.
+
+python benchmarks/batch_embeddings.py --images 256 --batch-sizes 1 8 32 64
+python benchmarks/batch_embeddings.py --model resnet50 --normalise resize_normalise --threads 4
+"""
+
+import argparse
+import json
+import os
+import platform
+import time
+from typing import List
+
+import numpy as np
+import torch
+import torchvision
+from PIL import Image
+
+from cyto_ml.data.image import prepare_batch
+from cyto_ml.models.utils import batch_embeddings
+
+
+def synthetic_vignettes(count: int, seed: int = 42) -> List[Image.Image]:
+    """I;16 images between 40 and 200 pixels a side, with values in the low range FlowCam gives"""
+    rng = np.random.default_rng(seed)
+    images = []
+    for _ in range(count):
+        height, width = rng.integers(40, 200, 2)
+        images.append(Image.fromarray(rng.integers(0, 1018, (height, width), dtype=np.uint16)))
+    return images
+
+
+def embedding_model(name: str) -> torch.nn.Module:
+    model = getattr(torchvision.models, name)()
+    model.fc = torch.nn.Identity()
+    return model.eval()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--images", type=int, default=256)
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 8, 16, 32, 64])
+    parser.add_argument("--model", choices=["resnet18", "resnet50"], default="resnet18")
+    parser.add_argument("--normalise", choices=["base_normalise", "resize_normalise"], default="base_normalise")
+    parser.add_argument("--threads", type=int, help="torch intra-op threads, defaults to torch's choice")
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    images = synthetic_vignettes(args.images)
+    model = embedding_model(args.model)
+    # Warm up, so the first batch size measured doesn't pay for one-off allocations
+    batch_embeddings(model, prepare_batch(images[:2], args.normalise))
+
+    results = []
+    for batch_size in args.batch_sizes:
+        prepare = forward = 0.0
+        for offset in range(0, len(images), batch_size):
+            start = time.perf_counter()
+            batch = prepare_batch(images[offset : offset + batch_size], args.normalise)  # noqa: E203
+            prepared = time.perf_counter()
+            batch_embeddings(model, batch)
+            prepare += prepared - start
+            forward += time.perf_counter() - prepared
+        results.append(
+            {
+                "batch_size": batch_size,
+                "images_per_sec": len(images) / (prepare + forward),
+                "prepare_s": prepare,
+                "forward_s": forward,
+            }
+        )
+        print(json.dumps(results[-1]))
+
+    report = {
+        "model": args.model,
+        "normalise": args.normalise,
+        "images": args.images,
+        "threads": torch.get_num_threads(),
+        "torch": torch.__version__,
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "results": results,
+    }
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+"""Throughput of batched nearest neighbour queries against looping closest().
+
+Fills a sqlite-vec store with seeded synthetic embeddings, then finds the k nearest
+neighbours of a batch of its own images three ways:
+* closest(url) per query - a lookup then a vec0 KNN query each
+* closest_by_vector(vec) per query - the vec0 KNN query alone
+* closest_many(matrix) - one in-memory matrix product per chunk of queries
+
+python benchmarks/closest_many.py --rows 50000 --dim 512 --queries 2000
+"""
+
+import argparse
+import json
+import os
+import tempfile
+import time
+
+import numpy as np
+
+from cyto_ml.data.vectorstore import vector_store
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=20000)
+    parser.add_argument("--dim", type=int, default=512)
+    parser.add_argument("--queries", type=int, default=1000)
+    parser.add_argument("-k", type=int, default=25)
+    parser.add_argument("--chunk-size", type=int, default=1024)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(42)
+    embeddings = rng.random((args.rows, args.dim), dtype=np.float32)
+    urls = [f"https://example.com/untagged-images-bench/vignette_{i}.tif" for i in range(args.rows)]
+    positions = rng.choice(args.rows, args.queries, replace=False)
+    queries = embeddings[positions]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        store = vector_store("sqlite", os.path.join(tmp, "bench.db"), embedding_len=args.dim, cache_size=0)
+        store.add_many(urls, embeddings)
+
+        report = {"rows": args.rows, "dim": args.dim, "k": args.k, "queries": args.queries}
+
+        start = time.perf_counter()
+        looped = [[url for url, _ in store.closest(urls[i], n_results=args.k)] for i in positions]
+        report["closest_qps"] = args.queries / (time.perf_counter() - start)
+
+        start = time.perf_counter()
+        for query in queries:
+            store.closest_by_vector(query, args.k)
+        report["closest_by_vector_qps"] = args.queries / (time.perf_counter() - start)
+
+        start = time.perf_counter()
+        ids, _ = store.closest_many(queries, args.k, chunk_size=args.chunk_size)
+        report["closest_many_qps"] = args.queries / (time.perf_counter() - start)
+
+        report["speedup"] = report["closest_many_qps"] / report["closest_qps"]
+        report["agreement"] = np.mean([len(set(row) & set(loop)) / args.k for row, loop in zip(ids, looped)])
+
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
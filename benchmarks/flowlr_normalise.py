@@ -0,0 +1,90 @@
+"""Per-image cost of normalising FlowCam 16-bit vignettes to 3 band float32, before and after.
+
+* previous - the earlier normalise_flowlr and convert_3_band: builtin max() over the flattened pixels,
+  a float64 division, then a float64 H x W x 3 array filled band by band and cast to float32
+* normalise_flowlr + convert_3_band - float32 with an in-place division, and a broadcast view for the bands
+* per image, padded - normalise_flowlr per image, then padded into one 3 band array per batch,
+  which is the work prepare_batch did for a batch of them before (through pad_and_stack)
+* normalise_flowlr_batch - a whole batch at once, padded into one array, its bands left to an expanded view
+
+Vignettes are seeded synthetic I;16 images with values in FlowCam's low range.
+Only numpy is timed, so torch isn't needed to run it. per_image_speedup is against previous,
+batched_speedup against per image, padded.
+
+python benchmarks/flowlr_normalise.py --images 500 --batch-size 32
+"""
+
+import argparse
+import json
+import time
+from typing import Callable, List
+
+import numpy as np
+from PIL import Image
+
+from cyto_ml.data.image import convert_3_band, normalise_flowlr, normalise_flowlr_batch
+
+
+def previous(image: Image.Image) -> np.ndarray:
+    pix = np.array(image)
+    pix = pix / max(pix.flatten())
+    img2 = np.zeros((pix.shape[0], pix.shape[1], 3))
+    img2[:, :, 0] = pix
+    img2[:, :, 1] = pix
+    img2[:, :, 2] = pix
+    return img2.astype(np.float32)
+
+
+def synthetic_vignettes(count: int, min_size: int, max_size: int, seed: int = 42) -> List[Image.Image]:
+    rng = np.random.default_rng(seed)
+    return [
+        Image.fromarray(rng.integers(0, 1018, rng.integers(min_size, max_size, 2), dtype=np.uint16))
+        for _ in range(count)
+    ]
+
+
+def padded(images: List[Image.Image]) -> np.ndarray:
+    batch = np.zeros((len(images), max(im.height for im in images), max(im.width for im in images), 3), np.float32)
+    for pix, image in zip(batch, images):
+        pix[: image.height, : image.width] = convert_3_band(normalise_flowlr(image))
+    return batch
+
+
+def per_image_us(images: List[Image.Image], func: Callable, repeats: int) -> float:
+    """Best of repeats, in microseconds per image"""
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func(images)
+        best = min(best, time.perf_counter() - start)
+    return best / len(images) * 1e6
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--images", type=int, default=500)
+    parser.add_argument("--min-size", type=int, default=40)
+    parser.add_argument("--max-size", type=int, default=200)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    images = synthetic_vignettes(args.images, args.min_size, args.max_size)
+    batches = [images[i : i + args.batch_size] for i in range(0, len(images), args.batch_size)]  # noqa: E203
+
+    report = {"images": args.images, "size": [args.min_size, args.max_size], "batch_size": args.batch_size}
+    report["previous_us"] = per_image_us(images, lambda ims: [previous(im) for im in ims], args.repeats)
+    report["per_image_us"] = per_image_us(
+        images, lambda ims: [convert_3_band(normalise_flowlr(im)) for im in ims], args.repeats
+    )
+    report["per_image_padded_us"] = per_image_us(images, lambda _: [padded(batch) for batch in batches], args.repeats)
+    report["batched_us"] = per_image_us(
+        images, lambda _: [normalise_flowlr_batch(batch) for batch in batches], args.repeats
+    )
+    report["per_image_speedup"] = report["previous_us"] / report["per_image_us"]
+    report["batched_speedup"] = report["per_image_padded_us"] / report["batched_us"]
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
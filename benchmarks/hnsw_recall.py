@@ -0,0 +1,68 @@
+"""Recall and latency of the HNSW backend against exact search with sqlite-vec.
+
+Builds both stores from the same seeded synthetic embeddings, queries each with
+a sample of its own images, and reports recall@k and mean query time per ef_search.
+
+python benchmarks/hnsw_recall.py --rows 20000 --dim 512
+"""
+
+import argparse
+import json
+import os
+import tempfile
+import time
+
+import numpy as np
+
+from cyto_ml.data.vectorstore import vector_store
+
+
+def timed_queries(store, urls, k, **kwargs):
+    results = []
+    start = time.perf_counter()
+    for url in urls:
+        results.append([url for url, _ in store.closest(url, n_results=k, **kwargs)])
+    return results, (time.perf_counter() - start) / len(urls)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=10000)
+    parser.add_argument("--dim", type=int, default=512)
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("-k", type=int, default=25)
+    parser.add_argument("--M", type=int, default=16)
+    parser.add_argument("--ef-construction", type=int, default=200)
+    parser.add_argument("--ef-search", type=int, nargs="+", default=[25, 50, 100, 200])
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(42)
+    embeddings = rng.random((args.rows, args.dim), dtype=np.float32)
+    urls = [f"https://example.com/untagged-images-bench/vignette_{i}.tif" for i in range(args.rows)]
+    queries = list(rng.choice(urls, args.queries, replace=False))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        exact = vector_store("sqlite", os.path.join(tmp, "exact.db"), embedding_len=args.dim)
+        exact.add_many(urls, embeddings)
+
+        start = time.perf_counter()
+        approx = vector_store(
+            "hnsw", os.path.join(tmp, "hnsw.pkl"), embedding_len=args.dim, M=args.M, ef_construction=args.ef_construction
+        )
+        approx.add_many(urls, embeddings)
+        build_time = time.perf_counter() - start
+
+        truth, exact_latency = timed_queries(exact, queries, args.k)
+        report = {"rows": args.rows, "dim": args.dim, "k": args.k, "hnsw_build_s": build_time}
+        report["sqlite_latency_ms"] = exact_latency * 1000
+        report["hnsw"] = []
+        for ef in args.ef_search:
+            found, latency = timed_queries(approx, queries, args.k, ef_search=ef)
+            recall = np.mean([len(set(f) & set(t)) / len(t) for f, t in zip(found, truth)])
+            report["hnsw"].append({"ef_search": ef, "recall": recall, "latency_ms": latency * 1000})
+
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,214 @@
+"""Benchmark every vector_store() backend on seeded synthetic collections, and report JSON.
+
+For each backend, collection size and embedding length it measures
+* ingest rate (rows/sec, through add_many where the backend has it)
+* closest() latency, p50 and p99, for a sample of the collection's own images
+* embeddings() load time
+* recall@k of closest() against exact cosine search
+* on-disk size after ingest
+* peak RSS
+
+Each run is a separate process, so peak RSS (and any caches) belong to that run alone.
+Embeddings are non-negative and clustered, like pooled CNN features, with flowcam-style urls.
+
+python benchmarks/vector_stores.py --rows 10000 100000 --dim 512 2048 --output before.json
+python benchmarks/vector_stores.py --backends sqlite memory --rows 1000000 --dim 512
+"""
+
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from cyto_ml.data import vectorstore
+from cyto_ml.data.vectorstore import VectorStore, top_k, vector_store
+
+DEFAULT_BACKENDS = ["sqlite", "sharded", "memory", "hnsw", "ivfpq", "chromadb"]
+CHUNK_SIZE = 10000
+N_CLUSTERS = 64
+
+
+def synthetic_urls(rows: int) -> List[str]:
+    """Urls shaped like a decollaged flowcam session's, so filename metadata gets parsed as it would be"""
+    return [
+        f"https://example.com/untagged-images-bench/"
+        f"Tank{i % 12}_54.{i % 97:04d}_-2.7770_{1 + i % 28:02d}052023_{i % 3}_images_{i:07d}.tif"
+        for i in range(rows)
+    ]
+
+
+def synthetic_embeddings(rows: int, dim: int, seed: int = 42) -> Iterator[np.ndarray]:
+    """(CHUNK_SIZE, dim) float32 chunks, the same for the same seed, without holding the whole collection"""
+    centres = np.random.default_rng(seed).gamma(1.0, 1.0, (N_CLUSTERS, dim)).astype(np.float32)
+    for offset in range(0, rows, CHUNK_SIZE):
+        rng = np.random.default_rng([seed, offset])
+        n = min(CHUNK_SIZE, rows - offset)
+        noise = rng.standard_normal((n, dim), dtype=np.float32) * 0.5
+        yield np.maximum(centres[rng.integers(0, N_CLUSTERS, n)] + noise, 0)
+
+
+def exact_neighbours(queries: np.ndarray, rows: int, dim: int, k: int) -> np.ndarray:
+    """Positions of each query's k nearest rows by cosine distance, merged chunk by chunk"""
+    best_positions = np.empty((len(queries), 0), dtype=np.int64)
+    best_distances = np.empty((len(queries), 0), dtype=np.float32)
+    for chunk_number, chunk in enumerate(synthetic_embeddings(rows, dim)):
+        positions, distances = top_k(queries, chunk, k)
+        best_positions = np.concatenate([best_positions, positions + chunk_number * CHUNK_SIZE], axis=1)
+        best_distances = np.concatenate([best_distances, distances], axis=1)
+        order = np.argsort(best_distances, axis=1, kind="stable")[:, :k]
+        best_positions = np.take_along_axis(best_positions, order, axis=1)
+        best_distances = np.take_along_axis(best_distances, order, axis=1)
+    return best_positions
+
+
+def rows_at(positions: np.ndarray, rows: int, dim: int) -> np.ndarray:
+    """The synthetic embeddings at these positions, in the same order"""
+    found = np.empty((len(positions), dim), dtype=np.float32)
+    for chunk_number, chunk in enumerate(synthetic_embeddings(rows, dim)):
+        offset = chunk_number * CHUNK_SIZE
+        in_chunk = (positions >= offset) & (positions < offset + len(chunk))
+        found[in_chunk] = chunk[positions[in_chunk] - offset]
+    return found
+
+
+def open_store(backend: str, directory: str, dim: int, sample: np.ndarray) -> VectorStore:
+    if backend == "sqlite":
+        return vector_store("sqlite", f"{directory}/bench.db", embedding_len=dim, cache_size=0)
+    if backend == "sharded":
+        return vector_store("sharded", f"{directory}/bench.db", embedding_len=dim)
+    if backend == "memory":
+        return vector_store("memory", embedding_len=dim)
+    if backend == "hnsw":
+        return vector_store("hnsw", f"{directory}/bench.pkl", embedding_len=dim)
+    if backend == "ivfpq":
+        store = vector_store("ivfpq", f"{directory}/bench.pkl", embedding_len=dim, n_lists=min(256, len(sample)))
+        store.train(sample)
+        return store
+    if backend == "chromadb":
+        # The chroma client is created on first use, so it can be pointed at the temporary directory
+        vectorstore.STORE = directory
+        return vector_store("chromadb", "bench")
+    return vector_store(backend, f"{directory}/bench.db", embedding_len=dim)
+
+
+def disk_size(directory: str) -> int:
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(directory) for name in names)
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is KiB on Linux, bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024**2 if sys.platform == "darwin" else peak / 1024
+
+
+def run(backend: str, rows: int, dim: int, queries: int, k: int) -> dict:
+    """Build one collection in one backend and measure it. Queries are the collection's own images,
+    spread across it, and the sqlite query cache is off, so every closest() does the full search"""
+    urls = synthetic_urls(rows)
+    query_positions = np.random.default_rng(0).choice(rows, min(queries, rows), replace=False)
+
+    with tempfile.TemporaryDirectory() as directory:
+        sample = next(synthetic_embeddings(rows, dim))
+        store = open_store(backend, directory, dim, sample)
+
+        start = time.perf_counter()
+        for chunk_number, chunk in enumerate(synthetic_embeddings(rows, dim)):
+            chunk_urls = urls[chunk_number * CHUNK_SIZE : chunk_number * CHUNK_SIZE + len(chunk)]  # noqa: E203
+            if hasattr(store, "add_many"):
+                store.add_many(chunk_urls, chunk)
+            else:
+                for url, row in zip(chunk_urls, chunk):
+                    store.add(url, row.tolist())
+        if hasattr(store, "save"):
+            store.save()
+        ingest = time.perf_counter() - start
+
+        latencies, found = [], []
+        for position in query_positions:
+            start = time.perf_counter()
+            result = store.closest(urls[position], n_results=k)
+            latencies.append(time.perf_counter() - start)
+            # chroma returns ids, the others (id, distance)
+            found.append({r if isinstance(r, str) else r[0] for r in result})
+
+        start = time.perf_counter()
+        store.embeddings()
+        load = time.perf_counter() - start
+
+        truth = exact_neighbours(rows_at(query_positions, rows, dim), rows, dim, k)
+        recall = np.mean([len(f & {urls[i] for i in t}) / len(t) for f, t in zip(found, truth)])
+
+        return {
+            "backend": backend,
+            "rows": rows,
+            "dim": dim,
+            "k": k,
+            "ingest_rows_per_sec": rows / ingest,
+            "closest_p50_ms": float(np.percentile(latencies, 50) * 1000),
+            "closest_p99_ms": float(np.percentile(latencies, 99) * 1000),
+            "embeddings_load_s": load,
+            f"recall_at_{k}": float(recall),
+            "disk_bytes": disk_size(directory),
+            "peak_rss_mb": peak_rss_mb(),
+        }
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--backends", nargs="+", default=DEFAULT_BACKENDS)
+    parser.add_argument("--rows", type=int, nargs="+", default=[10000])
+    parser.add_argument("--dim", type=int, nargs="+", default=[512, 2048])
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("-k", type=int, default=25)
+    parser.add_argument("--output", help="write the report here as well as to stdout")
+    # Internal: measure a single run in this process and print its result
+    parser.add_argument("--single", nargs=3, metavar=("BACKEND", "ROWS", "DIM"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.single:
+        backend, rows, dim = args.single
+        print(json.dumps(run(backend, int(rows), int(dim), args.queries, args.k)))
+        return
+
+    results: List[dict] = []
+    runs: List[Tuple[str, int, int]] = [(b, r, d) for r in args.rows for d in args.dim for b in args.backends]
+    for backend, rows, dim in runs:
+        command = [sys.executable, __file__, "--single", backend, str(rows), str(dim)]
+        command += ["--queries", str(args.queries), "-k", str(args.k)]
+        child = subprocess.run(command, check=False, capture_output=True, text=True)
+        if child.returncode:
+            results.append({"backend": backend, "rows": rows, "dim": dim, "error": child.stderr.strip()[-500:]})
+        else:
+            results.append(json.loads(child.stdout.strip().splitlines()[-1]))
+        print(json.dumps(results[-1]), file=sys.stderr)
+
+    report = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "results": results,
+    }
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,32 @@
+"""Precompute each image's nearest neighbours into the images_knn table of a sqlite-vec collection,
+so the app's neighbour grid is a lookup rather than a live KNN query.
+Run once per collection; image_embeddings.py keeps the graph up to date as images are added"""
+
+import argparse
+import glob
+import logging
+import os
+
+from cyto_ml.data.vectorstore import SQLiteVecStore
+
+logging.basicConfig(level=logging.INFO)
+
+DATA_DIR = os.path.join(os.path.abspath(os.path.dirname(__file__)), "../data")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build or update the nearest neighbour graph for sqlite vector stores")
+    parser.add_argument("databases", nargs="*", help="paths to .db files, defaults to everything in data/")
+    # The app's grid shows 65 neighbours
+    parser.add_argument("--depth", type=int, default=65, help="neighbours to store per image")
+    parser.add_argument("--rebuild", action="store_true", help="recompute the whole graph, not just what's changed")
+    parser.add_argument("--workers", type=int, default=4, help="threads for the matrix products")
+    parser.add_argument("--memory", type=int, default=1024**3, help="bytes of similarities held across the threads")
+    args = parser.parse_args()
+
+    for db_name in args.databases or glob.glob(f"{DATA_DIR}/*.db"):
+        store = SQLiteVecStore(db_name)
+        if args.rebuild or store.knn_depth() != args.depth:
+            rows = store.build_knn(depth=args.depth, workers=args.workers, memory=args.memory)
+        else:
+            rows = store.update_knn(workers=args.workers, memory=args.memory)
+        logging.info(f"{db_name}: neighbour lists written for {rows} images")
@@ -6,6 +6,7 @@ import os
 import yaml
 
 from sklearn.cluster import KMeans
+from cyto_ml.data.snapshot import snapshot
 from cyto_ml.data.vectorstore import vector_store
 
 
@@ -26,7 +27,12 @@ def main() -> None:
 
     kmeans = KMeans(n_clusters=n_clusters, random_state=42)
     store = vector_store("sqlite", collection_name)
-    X = store.embeddings()
+    if store.projection() is not None:
+        # Far fewer dimensions, if the collection has a fitted projection (see fit_projection.py)
+        X, _ = store.reduced_matrix()
+    else:
+        # Memory-mapped, and only re-exported from the db if it's changed since last run
+        X, _ = snapshot(store, f"{collection_name}.snapshot")
     kmeans.fit(X)
 
     # We supply a -o for output directory - this doesn't ensure we write there.
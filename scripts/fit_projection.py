@@ -0,0 +1,26 @@
+"""Fit a dimensionality-reducing projection for sqlite-vec collections, and index every embedding's
+projection for coarse search. cluster.py and the app's k-means page cluster on the projected
+embeddings once a collection has one; rows added later are projected as they're inserted"""
+
+import argparse
+import glob
+import logging
+import os
+
+from cyto_ml.data.vectorstore import SQLiteVecStore
+
+logging.basicConfig(level=logging.INFO)
+
+DATA_DIR = os.path.join(os.path.abspath(os.path.dirname(__file__)), "../data")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fit a PCA or random projection for sqlite vector stores")
+    parser.add_argument("databases", nargs="*", help="paths to .db files, defaults to everything in data/")
+    parser.add_argument("--dim", type=int, default=64, help="dimensions to project down to")
+    parser.add_argument("--method", choices=["pca", "random"], default="pca")
+    args = parser.parse_args()
+
+    for db_name in args.databases or glob.glob(f"{DATA_DIR}/*.db"):
+        store = SQLiteVecStore(db_name)
+        projection = store.fit_projection(dim=args.dim, method=args.method)
+        logging.info(f"{db_name}: {projection.method} projection from {projection.input_dim} to {projection.dim}")
@@ -1,5 +1,8 @@
 """Extract and store image embeddings from a collection in s3,
-using an off-the-shelf pre-trained model"""
+using off-the-shelf pre-trained models.
+Several models' embeddings can be computed from one download of each image: list them under model_types
+in params.yaml. The first fills the collection's default space, the others are kept by name -
+see SQLiteVecStore.register_model, and closest(url, model="resnet18")"""
 
 import os
 import logging
@@ -7,17 +10,28 @@ import argparse
 from tqdm import tqdm
 import yaml
 from dotenv import load_dotenv
-from cyto_ml.models.utils import flat_embeddings, resnet18
-from cyto_ml.data.image import load_image_from_url
+from cyto_ml.models.utils import batch_embeddings, resnet18
+from cyto_ml.data.fetch import ImageFetcher, image_cache
+from cyto_ml.data.image import ImageProcessingError, content_hash, prepare_image
 from resnet50_cefas import load_model
 
 from cyto_ml.data.vectorstore import vector_store
+import numpy as np
 import pandas as pd
+import torch
 
 logging.basicConfig(level=logging.info)
 load_dotenv()
 
 STATE_FILE='../models/ResNet_18_3classes_RGB.pth'
+# Rows to buffer before writing them to the store in one transaction
+BATCH_SIZE = 1000
+# Images to embed in one forward pass, unless params.yaml sets embedding_batch_size
+EMBEDDING_BATCH_SIZE = 32
+# Prepared images to hold, across every size, before embedding them in whatever batches they've made
+PENDING_LIMIT = 512
+# Downloads in flight at once, unless params.yaml sets fetch_concurrency
+FETCH_CONCURRENCY = 16
 
 if __name__ == "__main__":
 
@@ -25,8 +39,10 @@ if __name__ == "__main__":
     params = yaml.safe_load(open("params.yaml"))
     image_bucket = params["collection"]
     # fall back to the resnet50 model if it's not specified otherwise
-    model_type = params.get("model_type", 'resnet50')
+    model_types = params.get("model_types") or [params.get("model_type", 'resnet50')]
     file_index = f"{image_bucket}.csv"
+    embedding_batch_size = params.get("embedding_batch_size", EMBEDDING_BATCH_SIZE)
+    fetch_concurrency = params.get("fetch_concurrency", FETCH_CONCURRENCY)
 
     # We have a static file index, written by image_index.py
     df = pd.read_csv(file_index)
@@ -36,44 +52,136 @@ if __name__ == "__main__":
     if not os.path.exists(db_dir):
         os.mkdir(db_dir)
 
-    if model_type == 'resnet18':
-        model = resnet18(num_classes=3, filename=STATE_FILE, strip_final_layer=True)
-        embedding_len=512
-    elif model_type == 'resnet50':
-        model = load_model(strip_final_layer=True) 
-        embedding_len=2048
-    collection = vector_store("sqlite", f"{db_dir}/{image_bucket}.db", embedding_len=embedding_len)
+    # Model and embedding length for each model type
+    models = {}
+    for model_type in model_types:
+        if model_type == 'resnet18':
+            models[model_type] = resnet18(num_classes=3, filename=STATE_FILE, strip_final_layer=True), 512
+        elif model_type == 'resnet50':
+            models[model_type] = load_model(strip_final_layer=True), 2048
+        else:
+            raise ValueError(f"Unknown model_type {model_type}")
+
+    default_type = model_types[0]
+    collection = vector_store("sqlite", f"{db_dir}/{image_bucket}.db", embedding_len=models[default_type][1])
+    # The store's name for each model's embedding space, None being the default
+    spaces = {model_type: None if model_type == default_type else model_type for model_type in model_types}
+    for model_type, space in spaces.items():
+        if space is not None:
+            collection.register_model(space, models[model_type][1])
 
     # Turing Inst 3-class lightweight model needs downloaded manually.
     # Please see https://github.com/alan-turing-institute/ViT-LASNet/issues/2
 
 
-    def store_embeddings(url):
+    # What each stored embedding was computed from, so a rerun only embeds new or changed images
+    stored_hashes = {model_type: collection.content_hashes(space) for model_type, space in spaces.items()}
+    counts = {model_type: {"new": 0, "changed": 0, "unchanged": 0} for model_type in model_types}
+
+    # Buffer rows per model and write them with upsert_many, rather than a commit per image
+    buffers = {model_type: ([], [], []) for model_type in model_types}
+
+    def flush(model_type):
+        urls, vectors, hashes = buffers[model_type]
+        if urls:
+            report = collection.upsert_many(
+                urls, np.asarray(vectors, dtype=np.float32), hashes, model=spaces[model_type]
+            )
+            for status, changed in report.items():
+                counts[model_type][status] += len(changed)
+            urls.clear()
+            vectors.clear()
+            hashes.clear()
+
+    # Prepared images waiting to go through the models together, with what each needs, by height and width.
+    # Only images of the same size share a batch - zero padding would change their embeddings
+    pending = {}
+
+    def embed_pending(size):
+        """One forward pass per model over the pending images of a size, then buffer the results for the store"""
+        bucket = pending.pop(size, [])
+        if not bucket:
+            return
+        batch = torch.cat([image_data for _, _, image_data, _ in bucket])
+        for model_type in model_types:
+            rows = [i for i, (_, _, _, todo) in enumerate(bucket) if model_type in todo]
+            if not rows:
+                continue
+            embeddings = batch_embeddings(models[model_type][0], batch[rows])
+            urls, vectors, hashes = buffers[model_type]
+            for row, embedding in zip(rows, embeddings):
+                url, image_hash, _, _ = bucket[row]
+                urls.append(url)
+                vectors.append(embedding)
+                hashes.append(image_hash)
+            if len(urls) >= BATCH_SIZE:
+                flush(model_type)
+
+    def embed_all_pending():
+        for size in list(pending):
+            embed_pending(size)
+
+    def outdated(url, image_hash):
+        """Model types without an embedding of this version of the image"""
+        return [model_type for model_type in model_types if stored_hashes[model_type].get(url) != image_hash]
+
+    def known_hash(url):
+        """What every model's embedding of this url was computed from, if they agree"""
+        hashes = {stored_hashes[model_type].get(url) for model_type in model_types}
+        return hashes.pop() if len(hashes) == 1 else None
+
+    def store_embeddings(fetched):
+        # Object stores give us an ETag for the content, and answer 304 if it's still the one we sent
+        if fetched.not_modified:
+            for model_type in model_types:
+                counts[model_type]["unchanged"] += 1
+            return
+        # The fetcher has logged whatever went wrong
+        if fetched.image is None:
+            return
+
+        url = fetched.url
+        image_hash = fetched.etag or content_hash(fetched.content)
+        todo = outdated(url, image_hash)
+        for model_type in set(model_types) - set(todo):
+            counts[model_type]["unchanged"] += 1
+        if not todo:
+            return
+
         try:
-            image_data = load_image_from_url(url)
-        except ValueError as err:
-            # TODO diagnose and fix for this happening, in rare circumstances:
-            # (would be nice to know rather than just buffer the image and add code)
-            # File "python3.9/site-packages/PIL/PcdImagePlugin.py", line 34, in _open
-            #   self.fp.seek(2048)
-            # File "python3.9/site-packages/fsspec/implementations/http.py", line 745, in seek
-            # raise ValueError("Cannot seek streaming HTTP file")
-            # Is this still reproducible? - JW
+            image_data = prepare_image(fetched.image)
+        except ImageProcessingError as err:
             logging.info(err)
             logging.info(url)
             return
-        except OSError as err:
-            logging.info(err)
-            logging.info(row.Filename)
-            return
 
-        embeddings = flat_embeddings(model(image_data))
+        # The image is downloaded and decoded once for every model, and embedded with others in a batch
+        size = tuple(image_data.shape[-2:])
+        pending.setdefault(size, []).append((url, image_hash, image_data, todo))
+        if len(pending[size]) >= embedding_batch_size:
+            embed_pending(size)
+        elif sum(len(bucket) for bucket in pending.values()) >= PENDING_LIMIT:
+            # Vignettes come in many sizes, so don't hold on to them all waiting for full batches
+            embed_all_pending()
 
-        collection.add(
-            url=url,
-            embeddings=embeddings,
-        )
+    # Several downloads in flight at once, over a pool of kept-alive connections.
+    # Images other processes have cached are checked with the server rather than trusted,
+    # and only downloaded again if they've changed
+    cache = image_cache()
+    fetcher = ImageFetcher(concurrency=fetch_concurrency, cache=cache, revalidate=True)
+    image_urls = [f"{os.environ['AWS_URL_ENDPOINT']}/{image_bucket}/{row[0]}" for _, row in df.iterrows()]
+    etags = {url: etag for url in image_urls if (etag := known_hash(url))}
+    for fetched in tqdm(fetcher.iter_many(image_urls, etags), total=len(image_urls)):
+        store_embeddings(fetched)
+    fetcher.close()
+    if cache is not None:
+        logging.info(f"Image cache: {cache.stats()}")
+    # Embed and write whatever is left for every model
+    embed_all_pending()
+    for model_type in model_types:
+        flush(model_type)
+    logging.info(f"Embeddings: {counts}")
 
-    for _, row in tqdm(df.iterrows()):
-        image_url = f"{os.environ['AWS_URL_ENDPOINT']}/{image_bucket}/{row[0]}"
-        store_embeddings(image_url)
+    # Keep the precomputed neighbour graph current, if the collection has one (see build_knn_graph.py)
+    if collection.knn_depth() is not None and (counts[default_type]["new"] or counts[default_type]["changed"]):
+        collection.update_knn()
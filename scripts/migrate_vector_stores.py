@@ -0,0 +1,51 @@
+"""Bring the per-collection sqlite-vec databases up to date with the current schema.
+Run this on the DVC-tracked data/*.db files, then `dvc add` and push the results.
+Each db is vacuumed afterwards, so the space a migration frees (e.g. the second copy of every embedding
+that schema version 0 kept) goes back to the filesystem, and the space reclaimed is reported"""
+
+import argparse
+import glob
+import logging
+import os
+
+from cyto_ml.data.db_config import PRECISIONS
+from cyto_ml.data.vectorstore import SQLiteVecStore
+
+logging.basicConfig(level=logging.INFO)
+
+DATA_DIR = os.path.join(os.path.abspath(os.path.dirname(__file__)), "../data")
+
+
+def db_size(db_name: str) -> int:
+    """Bytes on disk, including any write-ahead log"""
+    return sum(os.path.getsize(path) for path in (db_name, f"{db_name}-wal") if os.path.exists(path))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Migrate sqlite vector stores to the current schema")
+    parser.add_argument("databases", nargs="*", help="paths to .db files, defaults to everything in data/")
+    parser.add_argument(
+        "--precision", choices=list(PRECISIONS), help="also re-encode the embeddings, e.g. int8 for a quarter the size"
+    )
+    args = parser.parse_args()
+
+    total = 0
+    for db_name in args.databases or glob.glob(f"{DATA_DIR}/*.db"):
+        before = db_size(db_name)
+        store = SQLiteVecStore(db_name)
+        migrated = store.migrate()
+        if args.precision:
+            migrated = store.set_precision(args.precision) or migrated
+        if not migrated:
+            logging.info(f"{db_name} is already up to date")
+            continue
+        store.vacuum()
+        version = store.schema_version()
+        store.close()
+        after = db_size(db_name)
+        total += before - after
+        logging.info(
+            f"Migrated {db_name} to schema version {version}: "
+            f"{before / 1e6:.1f} MB -> {after / 1e6:.1f} MB, {(before - after) / 1e6:.1f} MB reclaimed"
+        )
+    logging.info(f"{total / 1e6:.1f} MB reclaimed in total")
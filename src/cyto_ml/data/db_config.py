@@ -1,16 +1,100 @@
 # TODO manage this better elsewhere, once we settle on a storage option
+# Each embedding is stored once, in images_vec - formatted with the embedding length and vec0 element type
 SQLITE_SCHEMA = [
     """
     create table images (
     id integer primary key,
     url text not null,
     classification text not null,
-    embedding blob);""",
+    content_hash text,
+    lat real,
+    lon real,
+    date text,
+    session text);""",
     """create virtual table images_vec using vec0(
     id integer primary key,
-    embedding float[{}]);
+    embedding {1}[{0}] distance_metric=cosine);
     """,
+    """create unique index images_url on images(url);""",
+    """create index if not exists images_classification on images(classification);""",
+    """create index if not exists images_date on images(date);""",
+    """create index if not exists images_session on images(session);""",
+    """create index if not exists images_location on images(lat, lon);""",
+    # Precomputed nearest neighbours of each image, rank 0 being the closest, see SQLiteVecStore.build_knn
+    """create table if not exists images_knn (
+    id integer not null,
+    neighbour_id integer not null,
+    rank integer not null,
+    distance real not null,
+    primary key (id, rank)) without rowid;""",
+    """create index if not exists images_knn_neighbour on images_knn(neighbour_id);""",
+    # Per-collection settings, e.g. the depth of images_knn. Values can also be blobs (the fitted projection)
+    """create table if not exists collection_meta (key text primary key, value text);""",
+    # Embedding spaces besides images_vec, each in its own vec0 table - see SQLiteVecStore.register_model
+    """create table if not exists models (
+    name text primary key,
+    embedding_len integer not null,
+    precision text not null);""",
 ]
 
+# images_vec holds the default model's embeddings, the one closest() etc. use unless given model=...
+DEFAULT_MODEL = "default"
+# Every other model's embeddings, formatted with its name, vec0 element type and embedding length
+MODEL_SCHEMA = """create virtual table if not exists images_vec_{} using vec0(
+    id integer primary key,
+    embedding {}[{}] distance_metric=cosine);
+    """
+
+# Recorded in pragma user_version. Bump it whenever the layout changes in a way SQLiteVecStore.migrate() handles:
+# 0 - the embedding held twice, as an images.embedding blob as well as in images_vec
+# 1 - held once, in images_vec
+SCHEMA_VERSION = 1
+
+# How images_vec can hold each embedding - numpy dtype to vec0 element type.
+# int8 keeps a quarter of the size, and only each vector's direction, which is all cosine distance looks at
+PRECISIONS = {"float32": "float", "int8": "int8"}
+
+# Embeddings projected to fewer dimensions, for coarse search - see SQLiteVecStore.fit_projection
+REDUCED_SCHEMA = """create virtual table images_vec_reduced using vec0(
+    id integer primary key,
+    embedding float[{}] distance_metric=cosine);
+    """
+
+# Columns of images that closest(..., where={...}) can filter on.
+# Everything but classification is parsed from the filename, see cyto_ml.data.flowcam.filename_metadata
+FILTER_COLUMNS = ["classification", "lat", "lon", "date", "session"]
+
+# Set on every sqlite connection. WAL lets readers carry on while a write is in progress;
+# mmap_size (bytes) is shared through the OS page cache; cache_size (negative means KiB)
+# is private to each connection, so keep it modest with a pool of readers
+SQLITE_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "mmap_size": 1024 * 1024 * 1024,
+    "cache_size": -64 * 1024,
+}
+# The subset that makes sense on a read-only connection
+READ_PRAGMAS = ["mmap_size", "cache_size"]
+
 # Options passed as keyword arguments when setting a db connection
-OPTIONS = {"sqlite": {"embedding_len": 512, "check_same_thread": False}, "chromadb": {}}
+OPTIONS = {"sqlite": {"embedding_len": 512, "check_same_thread": False, "read_pool_size": 8}, "chromadb": {}}
+
+# Index for the on-disk image cache, see cyto_ml.data.image_cache.
+# blobs are the cached files, named by the SHA-256 of their contents, so a vignette reachable by several urls
+# is kept once; urls maps each url to the blob it last returned, and the ETag the server gave for it
+IMAGE_CACHE_SCHEMA = """
+    create table if not exists blobs (
+        hash text primary key,
+        size integer not null,
+        last_used real not null);
+    create index if not exists blobs_last_used on blobs (last_used);
+    create table if not exists urls (
+        url text primary key,
+        etag text,
+        hash text not null references blobs (hash) on delete cascade);
+    create index if not exists urls_hash on urls (hash);
+    create table if not exists stats (
+        name text primary key,
+        value integer not null);
+    insert or ignore into stats values ('hits', 0), ('misses', 0), ('evictions', 0), ('bytes', 0);
+    """
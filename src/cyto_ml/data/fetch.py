@@ -0,0 +1,189 @@
+"""Fetch images over HTTP from the object store, for everything in cyto_ml that reads them by url.
+
+* one requests.Session, so connections are pooled and kept alive rather than opened per image
+* connection errors, 429s and 5xx responses are retried with exponential backoff
+* every request has a (connect, read) timeout
+* fetch_many fetches a stream of urls concurrently, at most `concurrency` at a time,
+  and yields each decoded image as it arrives
+
+Pass the ETag an image had last time in `etags`, and an unchanged image comes back as a 304 with no body.
+
+With an ImageCache, images already on local disk aren't downloaded again. By default a cached copy is
+trusted, as vignettes don't change once they're in the object store; with revalidate=True each fetch
+asks the server with the cached copy's ETag instead, and is served from disk on a 304.
+The fetcher shared by cyto_ml caches in IMAGE_CACHE (~/.cache/cyto_ml/images unless set, empty for none),
+up to IMAGE_CACHE_LIMIT bytes.
+"""
+
+import asyncio
+import logging
+import os
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from itertools import islice
+from typing import AsyncIterator, Iterable, Iterator, Mapping, NamedTuple, Optional, Tuple
+
+import requests
+from PIL import Image
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from cyto_ml.data.image_cache import ImageCache
+
+# Statuses worth another try - rate limiting and server-side trouble
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+IMAGE_CACHE = os.environ.get("IMAGE_CACHE", os.path.join(os.path.expanduser("~"), ".cache", "cyto_ml", "images"))
+IMAGE_CACHE_LIMIT = int(os.environ.get("IMAGE_CACHE_LIMIT", str(5 * 1024**3)))
+
+
+class Fetched(NamedTuple):
+    url: str
+    status: Optional[int]  # None if there was no response at all
+    content: bytes = b""
+    etag: Optional[str] = None
+    image: Optional[Image.Image] = None
+
+    @property
+    def not_modified(self) -> bool:
+        return self.status == 304
+
+
+class ImageFetcher:
+    def __init__(
+        self,
+        concurrency: int = 16,
+        retries: int = 3,
+        backoff: float = 0.5,
+        timeout: Tuple[float, float] = (5, 30),
+        cache: Optional[ImageCache] = None,
+        revalidate: bool = False,
+    ):
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.cache = cache
+        self.revalidate = revalidate
+        retry = Retry(
+            total=retries,
+            backoff_factor=backoff,
+            status_forcelist=RETRY_STATUSES,
+            allowed_methods=("HEAD", "GET"),
+            raise_on_status=False,
+        )
+        # A pooled connection per worker thread
+        adapter = HTTPAdapter(pool_connections=concurrency, pool_maxsize=concurrency, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.pool = ThreadPoolExecutor(max_workers=concurrency)
+
+    def close(self) -> None:
+        self.pool.shutdown(wait=False)
+        self.session.close()
+
+    def head(self, url: str) -> requests.Response:
+        return self.session.head(url, timeout=self.timeout)
+
+    def get(self, url: str, etag: Optional[str] = None) -> requests.Response:
+        headers = {"If-None-Match": etag} if etag else None
+        return self.session.get(url, headers=headers, timeout=self.timeout)
+
+    def fetch(self, url: str, etag: Optional[str] = None) -> Fetched:
+        """Download and decode one image, or read it from the cache. Failures are logged and come back
+        without an image. With etag, an image that still has it comes back as not_modified"""
+        cached = self.cache.lookup(url) if self.cache else None
+        if cached is not None and not self.revalidate:
+            self.cache.hit(url)
+            if etag is not None and etag == cached[1]:
+                return Fetched(url, 304, etag=etag)
+            return self._decoded(url, *cached)
+
+        # Whichever ETag we have, the caller's or the cached copy's, lets the server skip sending the body
+        known = etag or (cached[1] if cached else None)
+        try:
+            response = self.get(url, known)
+        except requests.RequestException as err:
+            logging.error(f"{url} failed: {err}")
+            return Fetched(url, None)
+
+        if response.status_code == 304:
+            if etag is None and cached is not None:
+                self.cache.hit(url)
+                return self._decoded(url, *cached)
+            return Fetched(url, 304, etag=known)
+        if response.status_code != 200:
+            logging.error(f"{url} returned status code {response.status_code}")
+            return Fetched(url, response.status_code)
+
+        if self.cache:
+            try:
+                self.cache.put(url, response.content, response.headers.get("ETag"))
+            except (OSError, sqlite3.Error) as err:
+                # e.g. a full disk - the image is still good to use
+                logging.warning(f"Could not cache {url}: {err}")
+        return self._decoded(url, response.content, response.headers.get("ETag"))
+
+    @staticmethod
+    def _decoded(url: str, content: bytes, etag: Optional[str]) -> Fetched:
+        try:
+            image = Image.open(BytesIO(content))
+            # Decode now, in the worker thread, rather than whenever the pixels are first read
+            image.load()
+        except (OSError, ValueError) as err:
+            logging.error(f"{url} could not be decoded: {err}")
+            image = None
+        return Fetched(url, 200, content, etag, image)
+
+    async def fetch_many(
+        self, urls: Iterable[str], etags: Optional[Mapping[str, str]] = None
+    ) -> AsyncIterator[Fetched]:
+        """Fetch urls concurrently, yielding each result as it completes (not in the order given).
+        urls is read lazily, so it can be a generator over a whole collection"""
+        etags = etags or {}
+        loop = asyncio.get_running_loop()
+        urls = iter(urls)
+        pending = set()
+        try:
+            while True:
+                for url in islice(urls, self.concurrency - len(pending)):
+                    pending.add(loop.run_in_executor(self.pool, self.fetch, url, etags.get(url)))
+                if not pending:
+                    return
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+        finally:
+            for future in pending:
+                future.cancel()
+
+    def iter_many(self, urls: Iterable[str], etags: Optional[Mapping[str, str]] = None) -> Iterator[Fetched]:
+        """fetch_many for code that isn't async, e.g. the scripts"""
+        loop = asyncio.new_event_loop()
+        results = self.fetch_many(urls, etags)
+        try:
+            while True:
+                try:
+                    yield loop.run_until_complete(results.__anext__())
+                except StopAsyncIteration:
+                    return
+        finally:
+            loop.run_until_complete(results.aclose())
+            loop.close()
+
+
+_fetcher: Optional[ImageFetcher] = None
+
+
+def image_fetcher() -> ImageFetcher:
+    """The fetcher shared by everything in this process, so they share its connection pool,
+    and with other processes through the disk cache"""
+    global _fetcher  # noqa: PLW0603
+    if _fetcher is None:
+        _fetcher = ImageFetcher(cache=image_cache())
+    return _fetcher
+
+
+def image_cache() -> Optional[ImageCache]:
+    """The disk cache configured by IMAGE_CACHE and IMAGE_CACHE_LIMIT, if there is one"""
+    return ImageCache(IMAGE_CACHE, IMAGE_CACHE_LIMIT) if IMAGE_CACHE else None
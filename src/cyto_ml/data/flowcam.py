@@ -3,27 +3,36 @@
 # Add add those properties to the resulting output in the EXIF headers
 # where file path points to the flowcam data folder which has the collage .tifs and the .lst file inside
 # Originally adapted from https://sarigiering.co/posts/extract-individual-particle-images-from-flowcam/
+#
+# The vector store parses filenames with this module, so pandas, exiftool and skimage
+# are imported where they're used rather than on import
+from __future__ import annotations
+
 import argparse
 import glob
 import logging
 import os
 import re
-from typing import Optional
+from typing import TYPE_CHECKING, Optional
 
 import numpy as np
-import pandas as pd
-from exiftool import ExifToolHelper
-from exiftool.exceptions import ExifToolExecuteError
-from skimage.io import imread, imsave
+
+if TYPE_CHECKING:
+    import pandas as pd
 
 logging.basicConfig(level=logging.INFO)
 
+# _lat_lon_ddmmyyyy, optionally followed by _session
+FILENAME_PATTERN = r"_(-?\d+\.\d+)_(-?\d+\.\d+)_(\d{8})(?:_(\d+))?"
+
 
 def lst_metadata(filename: str) -> pd.DataFrame:
     """
     Read the csv-ish ".lst" file from the FlowCam export
     Return a pandas dataframe
     """
+    import pandas as pd  # noqa: PLC0415
+
     heads = pd.read_csv(filename, sep="|", nrows=53, skiprows=1)
     colNames = list(heads["num-fields"])
     meta = pd.read_csv(filename, sep="|", skiprows=55, header=None)
@@ -49,8 +58,7 @@ def headers_from_filename(filename: str) -> dict:
 
 def parse_filename(filename: str) -> tuple:
     """Attempt to extract file prefix, lon, lat, date, depth, from filename"""
-    pattern = r"_(-?\d+\.\d+)_(-?\d+\.\d+)_(\d{8})(?:_(\d+))?"
-    match = re.search(pattern, filename)
+    match = re.search(FILENAME_PATTERN, filename)
     if match:
         # We've left space for "depth" here
         # But all the observed values are not depths, they're like session IDs e.g. _1
@@ -69,6 +77,17 @@ def parse_filename(filename: str) -> tuple:
         return ()
 
 
+def filename_metadata(filename: str) -> dict:
+    """lat, lon, date and session encoded in a filename, each None if it doesn't have them.
+    The date is rearranged to yyyy-mm-dd so that it sorts, and can be filtered by range.
+    Quiet about filenames without coordinates, unlike parse_filename, as it's called for every stored image"""
+    match = re.search(FILENAME_PATTERN, filename)
+    if not match:
+        return {"lat": None, "lon": None, "date": None, "session": None}
+    lat, lon, date, session = match.groups()
+    return {"lat": float(lat), "lon": float(lon), "date": f"{date[4:]}-{date[2:4]}-{date[:2]}", "session": session}
+
+
 def exif_headers(lon: float, lat: float, date: str, depth: Optional[int] = 0) -> dict:
     """
     Given lat, lon, date and option of depth, write and return a dict with EXIF standard tags as keys
@@ -88,6 +107,9 @@ def write_headers(filename: str, headers: dict) -> bool:
     Given a dictionary of EXIF tag keys and their values, write to filename
     Returns True if nothing has obviously gone wrong during this process
     """
+    from exiftool import ExifToolHelper  # noqa: PLC0415
+    from exiftool.exceptions import ExifToolExecuteError  # noqa: PLC0415
+
     result = None
     try:
         with ExifToolHelper() as et:
@@ -101,6 +123,8 @@ def write_headers(filename: str, headers: dict) -> bool:
 
 
 def read_headers(filename: str) -> dict:
+    from exiftool import ExifToolHelper  # noqa: PLC0415
+
     meta = {}
     with ExifToolHelper() as et:
         meta = et.get_metadata(filename)
@@ -150,6 +174,8 @@ class FlowCamSession:
         """Not very lovely single function that replaces the work of the script.
         See cyto_ml.pipeline.pipeline_decollage - has the same code in it
         """
+        from skimage.io import imread, imsave  # noqa: PLC0415
+
         # Reasonably assume that all images in a session have same spatio-temporal metadata
         # extract the coords, date, possibly depth from directory name
         collage_headers = headers_from_filename(self.directory)
@@ -0,0 +1,162 @@
+"""Hierarchical Navigable Small World graph for approximate nearest neighbour search.
+
+Pure python/NumPy implementation of Malkov & Yashunin, https://arxiv.org/abs/1603.09320
+Vectors are L2-normalised on the way in and compared by cosine distance.
+Graph traversal is in python, but the distances for each node's neighbourhood
+are computed in one matrix-vector product.
+
+M - number of neighbours per node on the upper layers (2 * M on the bottom layer)
+ef_construction - size of the candidate list while inserting, trades build time for recall
+ef_search - size of the candidate list while querying, trades latency for recall
+"""
+
+import heapq
+import math
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+
+class HNSWIndex:
+    def __init__(
+        self,
+        dim: int,
+        M: int = 16,
+        ef_construction: int = 200,
+        ef_search: int = 50,
+        seed: int = 42,
+    ):
+        self.dim = dim
+        self.M = M
+        self.max_neighbours_0 = 2 * M
+        self.ef_construction = ef_construction
+        self.ef_search = ef_search
+        self.level_mult = 1 / math.log(M)
+        self.rng = np.random.default_rng(seed)
+
+        self.vectors = np.empty((16, dim), dtype=np.float32)
+        self.count = 0
+        self.levels: List[int] = []
+        # one adjacency dict per layer, node -> list of neighbour nodes
+        self.layers: List[Dict[int, List[int]]] = []
+        self.entry_point: Optional[int] = None
+
+    def __len__(self) -> int:
+        return self.count
+
+    def add(self, vector: np.ndarray) -> int:
+        """Insert one vector, return its node number (insertion order)"""
+        node = self._append(vector)
+        q = self.vectors[node]
+        level = int(-math.log(1.0 - self.rng.random()) * self.level_mult)
+        self.levels.append(level)
+
+        while len(self.layers) <= level:
+            self.layers.append({})
+        for layer in range(0, level + 1):
+            self.layers[layer][node] = []
+
+        if self.entry_point is None:
+            self.entry_point = node
+            return node
+
+        top = self.levels[self.entry_point]
+        entry = [self.entry_point]
+        # greedy descent through the layers above this node's level
+        for layer in range(top, level, -1):
+            entry = [self._search_layer(q, entry, 1, layer)[0][1]]
+
+        for layer in range(min(top, level), -1, -1):
+            candidates = self._search_layer(q, entry, self.ef_construction, layer)
+            max_neighbours = self.max_neighbours_0 if layer == 0 else self.M
+            neighbours = self._select_neighbours(candidates, self.M)
+            self.layers[layer][node] = neighbours
+
+            for n in neighbours:
+                links = self.layers[layer][n]
+                links.append(node)
+                if len(links) > max_neighbours:
+                    # shrink back down, keeping a diverse set from n's point of view
+                    dists = 1.0 - self.vectors[links] @ self.vectors[n]
+                    candidates_n = sorted(zip(dists.tolist(), links))
+                    self.layers[layer][n] = self._select_neighbours(candidates_n, max_neighbours)
+            entry = [n for _, n in candidates]
+
+        if level > top:
+            self.entry_point = node
+        return node
+
+    def search(self, query: np.ndarray, k: int, ef_search: Optional[int] = None) -> List[Tuple[float, int]]:
+        """Approximate k nearest nodes to query, as a list of (cosine distance, node) ordered by distance"""
+        if self.entry_point is None:
+            return []
+        q = np.asarray(query, dtype=np.float32)
+        q = q / (np.linalg.norm(q) or 1.0)
+        ef = max(ef_search or self.ef_search, k)
+
+        entry = [self.entry_point]
+        for layer in range(self.levels[self.entry_point], 0, -1):
+            entry = [self._search_layer(q, entry, 1, layer)[0][1]]
+        return self._search_layer(q, entry, ef, 0)[:k]
+
+    def _append(self, vector: np.ndarray) -> int:
+        """Copy a normalised vector into the preallocated buffer, doubling it when full"""
+        if self.count == len(self.vectors):
+            grown = np.empty((2 * len(self.vectors), self.dim), dtype=np.float32)
+            grown[: self.count] = self.vectors[: self.count]
+            self.vectors = grown
+        vector = np.asarray(vector, dtype=np.float32)
+        self.vectors[self.count] = vector / (np.linalg.norm(vector) or 1.0)
+        self.count += 1
+        return self.count - 1
+
+    def _search_layer(self, q: np.ndarray, entry: List[int], ef: int, layer: int) -> List[Tuple[float, int]]:
+        """Best-first search of one layer from the entry points, returning the ef closest (distance, node)"""
+        graph = self.layers[layer]
+        visited = set(entry)
+        dists = 1.0 - self.vectors[entry] @ q
+        candidates = list(zip(dists.tolist(), entry))
+        heapq.heapify(candidates)
+        # max-heap of the results so far, by negated distance
+        results = [(-d, n) for d, n in candidates]
+        heapq.heapify(results)
+        while len(results) > ef:
+            heapq.heappop(results)
+
+        while candidates:
+            dist, node = heapq.heappop(candidates)
+            if dist > -results[0][0]:
+                break
+            unseen = [n for n in graph[node] if n not in visited]
+            if not unseen:
+                continue
+            visited.update(unseen)
+            for d, n in zip((1.0 - self.vectors[unseen] @ q).tolist(), unseen):
+                if len(results) < ef or d < -results[0][0]:
+                    heapq.heappush(candidates, (d, n))
+                    heapq.heappush(results, (-d, n))
+                    if len(results) > ef:
+                        heapq.heappop(results)
+
+        return sorted((-d, n) for d, n in results)
+
+    def _select_neighbours(self, candidates: List[Tuple[float, int]], m: int) -> List[int]:
+        """Neighbour selection heuristic (algorithm 4 in the paper): take candidates in order of distance,
+        skipping any that are closer to an already selected neighbour than to the query.
+        Skipped candidates fill any remaining slots, so sparse regions still get m links"""
+        selected: List[int] = []
+        skipped: List[int] = []
+        for dist, node in candidates:
+            if len(selected) >= m:
+                break
+            if selected and np.max(self.vectors[selected] @ self.vectors[node]) > 1.0 - dist:
+                skipped.append(node)
+            else:
+                selected.append(node)
+        return selected + skipped[: m - len(selected)]
+
+    def __getstate__(self) -> dict:
+        """Pickle without the unused capacity at the end of the vector buffer"""
+        state = self.__dict__.copy()
+        state["vectors"] = self.vectors[: self.count]
+        return state
@@ -1,12 +1,18 @@
+# torch and torchvision are imported where they're needed, so that using
+# normalise_flowlr (e.g. in the streamlit app) doesn't load them
+from __future__ import annotations
+
+import hashlib
 import logging
-from io import BytesIO
-from typing import Optional
+from typing import TYPE_CHECKING, Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
 
 import numpy as np
-import requests
-import torch
 from PIL import Image
-from torchvision import transforms
+
+from cyto_ml.data.fetch import image_fetcher
+
+if TYPE_CHECKING:
+    import torch
 
 
 class ImageProcessingError(Exception):
@@ -25,12 +31,15 @@ def load_image_from_url(url: str, normalise_func: Optional[str] = "base_normalis
     """Given an image url, return a tensor suitable to hand to a model
     Optional normalise_func which defaults to converting to a range between 0..1
     """
-    response = requests.get(url)
-    if response.status_code == 200:
-        img = Image.open(BytesIO(response.content))
-        return prepare_image(img, normalise_func=normalise_func)
-    else:
-        logging.error(f"{url} returned status code {response.status_code}")
+    # Errors are logged by the fetcher
+    image = image_fetcher().fetch(url).image
+    if image is not None:
+        return prepare_image(image, normalise_func=normalise_func)
+
+
+def content_hash(data: bytes) -> str:
+    """Digest of an image's bytes, stored alongside its embedding so unchanged images needn't be re-embedded"""
+    return hashlib.sha256(data).hexdigest()
 
 
 def prepare_image(image: Image, normalise_func: Optional[str] = "base_normalise") -> torch.Tensor:
@@ -38,19 +47,12 @@ def prepare_image(image: Image, normalise_func: Optional[str] = "base_normalise"
     Take an xarray of image data and prepare it to pass through the model
     a) Converts the image data to a PyTorch tensor
     b) Accepts a single image or batch (no need for torch.stack)
+    normalise_func names a pipeline registered with register_normalise
     """
-
-    if hasattr(image, "mode") and image.mode == "I;16":
-        # Flow Cytometer images are 16-bit greyscale, in a low range
-        # Note - tried this and variants, does not have expected result
-        # https://stackoverflow.com/questions/18522295/python-pil-change-greyscale-tif-to-rgb
-        #
-        # Convert to 3 bands because our model has 3 channel input
-        image = convert_3_band(normalise_flowlr(image))
-
+    pipeline = normalise_pipeline(normalise_func)
     try:
-        tensor_image = globals()[normalise_func]()(image)
-    except (KeyError, Exception) as err:  # TODO trigger and catch
+        tensor_image = pipeline.image(image)
+    except Exception as err:  # TODO trigger and catch
         logging.error(err)
         raise ImageProcessingError(err)
 
@@ -59,20 +61,171 @@ def prepare_image(image: Image, normalise_func: Optional[str] = "base_normalise"
     return tensor_image
 
 
-def base_normalise() -> transforms.Compose:
+def prepare_batch(images: Iterable[Image], normalise_func: Optional[str] = "base_normalise") -> torch.Tensor:
+    """Prepare several images as one (N, 3, H, W) tensor, so a model can embed them in a single forward pass.
+    See pad_and_stack for how differently sized vignettes are combined, and Normalise.batch for the
+    batches that are prepared in one go rather than image by image"""
+    pipeline = normalise_pipeline(normalise_func)
+    try:
+        return pipeline.batch(list(images))
+    except Exception as err:
+        logging.error(err)
+        raise ImageProcessingError(err)
+
+
+def same_size_batches(
+    images: Sequence[Image], normalise_func: Optional[str] = "base_normalise", batch_size: int = 32
+) -> Iterator[List[int]]:
+    """Positions of images in batches of up to batch_size that are all prepared to the same height and width,
+    so prepare_batch has nothing to pad. Zero padding changes a ResNet's pooled features, so a padded image's
+    embedding would depend on what else was in its batch. With a pipeline that resizes, every image is the same size"""
+    pipeline = normalise_pipeline(normalise_func)
+    groups: Dict[Tuple[int, int], List[int]] = {}
+    for position, image in enumerate(images):
+        if pipeline.size:
+            size = tuple(pipeline.size)
+        else:
+            size = image.shape[:2] if isinstance(image, np.ndarray) else (image.height, image.width)
+        groups.setdefault(size, []).append(position)
+    for positions in groups.values():
+        for offset in range(0, len(positions), batch_size):
+            yield positions[offset : offset + batch_size]  # noqa: E203
+
+
+def pad_and_stack(tensors: List[torch.Tensor]) -> torch.Tensor:
+    """Combine prepared images, each (1, C, H, W) as prepare_image returns them, into one (N, C, H, W) batch.
+    FlowCam vignettes vary in size, so each is padded with zeros on the bottom and right to the largest
+    height and width in the batch. Padding shifts a vignette's embedding from the one it gets on its own -
+    to embed images, batch those of the same size with same_size_batches (or resize them all)"""
+    import torch  # noqa: PLC0415
+
+    height = max(tensor.shape[-2] for tensor in tensors)
+    width = max(tensor.shape[-1] for tensor in tensors)
+    return torch.cat(
+        [
+            torch.nn.functional.pad(tensor, (0, width - tensor.shape[-1], 0, height - tensor.shape[-2]))
+            for tensor in tensors
+        ]
+    )
+
+
+class Normalise:
+    """A named preprocessing pipeline, built once (see register_normalise) and used for every image.
+    Each image becomes a float tensor between 0 and 1 - by ToTensor, or normalise_flowlr for Flow Cytometer
+    images - is resized to size, if there is one, then goes through steps: torchvision transforms on float
+    tensors, such as Normalize, that work on one (C, H, W) image or an (N, C, H, W) batch alike
+    """
+
+    def __init__(self, size: Optional[Tuple[int, int]] = None, steps: Sequence[Callable] = ()):
+        from torchvision import transforms  # noqa: PLC0415
+
+        self.size = size
+        self.resize = transforms.Resize(size) if size else None
+        self.steps = transforms.Compose(list(steps)) if steps else None
+        self.to_tensor = transforms.ToTensor()
+
+    def __call__(self, image: Image) -> torch.Tensor:
+        """Like a torchvision transform, which these pipelines used to be"""
+        return self.image(image)
+
+    def image(self, image: Image) -> torch.Tensor:
+        """One image as a (C, H, W) tensor"""
+        if is_flowlr(image):
+            # Flow Cytometer images are 16-bit greyscale, in a low range
+            # Note - tried this and variants, does not have expected result
+            # https://stackoverflow.com/questions/18522295/python-pil-change-greyscale-tif-to-rgb
+            #
+            # Normalised straight to a float32 tensor, with 3 bands because our model has 3 channel input
+            tensor = flowlr_tensor(normalise_flowlr(image))
+        elif isinstance(image, Image.Image) and self.resize:
+            # PIL images are resized before they're tensorised, as torchvision has always done for them
+            tensor = self.to_tensor(self.resize(image))
+        else:
+            tensor = self.to_tensor(image)
+        if self.resize and tuple(tensor.shape[-2:]) != tuple(self.size):
+            tensor = self.resize(tensor)
+        return self.steps(tensor) if self.steps else tensor
+
+    def batch(self, images: List[Image]) -> torch.Tensor:
+        """Several images as one (N, C, H, W) tensor, the same as preparing each and padding them together.
+        Two kinds of batch are prepared in one go rather than image by image:
+        * Flow Cytometer images that only need tensorising, by normalise_flowlr_batch
+        * 8 bit PIL images that all get resized, tensorised as one stacked array"""
+        import torch  # noqa: PLC0415
+
+        if all(is_flowlr(image) for image in images) and not self.size and not self.steps:
+            return flowlr_tensor(normalise_flowlr_batch(images))
+
+        modes = {getattr(image, "mode", None) for image in images}
+        if (
+            self.size
+            and len(modes) == 1
+            and modes <= {"RGB", "L"}
+            and all(isinstance(image, Image.Image) for image in images)
+        ):
+            pixels = np.stack([np.asarray(self.resize(image)) for image in images])
+            if pixels.ndim == 3:
+                pixels = pixels[..., np.newaxis]
+            # What ToTensor does, for the whole batch at once
+            batch = torch.from_numpy(pixels).permute(0, 3, 1, 2).float().div(255)
+            return self.steps(batch) if self.steps else batch
+
+        return pad_and_stack([self.image(image).unsqueeze(0) for image in images])
+
+
+# Preprocessing pipelines by name, for normalise_func. Each is built the first time it's used,
+# so torchvision is only imported when it's needed, then kept
+_NORMALISE: Dict[str, Callable[[], Normalise]] = {}
+_built: Dict[str, Normalise] = {}
+
+
+def register_normalise(name: str, factory: Callable[[], Normalise]) -> None:
+    """Make a preprocessing pipeline available as normalise_func=name. For a model expecting
+    ImageNet-standardised 224x224 input, for example:
+
+    register_normalise("imagenet_normalise", lambda: Normalise((224, 224), [Normalize(IMAGENET_MEAN, IMAGENET_STD)]))
+    """
+    _NORMALISE[name] = factory
+    _built.pop(name, None)
+
+
+def normalise_pipeline(name: str) -> Normalise:
+    """The pipeline registered as name, built and checked the first time it's asked for"""
+    pipeline = _built.get(name)
+    if pipeline is None:
+        if name not in _NORMALISE:
+            logging.error(f"No normalise_func called {name}")
+            raise ImageProcessingError(f"No normalise_func called {name}, choose from {sorted(_NORMALISE)}")
+        pipeline = _NORMALISE[name]()
+        if not isinstance(pipeline, Normalise):
+            raise ImageProcessingError(f"normalise_func {name} built a {type(pipeline).__name__}, not a Normalise")
+        _built[name] = pipeline
+    return pipeline
+
+
+def base_normalise() -> Normalise:
     """
     Baseline - don't standardise the values, just tensorise
     (which automatically translates to a 0-1 range)
     """
-    return transforms.ToTensor()
+    return Normalise()
 
 
-def resize_normalise() -> transforms.Compose:
+def resize_normalise() -> Normalise:
     """
     Resize to 256x256
     https://github.com/ukceh-rse/ViT-LASNet/blob/36235f9b992a6c345f1010dab133549d20f181d9/test/test.py#L115
     """
-    return transforms.Compose([transforms.Resize((256, 256)), transforms.ToTensor()])
+    return Normalise(size=(256, 256))
+
+
+register_normalise("base_normalise", base_normalise)
+register_normalise("resize_normalise", resize_normalise)
+
+
+def is_flowlr(image: Image) -> bool:
+    """Flow Cytometer images are 16 bit greyscale"""
+    return getattr(image, "mode", None) == "I;16"
 
 
 def normalise_flowlr(image: Image) -> np.array:
@@ -84,24 +237,41 @@ def normalise_flowlr(image: Image) -> np.array:
     Both for display, and before handing to a model.
 
     Image.point(lambda...) should do this, but the values stay integers
-    So roundtrip this through numpy
+    So roundtrip this through numpy, as float32 which is what the model layers expect
     """
-    pix = np.array(image)
-    max_val = max(pix.flatten())
-    pix = pix / max_val
-    return pix
+    return normalise_flowlr_batch([image])[0]
+
+
+def normalise_flowlr_batch(images: List[Image]) -> np.array:
+    """normalise_flowlr for several images at once, as an (N, H, W) float32 array.
+    Images smaller than the largest height and width are padded with zeros on the bottom and right,
+    as pad_and_stack does. The 16 bit values are cast to float32 as they're copied in,
+    and each image is divided in place by its own maximum, so there are no intermediate arrays"""
+    height = max(image.height for image in images)
+    width = max(image.width for image in images)
+    batch = np.zeros((len(images), height, width), dtype=np.float32)
+    for pix, image in zip(batch, images):
+        pix[: image.height, : image.width] = np.asarray(image)
+    max_vals = batch.max(axis=(1, 2), keepdims=True)
+    # A blank image stays at zero, rather than dividing by it
+    np.divide(batch, max_vals, out=batch, where=max_vals > 0)
+    return batch
+
+
+def flowlr_tensor(pix: np.array) -> torch.Tensor:
+    """Normalised (H, W) or (N, H, W) greyscale as a (3, H, W) or (N, 3, H, W) tensor for a 3 channel model.
+    The tensor shares the array's memory, and the 3 bands are one expanded view of it rather than copies"""
+    import torch  # noqa: PLC0415
+
+    tensor = torch.from_numpy(pix).unsqueeze(-3)
+    return tensor.expand(*tensor.shape[:-3], 3, *tensor.shape[-2:])
 
 
 def convert_3_band(image: np.array) -> np.array:
     """
     Given a 1-band image normalised between 0 and 1, convert to 3 band
-    https://stackoverflow.com/a/57723482
-    This seems very brute-force, but PIL is not converting our odd-format
-    greyscale images from the Flow Cytometer well. Improvements appreciated
+    The same value in each band, as a read-only broadcast view of the image rather than a copy.
+    Cast to float32 (if it isn't already) as this is what the model layers expect
     """
-    img2 = np.zeros((image.shape[0], image.shape[1], 3))
-    img2[:, :, 0] = image  # same value in each channel
-    img2[:, :, 1] = image
-    img2[:, :, 2] = image
-    # Cast to float32 as this is what the model layers expect
-    return img2.astype(np.float32)
+    image = np.asarray(image, dtype=np.float32)
+    return np.broadcast_to(image[:, :, np.newaxis], (*image.shape, 3))
@@ -0,0 +1,154 @@
+"""A content-addressed cache of downloaded images on local disk, shared by every process on the machine.
+
+Files are named by the SHA-256 of their contents, so a vignette is kept once however many urls return it.
+A small sqlite index (see db_config.IMAGE_CACHE_SCHEMA) maps each url to its file and ETag, records when
+each file was last used, and keeps hit / miss / eviction counts. Once the files take more than max_bytes,
+the least recently used are evicted.
+
+Several processes can share a directory - e.g. the embedding job, the Label Studio backend and the
+streamlit app. Files are written to a temporary name and renamed into place, so nobody reads half a file,
+and index changes are short sqlite transactions. A file evicted by another process between looking it up
+and reading it is just a miss.
+"""
+
+import hashlib
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from typing import Iterator, List, Optional, Tuple
+
+from cyto_ml.data.db_config import IMAGE_CACHE_SCHEMA
+
+
+class ImageCache:
+    def __init__(self, directory: str, max_bytes: int = 5 * 1024**3):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        self.index = os.path.join(directory, "index.db")
+        # A connection per thread, as the fetcher uses the cache from its worker threads
+        self._local = threading.local()
+        self.db.executescript(IMAGE_CACHE_SCHEMA)
+
+    @property
+    def db(self) -> sqlite3.Connection:
+        db = getattr(self._local, "db", None)
+        if db is None:
+            # Autocommit, with explicit transactions where several statements go together
+            db = sqlite3.connect(self.index, timeout=30, isolation_level=None)
+            db.execute("pragma journal_mode = WAL")
+            db.execute("pragma synchronous = NORMAL")
+            db.execute("pragma foreign_keys = on")
+            self._local.db = db
+        return db
+
+    def path(self, digest: str) -> str:
+        # Two levels, so no one directory holds every file
+        return os.path.join(self.directory, digest[:2], digest)
+
+    def lookup(self, url: str) -> Optional[Tuple[bytes, Optional[str]]]:
+        """The cached contents of url and their ETag, or None. Doesn't count as a hit until hit() is called,
+        as the caller may yet find the copy is out of date"""
+        row = self.db.execute("select hash, etag from urls where url = ?", (url,)).fetchone()
+        if row is None:
+            return None
+        digest, etag = row
+        try:
+            with open(self.path(digest), "rb") as f:
+                return f.read(), etag
+        except FileNotFoundError:
+            # Evicted by another process since the lookup, or removed by hand
+            self._forget([digest])
+            return None
+
+    def hit(self, url: str) -> None:
+        """Record that url was served from the cache, marking its file as recently used"""
+        with self._transaction() as db:
+            db.execute(
+                "update blobs set last_used = ? where hash = (select hash from urls where url = ?)", (time.time(), url)
+            )
+            db.execute("update stats set value = value + 1 where name = 'hits'")
+
+    def put(self, url: str, content: bytes, etag: Optional[str] = None) -> None:
+        """Keep a download the cache couldn't serve (so counted as a miss), evicting old files if it's over size"""
+        digest = hashlib.sha256(content).hexdigest()
+        path = self.path(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with tempfile.NamedTemporaryFile(dir=os.path.dirname(path), delete=False) as f:
+                f.write(content)
+            os.replace(f.name, path)
+
+        with self._transaction() as db:
+            now = time.time()
+            if db.execute("insert or ignore into blobs values (?, ?, ?)", (digest, len(content), now)).rowcount:
+                db.execute("update stats set value = value + ? where name = 'bytes'", (len(content),))
+            else:
+                db.execute("update blobs set last_used = ? where hash = ?", (now, digest))
+            db.execute("insert or replace into urls (url, etag, hash) values (?, ?, ?)", (url, etag, digest))
+            db.execute("update stats set value = value + 1 where name = 'misses'")
+            evicted = self._evict(db)
+        self._remove(evicted)
+
+    def stats(self) -> dict:
+        """Counts since the cache was created, across every process that has used it"""
+        stats = dict(self.db.execute("select name, value from stats"))
+        stats["files"] = self.db.execute("select count(*) from blobs").fetchone()[0]
+        stats["max_bytes"] = self.max_bytes
+        return stats
+
+    def close(self) -> None:
+        db = getattr(self._local, "db", None)
+        if db is not None:
+            db.close()
+            self._local.db = None
+
+    @contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        """begin immediate takes the write lock up front, so concurrent writers queue rather than deadlock"""
+        db = self.db
+        db.execute("begin immediate")
+        try:
+            yield db
+        except BaseException:
+            db.execute("rollback")
+            raise
+        db.execute("commit")
+
+    def _evict(self, db: sqlite3.Connection) -> List[str]:
+        """Drop the least recently used files until the rest fit in max_bytes, returning their hashes"""
+        total = db.execute("select value from stats where name = 'bytes'").fetchone()[0]
+        if total <= self.max_bytes:
+            return []
+        evicted = []
+        for digest, size in db.execute("select hash, size from blobs order by last_used"):
+            if total <= self.max_bytes:
+                break
+            evicted.append(digest)
+            total -= size
+        self._delete(db, evicted)
+        db.execute("update stats set value = value + ? where name = 'evictions'", (len(evicted),))
+        return evicted
+
+    def _forget(self, digests: List[str]) -> None:
+        with self._transaction() as db:
+            self._delete(db, digests)
+
+    @staticmethod
+    def _delete(db: sqlite3.Connection, digests: List[str]) -> None:
+        """Remove files from the index - and the urls that returned them, by cascade - keeping the byte count"""
+        for digest in digests:
+            size = db.execute("select size from blobs where hash = ?", (digest,)).fetchone()
+            if size is not None:
+                db.execute("delete from blobs where hash = ?", (digest,))
+                db.execute("update stats set value = value - ? where name = 'bytes'", size)
+
+    def _remove(self, digests: List[str]) -> None:
+        for digest in digests:
+            try:
+                os.remove(self.path(digest))
+            except FileNotFoundError:
+                pass
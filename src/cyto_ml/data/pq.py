@@ -0,0 +1,184 @@
+"""Inverted file index with product quantisation (IVF-PQ) for compact approximate search.
+
+Jégou, Douze & Schmid, https://inria.hal.science/inria-00514462
+* a coarse k-means partitions the (L2-normalised) vectors into n_lists cells
+* each vector's residual from its cell centroid is split into n_subvectors pieces,
+  and each piece is replaced by the index of its nearest centroid in a 256-entry codebook
+
+So a vector is stored as one list number plus n_subvectors bytes - a 2048-d float32
+embedding (8 KB) with the default 128 subvectors takes 128 bytes.
+Each cell keeps a posting array of the positions in it, so a query only reads the codes of the cells it probes.
+Queries use asymmetric distance computation: the query stays exact, and for each probed cell
+its residual's distance to every codebook entry is tabulated once, so scoring a code is
+n_subvectors table lookups.
+"""
+
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+CODEBOOK_SIZE = 256  # one byte per subvector code
+
+
+def normalise(matrix: np.ndarray) -> np.ndarray:
+    """L2-normalise rows, so squared L2 distance is twice the cosine distance"""
+    matrix = np.asarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    return matrix / np.where(norms == 0, 1, norms)
+
+
+class IVFPQIndex:
+    def __init__(self, dim: int, n_lists: int = 256, n_subvectors: Optional[int] = None, seed: int = 42):
+        self.dim = dim
+        self.n_lists = n_lists
+        self.n_subvectors = n_subvectors or max(dim // 16, 1)
+        if dim % self.n_subvectors:
+            raise ValueError(f"Embedding length {dim} isn't divisible into {self.n_subvectors} subvectors")
+        self.sub_dim = dim // self.n_subvectors
+        self.seed = seed
+
+        self.centroids: Optional[np.ndarray] = None  # (n_lists, dim)
+        self.codebooks: Optional[np.ndarray] = None  # (n_subvectors, 256, sub_dim)
+        # Cell number and codes per vector, in buffers that double when full so adds are amortised O(1)
+        self._size = 0
+        self._lists = np.empty(0, dtype=np.int32)
+        self._codes = np.empty((0, self.n_subvectors), dtype=np.uint8)
+        # Positions in each cell, as the arrays added to it - merged into one when the cell is next searched
+        self._postings: List[List[np.ndarray]] = [[] for _ in range(n_lists)]
+
+    def __len__(self) -> int:
+        return self._size
+
+    @property
+    def lists(self) -> np.ndarray:
+        """Cell number per vector"""
+        return self._lists[: self._size]
+
+    @property
+    def codes(self) -> np.ndarray:
+        """(N, n_subvectors) uint8 codes"""
+        return self._codes[: self._size]
+
+    def __getstate__(self) -> dict:
+        # Pickled without the buffers' spare room, and with each cell's postings in one array
+        state = self.__dict__.copy()
+        state["_lists"], state["_codes"] = self.lists.copy(), self.codes.copy()
+        state["_postings"] = [[self._posting(cell)] for cell in range(self.n_lists)]
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        if "lists" in state:
+            # Pickled before cells had posting arrays
+            lists, codes = state.pop("lists"), state.pop("codes")
+            state.update(_size=len(lists), _lists=lists, _codes=codes)
+            state["_postings"] = [[np.flatnonzero(lists == cell)] for cell in range(state["n_lists"])]
+        self.__dict__.update(state)
+
+    @property
+    def is_trained(self) -> bool:
+        return self.centroids is not None
+
+    def train(self, sample: np.ndarray) -> None:
+        """Fit the coarse partition and the residual codebooks from a sample of the collection"""
+        # Only needed for training, and slow to import
+        from sklearn.cluster import KMeans  # noqa: PLC0415
+
+        sample = normalise(sample)
+        if len(sample) < max(self.n_lists, CODEBOOK_SIZE):
+            raise ValueError(f"Need at least {max(self.n_lists, CODEBOOK_SIZE)} vectors to train, got {len(sample)}")
+
+        coarse = KMeans(n_clusters=self.n_lists, n_init=1, random_state=self.seed).fit(sample)
+        self.centroids = coarse.cluster_centers_.astype(np.float32)
+        residuals = sample - self.centroids[coarse.labels_]
+
+        self.codebooks = np.empty((self.n_subvectors, CODEBOOK_SIZE, self.sub_dim), dtype=np.float32)
+        for j in range(self.n_subvectors):
+            piece = residuals[:, j * self.sub_dim : (j + 1) * self.sub_dim]  # noqa: E203
+            km = KMeans(n_clusters=CODEBOOK_SIZE, n_init=1, random_state=self.seed).fit(piece)
+            self.codebooks[j] = km.cluster_centers_
+
+    def encode(self, matrix: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Cell numbers and (N, n_subvectors) uint8 codes for a batch of vectors"""
+        matrix = normalise(np.atleast_2d(matrix))
+        lists = self._nearest(matrix, self.centroids)
+        residuals = matrix - self.centroids[lists]
+        codes = np.empty((len(matrix), self.n_subvectors), dtype=np.uint8)
+        for j in range(self.n_subvectors):
+            piece = residuals[:, j * self.sub_dim : (j + 1) * self.sub_dim]  # noqa: E203
+            codes[:, j] = self._nearest(piece, self.codebooks[j])
+        return lists, codes
+
+    def decode(self, positions: np.ndarray) -> np.ndarray:
+        """Approximate reconstruction of stored vectors from their cell centroid and codes"""
+        codes = self.codes[positions]
+        pieces = self.codebooks[np.arange(self.n_subvectors), codes]  # (N, n_subvectors, sub_dim)
+        return self.centroids[self.lists[positions]] + pieces.reshape(len(positions), self.dim)
+
+    def add(self, matrix: np.ndarray) -> np.ndarray:
+        """Encode and append vectors, returning their positions in the index"""
+        if not self.is_trained:
+            raise ValueError("Index needs to be trained before adding vectors")
+        lists, codes = self.encode(matrix)
+        start, end = self._size, self._size + len(lists)
+        self._reserve(end)
+        self._lists[start:end] = lists
+        self._codes[start:end] = codes
+        self._size = end
+
+        positions = np.arange(start, end)
+        order = np.argsort(lists, kind="stable")
+        cells, starts = np.unique(lists[order], return_index=True)
+        for cell, in_cell in zip(cells.tolist(), np.split(positions[order], starts[1:])):
+            self._postings[cell].append(in_cell)
+        return positions
+
+    def _reserve(self, size: int) -> None:
+        """Grow the buffers to hold at least size vectors, doubling"""
+        if size <= len(self._lists):
+            return
+        capacity = max(len(self._lists), 1)
+        while capacity < size:
+            capacity *= 2
+        lists = np.empty(capacity, dtype=np.int32)
+        codes = np.empty((capacity, self.n_subvectors), dtype=np.uint8)
+        lists[: self._size], codes[: self._size] = self.lists, self.codes
+        self._lists, self._codes = lists, codes
+
+    def _posting(self, cell: int) -> np.ndarray:
+        """Positions of the vectors in a cell, in the order they were added"""
+        chunks = self._postings[cell]
+        if len(chunks) > 1:
+            chunks[:] = [np.concatenate(chunks)]
+        return chunks[0] if chunks else np.empty(0, dtype=np.int64)
+
+    def search(self, query: np.ndarray, k: int, nprobe: int = 8) -> List[Tuple[float, int]]:
+        """Approximate k nearest positions to query by asymmetric distance over the nprobe closest cells.
+        Only those cells' codes are read, from their posting arrays.
+        Returns (cosine distance, position) ordered by distance"""
+        q = normalise(query)
+        cells = np.argsort(((self.centroids - q) ** 2).sum(axis=1))[:nprobe]
+        found, scores = [], []
+        for cell in cells.tolist():
+            in_cell = self._posting(cell)
+            if not len(in_cell):
+                continue
+            # Distance from each piece of the query's residual to every codebook entry, (n_subvectors, 256)
+            residual = (q - self.centroids[cell]).reshape(self.n_subvectors, 1, self.sub_dim)
+            table = ((self.codebooks - residual) ** 2).sum(axis=2)
+            found.append(in_cell)
+            scores.append(table[np.arange(self.n_subvectors), self._codes[in_cell]].sum(axis=1))
+        if not found:
+            return []
+        positions, distances = np.concatenate(found), np.concatenate(scores)
+
+        k = min(k, len(positions))
+        top = np.argpartition(distances, k - 1)[:k]
+        top = top[np.argsort(distances[top])]
+        # squared L2 between unit vectors is 2 * cosine distance
+        return [(float(distances[i]) / 2, int(positions[i])) for i in top]
+
+    @staticmethod
+    def _nearest(matrix: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+        """Index of the nearest centroid for each row, by squared L2"""
+        dists = (matrix**2).sum(axis=1, keepdims=True) - 2 * matrix @ centroids.T + (centroids**2).sum(axis=1)
+        return np.argmin(dists, axis=1)
@@ -0,0 +1,70 @@
+"""Linear projections of embeddings down to a few dimensions, for coarse search and clustering.
+
+* pca - incremental PCA, fitted chunk by chunk so the collection never has to fit in memory at once
+* random - a seeded Gaussian random projection, which needs no fitting and roughly preserves
+  distances between vectors (Johnson-Lindenstrauss)
+
+A 2048-d ResNet50 embedding projected to 64 dimensions is 32x smaller, so both a brute-force
+KNN scan and each KMeans iteration do about 32x less work.
+"""
+
+from io import BytesIO
+from typing import Iterable
+
+import numpy as np
+
+
+class Projection:
+    def __init__(self, components: np.ndarray, mean: np.ndarray, method: str):
+        self.components = np.asarray(components, dtype=np.float32)  # (dim, input_dim)
+        self.mean = np.asarray(mean, dtype=np.float32)  # (input_dim,)
+        self.method = method
+
+    @property
+    def dim(self) -> int:
+        return self.components.shape[0]
+
+    @property
+    def input_dim(self) -> int:
+        return self.components.shape[1]
+
+    @classmethod
+    def fit_pca(cls, chunks: Iterable[np.ndarray], dim: int) -> "Projection":
+        """Fit principal components from an iterable of (N, input_dim) matrices, e.g. VectorStore.iter_embeddings.
+        Each partial fit needs at least dim rows, so short chunks are held back and joined to the next -
+        fewer than dim left over at the end are skipped"""
+        # Only needed for fitting, and slow to import
+        from sklearn.decomposition import IncrementalPCA  # noqa: PLC0415
+
+        pca = IncrementalPCA(n_components=dim)
+        held = []
+        for chunk in chunks:
+            held.append(chunk)
+            if sum(len(c) for c in held) >= dim:
+                pca.partial_fit(np.concatenate(held))
+                held = []
+        if not hasattr(pca, "components_"):
+            raise ValueError(f"Need at least {dim} vectors to fit {dim} components")
+        return cls(pca.components_, pca.mean_, "pca")
+
+    @classmethod
+    def random(cls, input_dim: int, dim: int, seed: int = 42) -> "Projection":
+        """Gaussian random projection, scaled so vector lengths are preserved in expectation"""
+        rng = np.random.default_rng(seed)
+        components = rng.standard_normal((dim, input_dim), dtype=np.float32) / np.sqrt(dim)
+        return cls(components, np.zeros(input_dim, dtype=np.float32), "random")
+
+    def transform(self, matrix: np.ndarray) -> np.ndarray:
+        """Project (N, input_dim) rows to (N, dim), as contiguous float32"""
+        matrix = np.atleast_2d(np.asarray(matrix, dtype=np.float32))
+        return np.ascontiguousarray((matrix - self.mean) @ self.components.T)
+
+    def to_bytes(self) -> bytes:
+        buffer = BytesIO()
+        np.savez(buffer, components=self.components, mean=self.mean, method=self.method)
+        return buffer.getvalue()
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "Projection":
+        arrays = np.load(BytesIO(data))
+        return cls(arrays["components"], arrays["mean"], str(arrays["method"]))
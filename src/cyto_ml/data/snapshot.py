@@ -0,0 +1,90 @@
+"""Read-only snapshots of a vector store's embeddings, for consumers that only need the matrix.
+
+A snapshot is a `.npy` file holding the (N, D) float32 embeddings and a `.json` sidecar
+with the ids in the same order and the fingerprint of the store it was taken from.
+Loading memory-maps the `.npy`, so several processes (app sessions, the k-means stage,
+the Label Studio backend) share one page-cached copy instead of each reading SQLite.
+"""
+
+import json
+import logging
+import os
+from typing import Tuple
+
+import numpy as np
+
+from cyto_ml.data.vectorstore import VectorStore
+
+
+def snapshot_paths(path: str) -> Tuple[str, str]:
+    """The matrix and sidecar files for a snapshot at `path` (no extension)"""
+    return f"{path}.npy", f"{path}.json"
+
+
+def write_snapshot(store: VectorStore, path: str) -> None:
+    """Export the store's embeddings and ids to a snapshot at `path`.
+    Rows are streamed from the store in chunks into a memory-mapped .npy, so the whole
+    matrix is never held in memory. Both files are written under temporary names and moved
+    into place, sidecar last, so a concurrent reader never sees a half-written snapshot"""
+    matrix_file, sidecar_file = snapshot_paths(path)
+    fingerprint = store.fingerprint()
+    rows = store.count()
+
+    tmp = f".{os.getpid()}.tmp"
+    ids = []
+    matrix = None
+    if rows:
+        for chunk, chunk_ids in store.iter_embeddings():
+            if matrix is None:
+                shape = (rows, chunk.shape[1])
+                matrix = np.lib.format.open_memmap(matrix_file + tmp, mode="w+", dtype=np.float32, shape=shape)
+            # Rows added since we counted are left for the next snapshot
+            take = min(len(chunk), rows - len(ids))
+            matrix[len(ids) : len(ids) + take] = chunk[:take]  # noqa: E203
+            ids.extend(chunk_ids[:take])
+            if len(ids) == rows:
+                break
+    if matrix is None:
+        with open(matrix_file + tmp, "wb") as f:
+            np.save(f, np.empty((0, 0), dtype=np.float32))
+    elif len(ids) < rows:
+        # Rows removed since we counted - the matrix is sized by the rows read, not the count
+        with open(matrix_file + tmp + ".short", "wb") as f:
+            np.save(f, matrix[: len(ids)])
+        del matrix
+        os.replace(matrix_file + tmp + ".short", matrix_file + tmp)
+    else:
+        matrix.flush()
+        del matrix
+    os.replace(matrix_file + tmp, matrix_file)
+
+    with open(sidecar_file + tmp, "w") as f:
+        json.dump({"fingerprint": list(fingerprint), "ids": ids}, f)
+    os.replace(sidecar_file + tmp, sidecar_file)
+    logging.info(f"Wrote {len(ids)} embeddings to snapshot {matrix_file}")
+
+
+def load_snapshot(path: str) -> Tuple[np.memmap, np.ndarray]:
+    """Memory-map a snapshot, returning the read-only (N, D) matrix and the ids in the same order"""
+    matrix_file, sidecar_file = snapshot_paths(path)
+    with open(sidecar_file) as f:
+        sidecar = json.load(f)
+    matrix = np.load(matrix_file, mmap_mode="r")
+    return matrix, np.asarray(sidecar["ids"], dtype=object)
+
+
+def is_fresh(store: VectorStore, path: str) -> bool:
+    """True if a snapshot exists at `path` and the store hasn't changed since it was written"""
+    matrix_file, sidecar_file = snapshot_paths(path)
+    if not (os.path.exists(matrix_file) and os.path.exists(sidecar_file)):
+        return False
+    with open(sidecar_file) as f:
+        fingerprint = json.load(f)["fingerprint"]
+    return fingerprint == list(store.fingerprint())
+
+
+def snapshot(store: VectorStore, path: str) -> Tuple[np.memmap, np.ndarray]:
+    """Load the snapshot at `path`, first rewriting it if the store has changed (see VectorStore.fingerprint)"""
+    if not is_fresh(store, path):
+        write_snapshot(store, path)
+    return load_snapshot(path)
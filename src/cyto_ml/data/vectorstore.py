@@ -1,18 +1,47 @@
+import functools
+import hashlib
+import heapq
+import importlib
+import itertools
+import json
 import logging
 import os
+import pathlib
+import pickle
+import queue
+import random
+import re
 import sqlite3
 import struct
+import threading
+import time
 from abc import ABCMeta, abstractmethod
-from typing import List, Optional
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import TYPE_CHECKING, Callable, Dict, Iterator, List, Optional, Tuple, Union
 
-import chromadb
-import chromadb.api.models.Collection
 import numpy as np
 import sqlite_vec
-from chromadb.config import Settings
-from chromadb.errors import UniqueConstraintError
 
-from cyto_ml.data.db_config import SQLITE_SCHEMA
+from cyto_ml.data.db_config import (
+    DEFAULT_MODEL,
+    FILTER_COLUMNS,
+    MODEL_SCHEMA,
+    PRECISIONS,
+    READ_PRAGMAS,
+    REDUCED_SCHEMA,
+    SCHEMA_VERSION,
+    SQLITE_PRAGMAS,
+    SQLITE_SCHEMA,
+)
+from cyto_ml.data.flowcam import filename_metadata
+from cyto_ml.data.hnsw import HNSWIndex
+from cyto_ml.data.pq import IVFPQIndex, normalise
+from cyto_ml.data.projection import Projection
+
+if TYPE_CHECKING:
+    import chromadb
 
 logging.basicConfig(level=logging.INFO)
 # TODO make this sensibly configurable, not confusingly hardcoded
@@ -32,6 +61,125 @@ def deserialize(packed: bytes) -> List[float]:
     return struct.unpack("%sf" % size, packed)
 
 
+def pickle_atomic(obj: object, path: str) -> None:
+    """Pickle obj to path via a temporary file, so readers never see a partial write"""
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        pickle.dump(obj, f)
+    os.replace(tmp, path)
+
+
+class QueryCache:
+    """Bounded LRU cache for query results, with hit/miss counters.
+    Each entry is tagged with the store's generation when it was computed, and only served
+    while the store is still at that generation, so writes invalidate it without a scan"""
+
+    def __init__(self, maxsize: int = 1024):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_or_compute(self, key: tuple, generation: object, compute: Callable[[], Optional[list]]) -> Optional[list]:
+        """Cached result for key if it was computed at this generation, otherwise compute and cache it.
+        Take generation before computing, so a write that lands mid-query can't be masked.
+        Returns a fresh list each time, as callers are free to modify what they get back"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == generation:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return list(entry[1])
+            self.misses += 1
+
+        result = compute()
+        if result is not None and self.maxsize > 0:
+            with self._lock:
+                self._entries[key] = (generation, tuple(result))
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.maxsize:
+                    self._entries.popitem(last=False)
+        return None if result is None else list(result)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._entries), "maxsize": self.maxsize}
+
+
+def top_k(
+    queries: np.ndarray, matrix: np.ndarray, k: int, chunk_size: int = 1024, normalised: bool = False
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Exact cosine top-k of every query row against every matrix row.
+    Similarities are one matrix product per chunk of queries, so memory is bounded by
+    chunk_size * len(matrix) floats, and np.argpartition avoids sorting whole rows.
+    normalised - matrix rows are already unit length, so it needn't be copied to normalise it
+    Returns (positions, distances), both (len(queries), min(k, len(matrix))) and ordered by distance"""
+    queries = normalise(np.atleast_2d(queries))
+    if not normalised:
+        matrix = normalise(matrix)
+    k = min(k, len(matrix))
+    positions = np.empty((len(queries), k), dtype=np.int64)
+    distances = np.empty((len(queries), k), dtype=np.float32)
+    if not k:
+        return positions, distances
+
+    for offset in range(0, len(queries), chunk_size):
+        end = offset + chunk_size
+        similarity = queries[offset:end] @ matrix.T
+        top = np.argpartition(-similarity, k - 1, axis=1)[:, :k]
+        top_similarity = np.take_along_axis(similarity, top, axis=1)
+        order = np.argsort(-top_similarity, axis=1)
+        positions[offset:end] = np.take_along_axis(top, order, axis=1)
+        distances[offset:end] = 1.0 - np.take_along_axis(top_similarity, order, axis=1)
+    return positions, distances
+
+
+def stack_results(results: List[List[Tuple[str, float]]], width: int) -> Tuple[np.ndarray, np.ndarray]:
+    """(id, distance) lists for several queries as (ids, distances) arrays of width columns.
+    Approximate indexes can find fewer than that for a query - the gaps are None and inf"""
+    ids = np.full((len(results), width), None, dtype=object)
+    distances = np.full((len(results), width), np.inf, dtype=np.float32)
+    for row, result in enumerate(results):
+        found = result[:width]
+        if found:
+            ids[row, : len(found)], distances[row, : len(found)] = zip(*found)
+    return ids, distances
+
+
+# chromadb-style where operators, as SQL
+OPERATORS = {"$eq": "=", "$ne": "!=", "$gt": ">", "$gte": ">=", "$lt": "<", "$lte": "<=", "$in": "in", "$nin": "not in"}
+
+
+def where_clause(where: dict) -> Tuple[str, list]:
+    """SQL condition and parameters for a chromadb-style filter on images, e.g.
+    {"classification": "copepod", "date": {"$gte": "2023-05-01"}, "session": {"$in": ["1", "2"]}}
+    Conditions on several columns are ANDed"""
+    conditions, params = [], []
+    for column, condition in where.items():
+        if column not in FILTER_COLUMNS:
+            raise ValueError(f"Can't filter on {column}, only on {FILTER_COLUMNS}")
+        operators = condition if isinstance(condition, dict) else {"$eq": condition}
+        for operator, value in operators.items():
+            if operator not in OPERATORS:
+                raise ValueError(f"Unknown operator {operator}, expected one of {list(OPERATORS)}")
+            if operator in ("$in", "$nin"):
+                conditions.append(f"{column} {OPERATORS[operator]} ({','.join('?' * len(value))})")
+                params.extend(value)
+            else:
+                conditions.append(f"{column} {OPERATORS[operator]} ?")
+                params.append(value)
+    return " and ".join(conditions), params
+
+
+def cache_key(*args: object, where: Optional[dict] = None) -> tuple:
+    """Hashable key for a query's arguments, including a filter dict"""
+    return (*args, json.dumps(where, sort_keys=True) if where else None)
+
+
 class VectorStore(metaclass=ABCMeta):
     @abstractmethod
     def add(self, url: str, embeddings: List[float]) -> None:
@@ -53,16 +201,76 @@ class VectorStore(metaclass=ABCMeta):
     def ids(self) -> List[str]:
         pass
 
+    @abstractmethod
+    def embedding_matrix(self) -> Tuple[np.ndarray, np.ndarray]:
+        """All embeddings as one contiguous (N, D) float32 array, plus an array of ids in the same order"""
+        pass
 
-class ChromadbStore(VectorStore):
-    client = chromadb.PersistentClient(
+    def closest_by_vector(self, vector: np.ndarray, k: int = 25) -> Tuple[np.ndarray, np.ndarray]:
+        """The k closest ids to an embedding that needn't be in the store, by cosine distance.
+        Returns (ids, distances) arrays ordered by distance"""
+        ids, distances = self.closest_many(np.atleast_2d(np.asarray(vector, dtype=np.float32)), k)
+        return ids[0], distances[0]
+
+    def closest_many(self, queries: np.ndarray, k: int = 25, chunk_size: int = 1024) -> Tuple[np.ndarray, np.ndarray]:
+        """The k closest ids to each row of a (Q, D) query matrix, as (Q, k) arrays of ids and cosine distances.
+        By default this is exact search in memory over embedding_matrix(), see top_k"""
+        matrix, ids = self.embedding_matrix()
+        positions, distances = top_k(queries, matrix, k, chunk_size)
+        return ids[positions], distances
+
+    def fingerprint(self) -> tuple:
+        """Cheap summary of the store's contents (row count, last row id, and a write counter where the store keeps one)
+        that changes when they do. Used to decide whether derived copies like snapshots are stale"""
+        return len(self.ids()), None
+
+    def count(self) -> int:
+        return len(self.ids())
+
+    def sample(self, n: int) -> List[str]:
+        """Up to n ids picked at random"""
+        ids = self.ids()
+        return random.sample(ids, min(n, len(ids)))
+
+    def iter_ids(self, chunk_size: int = 10000) -> Iterator[np.ndarray]:
+        """Ids in chunks of up to chunk_size. Stores that can page through their rows override this;
+        by default it slices the full list"""
+        ids = np.asarray(self.ids(), dtype=object)
+        for offset in range(0, len(ids), chunk_size):
+            yield ids[offset : offset + chunk_size]  # noqa: E203
+
+    def iter_embeddings(self, chunk_size: int = 10000) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+        """(float32 matrix, ids) in chunks of up to chunk_size rows, in the same order as embedding_matrix()"""
+        matrix, ids = self.embedding_matrix()
+        for offset in range(0, len(ids), chunk_size):
+            yield matrix[offset : offset + chunk_size], ids[offset : offset + chunk_size]  # noqa: E203
+
+
+@functools.lru_cache(maxsize=None)
+def chroma_client() -> "chromadb.ClientAPI":
+    """One chromadb client per process, created on first use rather than at import,
+    as it opens (or creates) the STORE directory"""
+    import chromadb  # noqa: PLC0415
+    from chromadb.config import Settings  # noqa: PLC0415
+
+    return chromadb.PersistentClient(
         path=STORE,
         settings=Settings(
             anonymized_telemetry=False,
         ),
     )
 
+
+class ChromadbStore(VectorStore):
+    """chromadb is only imported when one of these is created"""
+
+    @property
+    def client(self) -> "chromadb.ClientAPI":
+        return chroma_client()
+
     def __init__(self, db_name: str):
+        from chromadb.errors import UniqueConstraintError  # noqa: PLC0415
+
         try:
             collection = self.client.create_collection(
                 name=db_name,
@@ -94,13 +302,27 @@ class ChromadbStore(VectorStore):
         results = self.store.query(query_embeddings=[embeddings], n_results=n_results)
         return results["ids"][0]  # by index because API assumes query always multiple inputs
 
+    def closest_many(self, queries: np.ndarray, k: int = 25, chunk_size: int = 1024) -> Tuple[np.ndarray, np.ndarray]:
+        """Chroma takes the whole batch of queries in one call"""
+        results = self.store.query(query_embeddings=np.atleast_2d(queries).tolist(), n_results=k, include=["distances"])
+        return stack_results(
+            [list(zip(ids, distances)) for ids, distances in zip(results["ids"], results["distances"])],
+            min(k, self.store.count()),
+        )
+
     def embeddings(self) -> List[List]:
+        return self.embedding_matrix()[0]
+
+    def embedding_matrix(self) -> Tuple[np.ndarray, np.ndarray]:
         result = self.store.get(include=["embeddings"])
-        return np.array(result["embeddings"])
+        return np.asarray(result["embeddings"], dtype=np.float32), np.asarray(result["ids"], dtype=object)
 
     def ids(self) -> List[str]:
         return self.store.get().get("ids", [])
 
+    def fingerprint(self) -> Tuple[int, Optional[int]]:
+        return self.store.count(), None
+
 
 class PostgresStore(VectorStore):
     def __init__(self, db_name: str):
@@ -123,22 +345,121 @@ class PostgresStore(VectorStore):
     def ids(self) -> List[str]:
         pass
 
+    def embedding_matrix(self) -> Tuple[np.ndarray, np.ndarray]:
+        pass
+
 
 class SQLiteVecStore(VectorStore):
-    def __init__(self, db_name: str, embedding_len: Optional[int] = 512, check_same_thread: bool = True):
+    """Embeddings in sqlite, indexed for KNN search by the sqlite-vec extension.
+    Writes go through one connection, serialised by a lock. Reads borrow a connection from a pool
+    of up to read_pool_size read-only ones, so concurrent app sessions don't queue on a single
+    connection - WAL journaling lets them read while a write is in progress.
+    Each embedding is stored once, in the images_vec index, as float32 or (precision="int8") quantised -
+    see PRECISIONS. An existing db keeps the precision it was created with.
+    Other models' embeddings of the same images can be kept alongside, each in its own vec0 table -
+    see register_model(). Methods taking model=... default to images_vec"""
+
+    def __init__(
+        self,
+        db_name: str,
+        embedding_len: Optional[int] = 512,
+        check_same_thread: bool = True,
+        read_pool_size: int = 4,
+        cache_size: int = 1024,
+        precision: str = "float32",
+    ):
+        if precision not in PRECISIONS:
+            raise ValueError(f"Unknown precision {precision}, expected one of {', '.join(PRECISIONS)}")
         self._check_same_thread = check_same_thread
+        self.db_name = db_name
         self.embedding_len = embedding_len
-        self.load_ext(db_name)
+        self.precision = precision
+        self.read_pool_size = read_pool_size
+        # ':memory:' (or '') is private to one connection, so can't be pooled
+        self._in_memory = db_name in (":memory:", "")
+        self._write_lock = threading.RLock()
+        self._readers = queue.LifoQueue()
+        self._reader_count = 0
+        self._pool_lock = threading.Lock()
+        # closest() results, invalidated when generation() moves on
+        self.cache = QueryCache(cache_size)
+        self.writes = 0
+        # vec0 tables whose shadow tables have been checked, see _chunked()
+        self._layouts = {}
+
+        self.db = self.connect()
         self.load_schema()
+        self._projection = self._load_projection()
+        self._models = self._load_models()
+        # Check now, so a sqlite-vec with another layout is reported when the store opens
+        self._chunked()
 
-    def load_ext(self, db_name: str) -> None:
-        """Load the sqlite extension into our db if needed"""
-        # db_name could be ':memory:' for testing, or a path
-        db = sqlite3.connect(db_name, check_same_thread=self._check_same_thread)
+    def connect(self, read_only: bool = False) -> sqlite3.Connection:
+        """Open a connection with the sqlite-vec extension loaded and our pragmas set"""
+        if read_only:
+            uri = f"{pathlib.Path(self.db_name).absolute().as_uri()}?mode=ro"
+            # Pooled connections are handed between threads, but only ever used by one at a time
+            db = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        else:
+            db = sqlite3.connect(self.db_name, check_same_thread=self._check_same_thread)
         db.enable_load_extension(True)
         sqlite_vec.load(db)
         db.enable_load_extension(False)
-        self.db = db
+
+        for pragma, value in SQLITE_PRAGMAS.items():
+            if pragma in READ_PRAGMAS or not read_only:
+                db.execute(f"pragma {pragma} = {value}")
+        return db
+
+    @contextmanager
+    def reader(self) -> Iterator[sqlite3.Connection]:
+        """Borrow a read-only connection from the pool, opening a new one if none is free and the pool
+        isn't full, otherwise waiting for one to be returned"""
+        if self._in_memory:
+            with self._write_lock:
+                yield self.db
+            return
+
+        try:
+            db = self._readers.get_nowait()
+        except queue.Empty:
+            with self._pool_lock:
+                can_open = self._reader_count < self.read_pool_size
+                if can_open:
+                    self._reader_count += 1
+            db = self.connect(read_only=True) if can_open else self._readers.get()
+        try:
+            yield db
+        finally:
+            self._readers.put(db)
+
+    def generation(self) -> int:
+        """Changes whenever the contents change: a count of writes kept in collection_meta, which every
+        write transaction bumps, so it also moves on for other processes' writes (e.g. the embedding pipeline)"""
+        with self.reader() as db:
+            row = db.execute("select value from collection_meta where key = 'writes'").fetchone()
+        return 0 if row is None else int(row[0])
+
+    def _begin(self) -> None:
+        """Take sqlite's write lock now if the caller's `with self.db` transaction hasn't started yet.
+        Python's sqlite3 only begins one at the first insert, and a deferred one at that, so anything read
+        before it (urls already stored, the next row id) could be changed by another process's writer meanwhile"""
+        if not self.db.in_transaction:
+            self.db.execute("begin immediate")
+
+    def _record_write(self) -> None:
+        """Move generation() on - the caller holds the write lock and transaction, so it's part of the same commit.
+        writes counts this process's own writes"""
+        self.db.execute(
+            "insert into collection_meta values ('writes', 1) on conflict(key) do update set value = value + 1"
+        )
+        self.writes += 1
+
+    def close(self) -> None:
+        """Close the writer and any pooled readers"""
+        while not self._readers.empty():
+            self._readers.get_nowait().close()
+        self.db.close()
 
     def load_schema(self) -> None:
         """Load our db schema if needed;
@@ -146,97 +467,1507 @@ class SQLiteVecStore(VectorStore):
         Consider SQLAlchemy for this, or a CLI-based way of loading from a file;
         a list of CREATE TABLE statements feels like a kludge.
         """
+        version = self.schema_version()
+        if version > SCHEMA_VERSION:
+            raise ValueError(f"{self.db_name} has schema version {version}, newer than this code's {SCHEMA_VERSION}")
+        if self._table_sql("images") is None:
+            self.db.execute(f"pragma user_version = {SCHEMA_VERSION}")
+
         for statement in SQLITE_SCHEMA:
-            query = statement.format(self.embedding_len)
+            query = statement.format(self.embedding_len, PRECISIONS[self.precision])
 
             try:
                 self.db.execute(query)
             except sqlite3.OperationalError as err:
-                if "already exists" in str(err):
+                # Older dbs can lack columns we index, which migrate() adds
+                if "already exists" in str(err) or "no such column" in str(err):
                     pass
                 else:
                     raise
+            except sqlite3.IntegrityError as err:
+                # or hold duplicate urls, which migrate() cleans up
+                logging.warning(err)
 
-    def add(self, url: str, embeddings: List[float], classification: Optional[str] = "") -> None:
-        """Add image embeddings to storage. Two tables:
-        * one regular one which holds metadata, with embeddings as floats
-        * one "virtual table" for indexing it by ID with encoded embeddings"""
-        cursor = self.db.cursor()
-        cursor.execute(
-            "INSERT INTO images(url, embedding, classification) VALUES (?, ?, ?)",
-            [url, serialize_f32(embeddings), classification],
+        # Trust the existing index over the precision we were opened with
+        self.precision = self._vector_spec()[0]
+        if self.needs_migration():
+            logging.warning(
+                f"Database predates the current schema ({', '.join(self.pending_migrations())}), "
+                "see scripts/migrate_vector_stores.py"
+            )
+
+    def add(
+        self, url: str, embeddings: List[float], classification: Optional[str] = "", model: Optional[str] = None
+    ) -> None:
+        """Add image embeddings to storage - single row version of add_many"""
+        self.add_many([url], np.asarray([embeddings], dtype=np.float32), [classification], model=model)
+
+    def add_many(
+        self,
+        urls: List[str],
+        embeddings: np.ndarray,
+        classifications: Optional[List[str]] = None,
+        chunk_size: int = 10000,
+        model: Optional[str] = None,
+    ) -> int:
+        """Bulk add image embeddings to storage. Two tables:
+        * one regular one which holds metadata
+        * one "virtual table" which holds the embeddings and indexes them by ID
+
+        Accepts a (N, embedding_len) matrix, writes both tables with executemany
+        in one transaction per chunk rather than committing every row.
+        Urls already stored (with another model's embeddings) keep their row in images,
+        but one that already has an embedding for this model is an IntegrityError.
+        Returns the number of rows written.
+        """
+        embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+        if embeddings.ndim != 2 or embeddings.shape[0] != len(urls):
+            raise ValueError(f"Expected a matrix with {len(urls)} rows, got shape {embeddings.shape}")
+        if classifications is None:
+            classifications = [""] * len(urls)
+
+        start = time.perf_counter()
+        for offset in range(0, len(urls), chunk_size):
+            end = offset + chunk_size
+            chunk = embeddings[offset:end]
+            # `with` wraps the chunk in a transaction, rolled back if any insert fails
+            with self._write_lock, self.db:
+                self._begin()
+                stored = self._stored(urls[offset:end], model)
+                present = [url for url in urls[offset:end] if url in stored and stored[url][2]]
+                if present:
+                    raise sqlite3.IntegrityError(
+                        f"UNIQUE constraint failed: {present[0]} already has a {model or DEFAULT_MODEL} embedding"
+                    )
+                new = [i for i, url in enumerate(urls[offset:end]) if url not in stored]
+                self._insert(
+                    [urls[offset + i] for i in new],
+                    chunk[new],
+                    [classifications[offset + i] for i in new],
+                    [None] * len(new),
+                    model,
+                )
+                existing = [i for i, url in enumerate(urls[offset:end]) if url in stored]
+                existing_ids = [stored[urls[offset + i]][0] for i in existing]
+                self._insert_vectors(existing_ids, chunk[existing], model=model)
+                if self._projection is not None and self._space(model)[0] == "images_vec":
+                    # images_vec_reduced has no row for an image that had no default embedding
+                    self._insert_reduced(existing_ids, chunk[existing], replace=True)
+                self._record_write()
+
+        elapsed = time.perf_counter() - start
+        # Not worth a line per image when they're added one at a time
+        log = logging.debug if len(urls) == 1 else logging.info
+        log(f"Added {len(urls)} rows in {elapsed:.2f}s ({len(urls) / max(elapsed, 1e-9):.0f} rows/sec)")
+        return len(urls)
+
+    def upsert_many(
+        self,
+        urls: List[str],
+        embeddings: np.ndarray,
+        content_hashes: List[str],
+        classifications: Optional[List[str]] = None,
+        chunk_size: int = 10000,
+        model: Optional[str] = None,
+    ) -> Dict[str, List[str]]:
+        """Add or update image embeddings, keyed on url.
+        content_hashes identify what each embedding was computed from (an ETag, or a digest of the image bytes).
+        Rows whose stored hash matches are left alone, so reruns only write what changed.
+        Classifications are only overwritten for existing rows if given.
+        A changed image's embeddings from other models are dropped, as they describe the old one -
+        so write every model's embeddings for a batch of images (each upsert then reports them as new)
+
+        Returns the urls which were "new" (to this model), "changed" and "unchanged"
+        """
+        embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+        if embeddings.ndim != 2 or embeddings.shape[0] != len(urls) or len(content_hashes) != len(urls):
+            raise ValueError(f"Expected {len(urls)} rows and hashes, got shape {embeddings.shape}")
+
+        report = {"new": [], "changed": [], "unchanged": []}
+        for offset in range(0, len(urls), chunk_size):
+            end = offset + chunk_size
+            # A url repeated within the batch takes its last value
+            rows = {
+                url: (i, content_hash)
+                for i, (url, content_hash) in enumerate(zip(urls[offset:end], content_hashes[offset:end]), offset)
+            }
+            with self._write_lock, self.db:
+                self._begin()
+                stored = self._stored(list(rows), model)
+                new, missing, changed = [], [], []
+                for url, (i, content_hash) in rows.items():
+                    if url not in stored:
+                        new.append(url)
+                    elif stored[url][1] != content_hash:
+                        changed.append(url)
+                    elif not stored[url][2]:
+                        # the image is stored, but not this model's embedding of it
+                        missing.append(url)
+                    else:
+                        report["unchanged"].append(url)
+
+                self._insert(
+                    new,
+                    embeddings[[rows[url][0] for url in new]],
+                    [classifications[rows[url][0]] if classifications else "" for url in new],
+                    [rows[url][1] for url in new],
+                    model,
+                )
+                missing_ids = [stored[url][0] for url in missing]
+                missing_embeddings = embeddings[[rows[url][0] for url in missing]]
+                self._insert_vectors(missing_ids, missing_embeddings, model=model)
+                changed_ids = [stored[url][0] for url in changed]
+                changed_embeddings = embeddings[[rows[url][0] for url in changed]]
+                self.db.executemany(
+                    "update images set content_hash = ?, classification = coalesce(?, classification) where id = ?",
+                    [
+                        (rows[url][1], classifications[rows[url][0]] if classifications else None, row_id)
+                        for url, row_id in zip(changed, changed_ids)
+                    ],
+                )
+                self._insert_vectors(changed_ids, changed_embeddings, replace=True, model=model)
+                for other in self.models():
+                    if self._space(other) != self._space(model):
+                        table = self._space(other)[0]
+                        self.db.executemany(f"delete from {table} where id = ?", [(row_id,) for row_id in changed_ids])
+                if self._projection is not None:
+                    if self._space(model)[0] == "images_vec":
+                        self._insert_reduced(changed_ids, changed_embeddings, replace=True)
+                        # and for images that had no default embedding, so no projection either
+                        self._insert_reduced(missing_ids, missing_embeddings, replace=True)
+                    else:
+                        self.db.executemany(
+                            "delete from images_vec_reduced where id = ?", [(row_id,) for row_id in changed_ids]
+                        )
+                # Neighbour lists involving a changed embedding are stale; update_knn() recomputes the gaps
+                self.db.executemany(
+                    "delete from images_knn where id = ?1 or neighbour_id = ?1", [(row_id,) for row_id in changed_ids]
+                )
+                if new or missing or changed:
+                    self._record_write()
+            report["new"].extend(new + missing)
+            report["changed"].extend(changed)
+
+        logging.info(", ".join(f"{len(v)} {k}" for k, v in report.items()))
+        return report
+
+    def _insert(
+        self,
+        urls: List[str],
+        embeddings: np.ndarray,
+        classifications: List[str],
+        content_hashes: List[str],
+        model: Optional[str] = None,
+    ) -> None:
+        """Insert new rows into images and model's vec0 table - the caller holds the write lock and transaction"""
+        # Assign ids ourselves so images and images_vec stay linked without lastrowid.
+        # Inside begin immediate, so another process can't take the same ids between reading max(id) and inserting
+        self._begin()
+        first_id = self.db.execute("select coalesce(max(id), 0) + 1 from images").fetchone()[0]
+        row_ids = list(range(first_id, first_id + len(embeddings)))
+        # Filterable columns parsed from the filename, see FILTER_COLUMNS
+        metadata = [filename_metadata(url).values() for url in urls]
+        self.db.executemany(
+            "INSERT INTO images(id, url, classification, content_hash, lat, lon, date, session) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (row + tuple(meta) for row, meta in zip(zip(row_ids, urls, classifications, content_hashes), metadata)),
         )
+        self._insert_vectors(row_ids, embeddings, model=model)
+        if self._projection is not None and self._space(model)[0] == "images_vec":
+            self._insert_reduced(row_ids, embeddings)
 
-        row_id = cursor.lastrowid
-        cursor.execute(
-            "INSERT INTO images_vec(id, embedding) VALUES (?, ?)",
-            [row_id, serialize_f32(embeddings)],
+    def _insert_vectors(
+        self, row_ids: List[int], embeddings: np.ndarray, replace: bool = False, model: Optional[str] = None
+    ) -> None:
+        """Write embeddings to model's vec0 table at its precision - the caller holds the write lock and transaction.
+        Replacing is a delete and insert, as vec0 won't update an int8 column"""
+        if not row_ids:
+            return
+        table, precision = self._space(model)
+        if replace:
+            self.db.executemany(f"delete from {table} where id = ?", [(row_id,) for row_id in row_ids])
+        self.db.executemany(
+            f"insert into {table}(id, embedding) values (?, {self._vector_param(precision)})",
+            zip(row_ids, self._encode(embeddings, precision)),
         )
+        if table == "images_vec":
+            # These rows may belong in other rows' neighbour lists, so images_knn is out of date until update_knn()
+            self.db.execute(
+                "insert into collection_meta values ('knn_stale', 1) on conflict(key) do update set value = value + 1"
+            )
 
-        self.db.commit()
+    def _stored(self, urls: List[str], model: Optional[str] = None) -> Dict[str, Tuple[int, Optional[str], bool]]:
+        """Row id, content hash and whether there's an embedding from model, for those of urls already stored.
+        The caller holds the write lock"""
+        # One json array parameter rather than a placeholder per url, which could hit SQLITE_MAX_VARIABLE_NUMBER
+        query = f"""
+            select images.url, images.id, images.content_hash, {self._location_columns(model)}
+            {self._locations(model, join="left join")}
+            where images.url in (select value from json_each(?))"""
+        return {
+            url: (row_id, content_hash, location is not None)
+            for url, row_id, content_hash, location, _ in self.db.execute(query, [json.dumps(list(urls))])
+        }
 
-    def get(self, url: str) -> List[float]:
-        result = self.db.execute("select embedding from images where url = ?", [url]).fetchone()
-        if len(result):
-            return result[0]
-        else:
+    def _insert_reduced(self, row_ids: List[int], matrix: np.ndarray, replace: bool = False) -> None:
+        """Project embeddings and write them to images_vec_reduced - the caller holds the write lock and transaction"""
+        if not row_ids:
+            return
+        if replace:
+            self.db.executemany("delete from images_vec_reduced where id = ?", [(row_id,) for row_id in row_ids])
+        self.db.executemany(
+            "insert into images_vec_reduced(id, embedding) values (?, ?)",
+            zip(row_ids, (row.tobytes() for row in self._projection.transform(matrix))),
+        )
+
+    def _encode(self, embeddings: np.ndarray, precision: Optional[str] = None) -> List[bytes]:
+        """Rows as images_vec blobs. int8 scales each row so its largest magnitude is 127"""
+        embeddings = np.atleast_2d(np.asarray(embeddings, dtype=np.float32))
+        if (precision or self.precision) == "int8":
+            scale = np.abs(embeddings).max(axis=1, keepdims=True)
+            embeddings = np.rint(embeddings * 127 / np.where(scale == 0, 1, scale)).astype(np.int8)
+        return [row.tobytes() for row in embeddings]
+
+    def _decode(self, vectors: Union[List[bytes], np.ndarray], precision: Optional[str] = None) -> np.ndarray:
+        """images_vec blobs (or a matrix of their elements) back to float32 rows.
+        int8 rows come back with their largest magnitude scaled to 1"""
+        precision = precision or self.precision
+        if not isinstance(vectors, np.ndarray):
+            element = np.int8 if precision == "int8" else np.float32
+            vectors = np.frombuffer(b"".join(vectors), dtype=element).reshape(len(vectors), -1)
+        if precision == "int8":
+            return vectors.astype(np.float32) / 127
+        return vectors
+
+    def _locations(self, model: Optional[str] = None, join: str = "join") -> str:
+        """FROM clause joining images to where each row's embedding is kept in model's vec0 table, see _gather()"""
+        table = self._space(model)[0]
+        if self._chunked(model):
+            return f"from images {join} {table}_rowids as vec on vec.rowid = images.id"
+        return f"from images {join} {table} as vec on vec.id = images.id"
+
+    def _location_columns(self, model: Optional[str] = None) -> str:
+        """The two columns of _locations() that _gather() takes for each row: its (chunk_id, chunk_offset),
+        or its id when embeddings are read through vec0 itself"""
+        return "vec.chunk_id, vec.chunk_offset" if self._chunked(model) else "vec.id, null"
+
+    def _chunked(self, model: Optional[str] = None) -> bool:
+        """Whether model's embeddings can be read a chunk at a time from sqlite-vec 0.1's shadow tables (see _gather()).
+        The shadow tables aren't part of sqlite-vec's API, so before relying on them we check they have the
+        columns we read, and that a stored vector read from them matches the one vec0 returns.
+        If not - another sqlite-vec, say - embeddings are read through vec0, which is slower but always right.
+        Decided once per table, when it first has rows to compare"""
+        table, precision = self._space(model)
+        if table not in self._layouts:
+            with self._write_lock:
+                chunked = self._check_layout(table, precision)
+            if chunked is None:
+                return True
+            if not chunked:
+                logging.warning(
+                    f"{table} in {self.db_name} isn't laid out as sqlite-vec 0.1 does, "
+                    "so embeddings will be read through vec0 one row at a time"
+                )
+            self._layouts[table] = chunked
+        return self._layouts[table]
+
+    def _check_layout(self, table: str, precision: str) -> Optional[bool]:
+        """See _chunked(). None if the shadow tables look right but there's no vector yet to compare"""
+
+        def columns(name: str) -> set:
+            return {row[1] for row in self.db.execute(f"pragma table_info({name})")}
+
+        if not {"chunk_id", "chunk_offset"} <= columns(f"{table}_rowids"):
+            return False
+        if "vectors" not in columns(f"{table}_vector_chunks00"):
+            return False
+        try:
+            row = self.db.execute(
+                f"""select vec.chunk_id, vec.chunk_offset, stored.embedding, chunks.vectors
+                from {table}_rowids as vec
+                join {table}_vector_chunks00 as chunks on chunks.rowid = vec.chunk_id
+                join {table} as stored on stored.id = vec.rowid
+                limit 1"""
+            ).fetchone()
+        except sqlite3.OperationalError:
+            return False
+        if row is None:
             return None
+        _, offset, embedding, vectors = row
+        size = len(embedding)
+        return vectors[offset * size : (offset + 1) * size] == embedding  # noqa: E203
 
-    def closest(self, url: str, n_results: int = 25) -> List:
-        """Find and return the N closest examples by distance
-        Accepts an image URL, returns a list ordered by distance
-        """
-        # See https://til.simonwillison.net/sqlite/sqlite-vec
-        # https://github.com/asg017/sqlite-vec/issues/41 - "limit ?" not guaranteed
-        # Note - stopped returning distance for consistency, but might be useful
+    def _vector_param(self, precision: Optional[str] = None) -> str:
+        """Placeholder for an encoded vector - vec0 takes a blob as float32 unless it's marked otherwise"""
+        return "vec_int8(?)" if (precision or self.precision) == "int8" else "?"
+
+    def _vector_spec(self, table: str = "images_vec") -> Tuple[str, int]:
+        """Precision and embedding length of an existing vec0 table"""
+        element, length = re.search(r"(\w+)\[(\d+)\]", self._table_sql(table)).groups()
+        return {v: k for k, v in PRECISIONS.items()}[element], int(length)
 
+    def _space(self, model: Optional[str] = None) -> Tuple[str, str]:
+        """vec0 table and precision for a model's embeddings - images_vec for the default"""
+        if model is None or model == DEFAULT_MODEL:
+            return "images_vec", self.precision
+        if model not in self._models:
+            # Perhaps registered since, by another process
+            self._models = self._load_models()
         try:
-            doc_id = self.db.execute("select id from images where url = ?", [url]).fetchone()[0]
-        except IndexError:
+            return self._models[model]
+        except KeyError:
+            raise ValueError(f"No {model} embeddings in {self.db_name}, see register_model()") from None
+
+    def _load_models(self) -> Dict[str, Tuple[str, str]]:
+        with self._write_lock:
+            rows = self.db.execute("select name, precision from models").fetchall()
+        return {name: (f"images_vec_{name}", precision) for name, precision in rows}
+
+    def register_model(self, name: str, embedding_len: int, precision: str = "float32") -> None:
+        """Add a named embedding space, for another model's embeddings of the same images, in its own vec0 table.
+        Does nothing if it's already registered with this embedding length"""
+        if not re.fullmatch(r"\w+", name) or name == DEFAULT_MODEL:
+            raise ValueError(f"Model names are letters, digits and underscores, other than {DEFAULT_MODEL}: {name}")
+        if precision not in PRECISIONS:
+            raise ValueError(f"Unknown precision {precision}, expected one of {', '.join(PRECISIONS)}")
+        registered = self.models().get(name)
+        if registered == embedding_len:
+            return
+        if registered is not None:
+            raise ValueError(f"Model {name} is already registered with embedding length {registered}")
+        with self._write_lock, self.db:
+            self.db.execute(MODEL_SCHEMA.format(name, PRECISIONS[precision], embedding_len))
+            self.db.execute("insert into models values (?, ?, ?)", [name, embedding_len, precision])
+            self._record_write()
+        self._models = self._load_models()
+
+    def models(self) -> Dict[str, int]:
+        """Embedding length of each model's space, the default one first"""
+        with self.reader() as db:
+            registered = dict(db.execute("select name, embedding_len from models order by name"))
+        return {DEFAULT_MODEL: self.dimensions(), **registered}
+
+    def _gather(
+        self, db: sqlite3.Connection, locations: List[Tuple[int, int]], model: Optional[str] = None
+    ) -> np.ndarray:
+        """Embeddings for many rows as a float32 matrix, from their (chunk_id, chunk_offset) in images_vec_rowids.
+        Selecting the embedding column of images_vec looks each row up in turn, which is ~10x slower than
+        reading a blob column, so bulk reads go to the shadow table instead: images_vec_vector_chunks00
+        holds each chunk's vectors as one blob, read here once per chunk.
+        That layout is sqlite-vec 0.1's, which pyproject.toml pins, and is checked before it's relied on -
+        see _chunked(). Otherwise locations are (id, None) and the embedding column is read after all"""
+        table, precision = self._space(model)
+        element = np.int8 if precision == "int8" else np.float32
+        dim = self.dimensions(model)
+        matrix = np.empty((len(locations), dim), dtype=element)
+        if not locations:
+            return self._decode(matrix, precision)
+        if not self._chunked(model):
+            row_ids = [row_id for row_id, _ in locations]
+            found = dict(
+                db.execute(
+                    f"select id, embedding from {table} where id in (select value from json_each(?))",
+                    [json.dumps(row_ids)],
+                )
+            )
+            return self._decode([found[row_id] for row_id in row_ids], precision)
+        chunk_ids, offsets = (np.array(column, dtype=np.int64) for column in zip(*locations))
+
+        # Group rows by chunk
+        order = np.argsort(chunk_ids, kind="stable")
+        wanted, starts = np.unique(chunk_ids[order], return_index=True)
+        groups = dict(zip(wanted.tolist(), np.split(order, starts[1:])))
+        for chunk_id, blob in db.execute(
+            f"select rowid, vectors from {table}_vector_chunks00 where rowid in (select value from json_each(?))",
+            [json.dumps(wanted.tolist())],
+        ):
+            rows = groups[chunk_id]
+            matrix[rows] = np.frombuffer(blob, dtype=element).reshape(-1, dim)[offsets[rows]]
+        return self._decode(matrix, precision)
+
+    def content_hashes(self, model: Optional[str] = None) -> Dict[str, Optional[str]]:
+        """Stored content hash for every url with an embedding from model,
+        for deciding what needs (re-)embedding before doing the work"""
+        with self.reader() as db:
+            return dict(db.execute(f"select images.url, images.content_hash {self._locations(model)}"))
+
+    def get(self, url: str, model: Optional[str] = None) -> List[float]:
+        """The embedding as float32 bytes, or None if url isn't stored"""
+        table, precision = self._space(model)
+        query = f"select vec.embedding from images join {table} as vec on vec.id = images.id where images.url = ?"
+        with self.reader() as db:
+            result = db.execute(query, [url]).fetchone()
+        return None if result is None else self._decode([result[0]], precision)[0].tobytes()
+
+    def get_many(self, urls: List[str], model: Optional[str] = None) -> np.ndarray:
+        """Embeddings for several urls as a (N, D) float32 matrix, in the order given.
+        Raises ValueError naming any urls that have no embedding from model"""
+        table, precision = self._space(model)
+        query = f"""
+            select images.url, vec.embedding
+            from images join {table} as vec on vec.id = images.id
+            where images.url in (select value from json_each(?))"""
+        with self.reader() as db:
+            rows = dict(db.execute(query, [json.dumps(list(urls))]))
+        missing = [url for url in urls if url not in rows]
+        if missing:
+            raise ValueError(f"No {model or DEFAULT_MODEL} embeddings in {self.db_name} for {missing}")
+        if not urls:
+            return np.empty((0, self.dimensions(model)), dtype=np.float32)
+        return self._decode([rows[url] for url in urls], precision)
+
+    def closest(self, url: str, n_results: int = 25, where: Optional[dict] = None, model: Optional[str] = None) -> List:
+        """Find and return the N closest examples by cosine distance
+        Accepts an image URL, returns a list of (url, distance) ordered by distance.
+        where optionally restricts the results, see where_clause, e.g. {"classification": "copepod"}
+        model picks the embedding space to compare in, see register_model()
+        Results are cached until the store is written to
+        """
+        return self.cache.get_or_compute(
+            cache_key(url, n_results, model, where=where),
+            self.generation(),
+            lambda: self._closest(url, n_results, where, model),
+        )
+
+    def _closest(self, url: str, n_results: int, where: Optional[dict] = None, model: Optional[str] = None) -> List:
+        # The precomputed neighbours are from the default model's embeddings
+        if not where and self._space(model)[0] == "images_vec":
+            neighbours = self._graph_neighbours(url, n_results)
+            if len(neighbours) == n_results:
+                return neighbours
+        embedding = self.get(url, model)
+        if embedding is None:
             return None
+        return self._knn(embedding, n_results, where, model)
 
+    def _graph_neighbours(self, url: str, n_results: int) -> List:
+        """The first n_results of url's precomputed neighbours in images_knn, in the same form as _knn().
+        Fewer than that if there's no graph, it isn't as deep as n_results, url's list is out of date,
+        or embeddings have been written since the graph was last brought up to date"""
         query = """
-            with image_embedding as (
-                select embedding as first_embedding from images_vec where id = ?
+            select neighbour.url, knn.distance
+            from images
+            join images_knn as knn on knn.id = images.id
+            join images as neighbour on neighbour.id = knn.neighbour_id
+            where images.url = ? and knn.rank < ?
+            and not exists (select 1 from collection_meta where key = 'knn_stale')
+            order by knn.rank"""
+        with self.reader() as db:
+            return db.execute(query, [url, n_results]).fetchall()
+
+    def build_knn(
+        self, depth: int = 65, chunk_size: Optional[int] = None, workers: int = 4, memory: int = 1024**3
+    ) -> int:
+        """Compute the depth nearest neighbours of every image (itself included, as with closest()) into images_knn,
+        so closest() can answer from the table when n_results <= depth.
+        Exact search over the whole collection in memory, a chunk of rows per matrix product, spread across
+        threads - NumPy releases the GIL for the BLAS work. See update_knn() for chunk_size, workers and memory.
+        Returns the number of rows whose lists were written"""
+        with self._write_lock, self.db:
+            self.db.execute("delete from images_knn")
+            self.db.execute("insert or replace into collection_meta values ('knn_depth', ?)", [depth])
+            self._record_write()
+        return self.update_knn(chunk_size, workers, memory)
+
+    def update_knn(self, chunk_size: Optional[int] = None, workers: int = 4, memory: int = 1024**3) -> int:
+        """Bring images_knn up to date after rows are added or changed, without recomputing the rest:
+        * rows with no list, or a short one, get their neighbours computed in full
+        * those rows are merged into the other lists they now belong in
+        Each of the workers threads holds one chunk of rows' similarities to the whole collection at a time,
+        and what's derived from them - float32 similarities, argpartition's int64 positions and a bool mask,
+        13 bytes a pair, 16 allowing for the rest. Chunks are sized so all of it fits in memory bytes,
+        unless chunk_size is given.
+        Returns the number of rows whose lists were written"""
+        depth = self.knn_depth()
+        if depth is None:
+            raise ValueError("No neighbour graph for this collection, build_knn() first")
+        with self.reader() as db:
+            # Read before the embeddings, so a write that lands after it leaves the graph marked stale
+            stale_marker = db.execute("select value from collection_meta where key = 'knn_stale'").fetchone()
+            rows = db.execute(f"select images.id, {self._location_columns()} {self._locations()} order by images.id")
+            row_ids, matrix = self._values_and_matrix(db, rows.fetchall())
+            # Row ids to (list length, furthest neighbour's distance)
+            lists = {
+                row_id: (length, furthest)
+                for row_id, length, furthest in db.execute(
+                    "select id, count(*), max(distance) from images_knn group by id"
+                )
+            }
+        if not len(row_ids):
+            self._clear_knn_stale(stale_marker)
+            return 0
+        row_ids = np.array(row_ids)
+        matrix = normalise(matrix)
+        expected = min(depth, len(row_ids))
+        stale = np.array([lists.get(row_id, (0, 0))[0] < expected for row_id in row_ids])
+        # For lists that are complete, a stale row only gets in if it's more similar than the furthest one.
+        # Stale rows' own lists are recomputed in full, so nothing gets into them this way
+        entry = np.array([1.0 - lists[row_id][1] if not s else np.inf for row_id, s in zip(row_ids, stale)])
+
+        if chunk_size is None:
+            chunk_size = max(1, memory // (workers * 16 * len(row_ids)))
+        positions = np.flatnonzero(stale)
+        chunks = [positions[offset : offset + chunk_size] for offset in range(0, len(positions), chunk_size)]  # noqa: E203
+
+        def neighbours(chunk: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray, Tuple[np.ndarray, ...]]:
+            """Full lists for a chunk of stale rows, plus the entries they displace in existing lists,
+            as (list position, newcomer position, distance) arrays"""
+            similarity = matrix[chunk] @ matrix.T
+            top = np.argpartition(similarity, -expected, axis=1)[:, -expected:]
+            top_similarity = np.take_along_axis(similarity, top, axis=1)
+            order = np.argsort(-top_similarity, axis=1)
+            rows, displaced = np.nonzero(similarity > entry)
+            return (
+                chunk,
+                np.take_along_axis(top, order, axis=1),
+                1.0 - np.take_along_axis(top_similarity, order, axis=1),
+                (displaced, chunk[rows], 1.0 - similarity[rows, displaced]),
             )
-            select
-            images.url,
-            vec_distance_cosine(images_vec.embedding, first_embedding) as distance
-            from
-            images_vec, image_embedding, images
-            where images_vec.id = images.id
-            order by distance limit ?"""
 
-        results = self.db.execute(query, [doc_id, n_results]).fetchall()
-        return results  # [i for j in results for i in j]
+        found = []
+        with ThreadPoolExecutor(workers) as pool:
+            for chunk, top, distances, displaced in pool.map(neighbours, chunks):
+                self._write_knn(
+                    [
+                        (int(row_ids[p]), int(row_ids[n]), rank, float(d))
+                        for p, ns, ds in zip(chunk, top, distances)
+                        for rank, (n, d) in enumerate(zip(ns, ds))
+                    ],
+                    row_ids[chunk].tolist(),
+                )
+                found.append(displaced)
+
+        merged_ids = []
+        if found:
+            # Merge newcomers into the existing lists they're close enough for, keeping the depth closest
+            targets, newcomers, distances = (np.concatenate(column) for column in zip(*found))
+            order = np.argsort(targets, kind="stable")
+            merged, starts = np.unique(targets[order], return_index=True)
+            merged_ids = row_ids[merged].tolist()
+            with self.reader() as db:
+                current = db.execute(
+                    "select id, neighbour_id, distance from images_knn where id in (select value from json_each(?))",
+                    [json.dumps(merged_ids)],
+                ).fetchall()
+            # Row id to {neighbour id: distance} - a recomputed row can already be in the list it's merged into
+            existing = {}
+            for row_id, neighbour_id, distance in current:
+                existing.setdefault(row_id, {})[neighbour_id] = distance
+            knn_rows = []
+            for row_id, group in zip(merged_ids, np.split(order, starts[1:])):
+                entries = existing.get(row_id, {})
+                entries.update(zip(row_ids[newcomers[group]].tolist(), distances[group].tolist()))
+                closest = sorted(entries.items(), key=lambda item: item[1])[:depth]
+                knn_rows.extend((row_id, neighbour_id, rank, d) for rank, (neighbour_id, d) in enumerate(closest))
+            self._write_knn(knn_rows, merged_ids)
+
+        self._clear_knn_stale(stale_marker)
+        logging.info(f"Neighbour lists computed for {len(positions)} rows, merged into {len(merged_ids)} more")
+        return len(positions) + len(merged_ids)
+
+    def _clear_knn_stale(self, marker: Optional[tuple]) -> None:
+        """Mark images_knn up to date, unless embeddings were written again since marker was read"""
+        if marker is None:
+            return
+        with self._write_lock, self.db:
+            self.db.execute("delete from collection_meta where key = 'knn_stale' and value = ?", marker)
+            self._record_write()
+
+    def fit_projection(self, dim: int = 64, method: str = "pca", chunk_size: int = 10000) -> Projection:
+        """Fit a linear projection to dim dimensions (see cyto_ml.data.projection) and index every embedding's
+        projection in images_vec_reduced, for coarse search with closest_reduced() and for clustering.
+        The projection is kept in collection_meta, and rows added later are projected as they're inserted"""
+        if method == "pca":
+            projection = Projection.fit_pca((matrix for matrix, _ in self.iter_embeddings(chunk_size)), dim)
+        elif method == "random":
+            projection = Projection.random(self.dimensions(), dim)
+        else:
+            raise ValueError(f"Unknown projection method {method}, expected pca or random")
+
+        with self._write_lock, self.db:
+            self.db.execute("drop table if exists images_vec_reduced")
+            self.db.execute(REDUCED_SCHEMA.format(dim))
+            self.db.execute("insert or replace into collection_meta values ('projection', ?)", [projection.to_bytes()])
+            self._projection = projection
+            for matrix, row_ids in self._embedding_pages("images.id", chunk_size):
+                self._insert_reduced(row_ids, matrix)
+            self._record_write()
+        return projection
+
+    def projection(self) -> Optional[Projection]:
+        """The collection's fitted projection, or None if fit_projection() hasn't been run"""
+        return self._projection
+
+    def _load_projection(self) -> Optional[Projection]:
+        with self._write_lock:
+            row = self.db.execute("select value from collection_meta where key = 'projection'").fetchone()
+        return None if row is None else Projection.from_bytes(row[0])
+
+    def closest_reduced(self, url: str, n_results: int = 25, candidates: Optional[int] = None) -> List:
+        """Coarse KNN search over the projected embeddings for candidates (default 4 * n_results) rows,
+        then exact cosine re-ranking of those with the full embeddings.
+        Returns a list of (url, distance) ordered by distance, like closest()"""
+        if self._projection is None:
+            raise ValueError("No projection for this collection, fit_projection() first")
+        embedding = self.get(url)
+        if embedding is None:
+            return None
+        query = np.frombuffer(embedding, dtype=np.float32)
+
+        coarse = """
+            select images.url, vec.embedding
+            from (
+                select id, distance from images_vec_reduced
+                where embedding match ? and k = ?
+            ) as knn
+            join images on images.id = knn.id
+            join images_vec as vec on vec.id = knn.id"""
+        with self.reader() as db:
+            rows = db.execute(
+                coarse, [self._projection.transform(query).tobytes(), candidates or 4 * n_results]
+            ).fetchall()
+        if not rows:
+            return []
+        urls, blobs = zip(*rows)
+        distances = 1.0 - normalise(self._decode(list(blobs))) @ normalise(query)
+        order = np.argsort(distances)[:n_results]
+        return [(urls[i], float(distances[i])) for i in order]
+
+    def reduced_matrix(self) -> Tuple[np.ndarray, np.ndarray]:
+        """Every projected embedding as one (N, dim) float32 matrix plus urls, in the same order as embedding_matrix().
+        Much smaller than the full matrix, e.g. for clustering"""
+        if self._projection is None:
+            raise ValueError("No projection for this collection, fit_projection() first")
+        with self.reader() as db:
+            rows = db.execute(
+                "select images.url, reduced.embedding from images_vec_reduced as reduced "
+                "join images on images.id = reduced.id order by images.id"
+            ).fetchall()
+        if not rows:
+            return np.empty((0, self._projection.dim), dtype=np.float32), np.empty(0, dtype=object)
+        urls, blobs = zip(*rows)
+        matrix = np.frombuffer(b"".join(blobs), dtype=np.float32).reshape(len(blobs), -1)
+        return matrix, np.asarray(urls, dtype=object)
+
+    def knn_depth(self) -> Optional[int]:
+        """How many neighbours images_knn holds per row, or None if build_knn() hasn't been run"""
+        with self.reader() as db:
+            depth = db.execute("select value from collection_meta where key = 'knn_depth'").fetchone()
+        return None if depth is None else int(depth[0])
+
+    def _write_knn(self, knn_rows: List[tuple], row_ids: List[int]) -> None:
+        """Replace the neighbour lists for row_ids with (id, neighbour_id, rank, distance) rows"""
+        with self._write_lock, self.db:
+            self.db.executemany("delete from images_knn where id = ?", [(row_id,) for row_id in row_ids])
+            self.db.executemany("insert into images_knn values (?, ?, ?, ?)", knn_rows)
+            self._record_write()
+
+    def closest_by_vector(
+        self, vector: np.ndarray, k: int = 25, where: Optional[dict] = None, model: Optional[str] = None
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """KNN query on the vec0 index for a single vector. closest_many() loads the whole collection
+        for one matrix product, which pays off for large batches of queries rather than one"""
+        ids, distances = stack_results(
+            [self._knn(np.asarray(vector, dtype=np.float32).tobytes(), k, where, model)], min(k, self.count())
+        )
+        return ids[0], distances[0]
+
+    def _knn(self, embedding: bytes, n_results: int, where: Optional[dict] = None, model: Optional[str] = None) -> List:
+        """KNN query against the vec0 index for one serialised embedding.
+        The virtual table does the top-k itself, so images is only joined on the winning ids
+        See https://alexgarcia.xyz/sqlite-vec/features/knn.html
+
+        A filter becomes a set of ids from an indexed lookup on images, which vec0 applies
+        inside the KNN query, so only matching rows are scored and k of them still come back
+        """
+        filters, params = "", []
+        if where:
+            conditions, params = where_clause(where)
+            filters = f"and id in (select id from images where {conditions})"
+        table, precision = self._space(model)
+        query = f"""
+            select images.url, knn.distance
+            from (
+                select id, distance from {table}
+                where embedding match {self._vector_param(precision)} and k = ? {filters}
+            ) as knn
+            join images on images.id = knn.id
+            order by knn.distance"""
+        encoded = self._encode(np.frombuffer(embedding, dtype=np.float32), precision)[0]
+
+        with self.reader() as db:
+            return db.execute(query, [encoded, n_results, *params]).fetchall()
+
+    def pending_migrations(self) -> List[str]:
+        """Schema changes this db is missing:
+        * cosine_metric - images_vec predates distance_metric=cosine, so KNN queries rank by L2
+        * content_hash - images has nowhere to record what each embedding was computed from
+        * unique_url - no unique index on images.url, so it may hold duplicates
+        * filter_columns - images lacks the metadata columns closest(where=...) filters on
+        * single_copy - images holds a second copy of every embedding (schema version 0)"""
+        pending = []
+        vec_sql = self._table_sql("images_vec")
+        if vec_sql is not None and "distance_metric=cosine" not in vec_sql:
+            pending.append("cosine_metric")
+        if "content_hash" not in self._table_sql("images"):
+            pending.append("content_hash")
+        if self._table_sql("images_url") is None:
+            pending.append("unique_url")
+        if "session" not in self._table_sql("images"):
+            pending.append("filter_columns")
+        if "embedding" in self._table_sql("images"):
+            pending.append("single_copy")
+        return pending
+
+    def needs_migration(self) -> bool:
+        return bool(self.pending_migrations())
+
+    def migrate(self) -> bool:
+        """Bring an older db up to the current schema in one transaction.
+        Returns True if anything needed doing"""
+        pending = self.pending_migrations()
+        if not pending:
+            return False
+        with self._write_lock, self.db:
+            if "content_hash" in pending:
+                self.db.execute("alter table images add column content_hash text")
+            if "unique_url" in pending:
+                # Keep the most recently added row for each url
+                duplicates = "select id from images where id not in (select max(id) from images group by url)"
+                self.db.execute(f"delete from images_vec where id in ({duplicates})")
+                self.db.execute(f"delete from images where id in ({duplicates})")
+                self.db.execute(SQLITE_SCHEMA[2])
+            if "filter_columns" in pending:
+                for column in ("lat real", "lon real", "date text", "session text"):
+                    self.db.execute(f"alter table images add column {column}")
+                self.db.executemany(
+                    "update images set lat = :lat, lon = :lon, date = :date, session = :session where id = :id",
+                    (
+                        {**filename_metadata(url), "id": row_id}
+                        for row_id, url in self.db.execute("select id, url from images").fetchall()
+                    ),
+                )
+                for statement in SQLITE_SCHEMA[3:]:
+                    self.db.execute(statement)
+            if "cosine_metric" in pending:
+                self._rebuild_vectors(self.precision)
+            if "single_copy" in pending:
+                # images_vec has always held the same vectors, so this copy can simply go
+                self.db.execute("alter table images drop column embedding")
+            self.db.execute(f"pragma user_version = {SCHEMA_VERSION}")
+            self._record_write()
+        logging.info(f"Applied migrations: {', '.join(pending)}")
+        return True
+
+    def set_precision(self, precision: str) -> bool:
+        """Re-encode every embedding in images_vec at another precision, e.g. int8 for a quarter of the size.
+        Going back to float32 doesn't restore what int8 dropped. Returns True if anything needed doing"""
+        if precision not in PRECISIONS:
+            raise ValueError(f"Unknown precision {precision}, expected one of {', '.join(PRECISIONS)}")
+        if precision == self.precision:
+            return False
+        with self._write_lock, self.db:
+            self._rebuild_vectors(precision)
+            self._record_write()
+        return True
+
+    def _rebuild_vectors(self, precision: str, chunk_size: int = 10000) -> None:
+        """Recreate images_vec with the current schema (distance metric, precision) from its existing contents,
+        via a temporary copy - vec0 tables can't be renamed. The caller holds the write lock and transaction"""
+        old_precision, embedding_len = self._vector_spec()
+        self.db.execute("create temp table images_vec_copy (id integer primary key, embedding blob)")
+        self.db.execute("insert into images_vec_copy select id, embedding from images_vec")
+        self.db.execute("drop table images_vec")
+        self.db.execute(SQLITE_SCHEMA[1].format(embedding_len, PRECISIONS[precision]))
+        self.precision = precision
+
+        last_id = 0
+        while rows := self.db.execute(
+            "select id, embedding from images_vec_copy where id > ? order by id limit ?", [last_id, chunk_size]
+        ).fetchall():
+            row_ids, blobs = zip(*rows)
+            self._insert_vectors(list(row_ids), self._decode(list(blobs), old_precision))
+            last_id = row_ids[-1]
+        self.db.execute("drop table images_vec_copy")
+
+    def schema_version(self) -> int:
+        """The db's pragma user_version, see SCHEMA_VERSION"""
+        with self._write_lock:
+            return self.db.execute("pragma user_version").fetchone()[0]
+
+    def vacuum(self) -> None:
+        """Rewrite the db file, returning the space freed by migrations or deleted rows to the filesystem"""
+        with self._write_lock:
+            self.db.execute("vacuum")
+            self.db.execute("pragma wal_checkpoint(truncate)")
+
+    def _table_sql(self, name: str) -> Optional[str]:
+        """The CREATE statement for a table, or None if it doesn't exist"""
+        with self._write_lock:
+            sql = self.db.execute("select sql from sqlite_master where name = ?", [name]).fetchone()
+        return sql[0] if sql else None
 
     def labelled(self, label: str, n_results: int = 50) -> List[str]:
-        labelled = self.db.execute(
-            """select url from images where classification = ? limit ?""", (label, n_results)
-        ).fetchall()
+        with self.reader() as db:
+            labelled = db.execute(
+                """select url from images where classification = ? limit ?""", (label, n_results)
+            ).fetchall()
         return [i for j in labelled for i in j]
 
     def classes(self) -> List[str]:
-        classes = self.db.execute("""select distinct classification from images""").fetchall()
+        with self.reader() as db:
+            classes = db.execute("""select distinct classification from images""").fetchall()
         return [i for j in classes for i in j]
 
-    def embeddings(self) -> List[List]:
-        embeddings = self.db.execute("""select embedding from images""").fetchall()
-        return [deserialize(i) for j in embeddings for i in j]
+    def classifications(self) -> Dict[str, str]:
+        """Classification for every url"""
+        with self.reader() as db:
+            return dict(db.execute("select url, classification from images"))
+
+    def dimensions(self, model: Optional[str] = None) -> int:
+        """Embedding length the index was created with, which may differ from the one we were opened with"""
+        return self._vector_spec(self._space(model)[0])[1]
+
+    def embeddings(self, model: Optional[str] = None) -> List[List]:
+        return self.embedding_matrix(model)[0]
+
+    def embedding_matrix(self, model: Optional[str] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """Read every embedding in one pass into a single float32 matrix, a chunk of the vec0 table at a time
+        (see _gather) rather than unpacking row by row"""
+        with self.reader() as db:
+            rows = db.execute(
+                f"select images.url, {self._location_columns(model)} {self._locations(model)} order by images.id"
+            )
+            urls, matrix = self._values_and_matrix(db, rows.fetchall(), model)
+        if not urls:
+            return np.empty((0, self.dimensions(model)), dtype=np.float32), np.empty(0, dtype=object)
+        return matrix, np.asarray(urls, dtype=object)
 
     def ids(self) -> List[str]:
-        urls = self.db.execute("""select url from images""").fetchall()
+        with self.reader() as db:
+            urls = db.execute("""select url from images order by id""").fetchall()
         return [i for j in urls for i in j]
 
+    def fingerprint(self) -> Tuple[int, int, int]:
+        """Row count and last row id, like count() only of rows with a default embedding (the ones iter_embeddings()
+        reads), plus generation(), which also moves on for writes that change rows in place"""
+        query = f"""
+            select count(*), coalesce(max(images.id), 0),
+            coalesce((select value from collection_meta where key = 'writes'), 0)
+            {self._locations()}"""
+        with self.reader() as db:
+            count, last_id, generation = db.execute(query).fetchone()
+        return count, last_id, int(generation)
+
+    def count(self) -> int:
+        """Rows with a default embedding. Images only embedded by other models aren't counted"""
+        with self.reader() as db:
+            return db.execute(f"select count(*) {self._locations()}").fetchone()[0]
+
+    def sample(self, n: int) -> List[str]:
+        """Up to n urls with a default embedding picked at random, by drawing random row ids rather than
+        reading every row. Gaps in the ids (deleted rows, or no default embedding) are redrawn until we have enough"""
+        with self.reader() as db:
+            low, high, total = db.execute(
+                f"select min(images.id), max(images.id), count(*) {self._locations()}"
+            ).fetchone()
+            n = min(n, total)
+            if not n:
+                return []
+            found = {}
+            while len(found) < n:
+                candidates = random.sample(range(low, high + 1), min(2 * (n - len(found)), high - low + 1))
+                # One json array parameter, as a placeholder per candidate can pass SQLITE_MAX_VARIABLE_NUMBER
+                found.update(
+                    db.execute(
+                        f"select images.id, images.url {self._locations()} "
+                        "where images.id in (select value from json_each(?))",
+                        [json.dumps(candidates)],
+                    )
+                )
+        return list(found.values())[:n]
+
+    def iter_ids(self, chunk_size: int = 10000) -> Iterator[np.ndarray]:
+        """Urls in chunks of up to chunk_size, paging on the row id so memory stays flat"""
+        for chunk in self._pages("url", chunk_size):
+            yield np.asarray([url for (url,) in chunk], dtype=object)
+
+    def iter_embeddings(
+        self, chunk_size: int = 10000, model: Optional[str] = None, after: int = 0
+    ) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+        """(float32 matrix, urls) in chunks of up to chunk_size rows, paging on the row id.
+        after - only rows with a later id, e.g. those added since a fingerprint() was taken"""
+        for matrix, urls in self._embedding_pages("images.url", chunk_size, model, after):
+            yield matrix, np.asarray(urls, dtype=object)
+
+    def _embedding_pages(
+        self, column: str, chunk_size: int, model: Optional[str] = None, after: int = 0
+    ) -> Iterator[Tuple[np.ndarray, list]]:
+        """(float32 matrix, values of a column of images) for pages of up to chunk_size rows, like _pages()"""
+        last_id = after
+        while True:
+            with self.reader() as db:
+                rows = db.execute(
+                    f"select images.id, {column}, {self._location_columns(model)} {self._locations(model)} "
+                    "where images.id > ? order by images.id limit ?",
+                    [last_id, chunk_size],
+                ).fetchall()
+                if not rows:
+                    return
+                values, matrix = self._values_and_matrix(db, [row[1:] for row in rows], model)
+            last_id = rows[-1][0]
+            yield matrix, values
+
+    def _values_and_matrix(
+        self, db: sqlite3.Connection, rows: List[tuple], model: Optional[str] = None
+    ) -> Tuple[list, np.ndarray]:
+        """Split (value, chunk_id, chunk_offset) rows into the values and the matrix of their embeddings"""
+        return [row[0] for row in rows], self._gather(db, [row[1:] for row in rows], model)
+
+    def _pages(self, columns: str, chunk_size: int) -> Iterator[List[tuple]]:
+        """Keyset pagination over images - each page starts after the last id of the previous one,
+        so it's an index seek rather than an OFFSET that rescans everything before it.
+        A pooled connection is only borrowed for each page, not held while the caller works"""
+        last_id = 0
+        while True:
+            with self.reader() as db:
+                rows = db.execute(
+                    f"select id, {columns} from images where id > ? order by id limit ?", [last_id, chunk_size]
+                ).fetchall()
+            if not rows:
+                return
+            last_id = rows[-1][0]
+            yield [row[1:] for row in rows]
+
+
+class ShardedStore(VectorStore):
+    """Hash-partitions urls across n_shards SQLiteVecStore files, named like db_name with a shard suffix.
+    closest() queries every shard concurrently in a thread pool (sqlite releases the GIL while it works)
+    and merges their top-k lists; add_many() writes the shards in parallel"""
+
+    def __init__(
+        self,
+        db_name: str,
+        n_shards: int = 4,
+        embedding_len: Optional[int] = 512,
+        workers: Optional[int] = None,
+        precision: str = "float32",
+    ):
+        stem, ext = os.path.splitext(db_name)
+        # shards are used from the pool's threads, one query at a time each
+        self.shards = [
+            SQLiteVecStore(
+                f"{stem}-{i:02d}-of-{n_shards:02d}{ext}", embedding_len, check_same_thread=False, precision=precision
+            )
+            for i in range(n_shards)
+        ]
+        self.pool = ThreadPoolExecutor(max_workers=workers or n_shards)
+        self.cache = QueryCache()
+
+    def shard_number(self, url: str) -> int:
+        """The shard a url lives in - a stable hash, unlike hash(), which is salted per process"""
+        digest = hashlib.blake2b(url.encode(), digest_size=8).digest()
+        return int.from_bytes(digest, "little") % len(self.shards)
+
+    def shard(self, url: str) -> SQLiteVecStore:
+        return self.shards[self.shard_number(url)]
+
+    def add(
+        self, url: str, embeddings: List[float], classification: Optional[str] = "", model: Optional[str] = None
+    ) -> None:
+        self.shard(url).add(url, embeddings, classification, model=model)
+
+    def add_many(
+        self,
+        urls: List[str],
+        embeddings: np.ndarray,
+        classifications: Optional[List[str]] = None,
+        model: Optional[str] = None,
+    ) -> int:
+        """Split rows by shard and write each shard's share concurrently"""
+        # Lists of rows too, as the other stores take, so each shard's rows can be picked out by index
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        classifications = classifications or [""] * len(urls)
+        rows = [[] for _ in self.shards]
+        for row, url in enumerate(urls):
+            rows[self.shard_number(url)].append(row)
+
+        futures = [
+            self.pool.submit(
+                shard.add_many,
+                [urls[i] for i in shard_rows],
+                embeddings[shard_rows],
+                [classifications[i] for i in shard_rows],
+                model=model,
+            )
+            for shard, shard_rows in zip(self.shards, rows)
+            if shard_rows
+        ]
+        return sum(future.result() for future in futures)
+
+    def upsert_many(
+        self,
+        urls: List[str],
+        embeddings: np.ndarray,
+        content_hashes: List[str],
+        classifications: Optional[List[str]] = None,
+        model: Optional[str] = None,
+    ) -> Dict[str, List[str]]:
+        """Split rows by shard and upsert each shard's share concurrently, merging the reports"""
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        rows = [[] for _ in self.shards]
+        for row, url in enumerate(urls):
+            rows[self.shard_number(url)].append(row)
+
+        futures = [
+            self.pool.submit(
+                shard.upsert_many,
+                [urls[i] for i in shard_rows],
+                embeddings[shard_rows],
+                [content_hashes[i] for i in shard_rows],
+                [classifications[i] for i in shard_rows] if classifications else None,
+                model=model,
+            )
+            for shard, shard_rows in zip(self.shards, rows)
+            if shard_rows
+        ]
+        report = {"new": [], "changed": [], "unchanged": []}
+        for future in futures:
+            for status, shard_urls in future.result().items():
+                report[status].extend(shard_urls)
+        return report
+
+    def content_hashes(self, model: Optional[str] = None) -> Dict[str, Optional[str]]:
+        return {url: content_hash for shard in self.shards for url, content_hash in shard.content_hashes(model).items()}
+
+    def register_model(self, name: str, embedding_len: int, precision: str = "float32") -> None:
+        for shard in self.shards:
+            shard.register_model(name, embedding_len, precision)
+
+    def models(self) -> Dict[str, int]:
+        return self.shards[0].models()
+
+    def classifications(self) -> Dict[str, str]:
+        return {url: label for shard in self.shards for url, label in shard.classifications().items()}
+
+    def get(self, url: str, model: Optional[str] = None) -> List[float]:
+        return self.shard(url).get(url, model)
+
+    def generation(self) -> tuple:
+        return tuple(shard.generation() for shard in self.shards)
+
+    def closest(self, url: str, n_results: int = 25, where: Optional[dict] = None, model: Optional[str] = None) -> List:
+        """Find the N closest examples in each shard in parallel, and merge them by distance.
+        Cached until any shard is written to"""
+        return self.cache.get_or_compute(
+            cache_key(url, n_results, model, where=where),
+            self.generation(),
+            lambda: self._closest(url, n_results, where, model),
+        )
+
+    def _closest(self, url: str, n_results: int, where: Optional[dict] = None, model: Optional[str] = None) -> List:
+        embedding = self.get(url, model)
+        if embedding is None:
+            return None
+        return self._knn(embedding, n_results, where, model)
+
+    def closest_by_vector(
+        self, vector: np.ndarray, k: int = 25, where: Optional[dict] = None, model: Optional[str] = None
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        ids, distances = stack_results(
+            [self._knn(np.asarray(vector, dtype=np.float32).tobytes(), k, where, model)], min(k, self.count())
+        )
+        return ids[0], distances[0]
+
+    def _knn(self, embedding: bytes, n_results: int, where: Optional[dict] = None, model: Optional[str] = None) -> List:
+        """KNN query on every shard in parallel, merged by distance"""
+        per_shard = self.pool.map(lambda shard: shard._knn(embedding, n_results, where, model), self.shards)
+        # each shard's results are already ordered by distance
+        return list(itertools.islice(heapq.merge(*per_shard, key=lambda result: result[1]), n_results))
+
+    def count(self) -> int:
+        return sum(shard.count() for shard in self.shards)
+
+    def labelled(self, label: str, n_results: int = 50) -> List[str]:
+        labelled = itertools.chain.from_iterable(shard.labelled(label, n_results) for shard in self.shards)
+        return list(itertools.islice(labelled, n_results))
+
+    def classes(self) -> List[str]:
+        return sorted({label for shard in self.shards for label in shard.classes()})
+
+    def embeddings(self, model: Optional[str] = None) -> List[List]:
+        return self.embedding_matrix(model)[0]
+
+    def embedding_matrix(self, model: Optional[str] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """Shard by shard, so ids are grouped by shard rather than in insertion order"""
+        matrices, ids = zip(*self.pool.map(lambda shard: shard.embedding_matrix(model), self.shards))
+        return np.concatenate(matrices), np.concatenate(ids)
+
+    def ids(self) -> List[str]:
+        return [url for shard in self.shards for url in shard.ids()]
+
+    def fingerprint(self) -> Tuple[int, int, int]:
+        """Each part summed over the shards - generations only go up, so their sum moves on when any of them does"""
+        return tuple(sum(part) for part in zip(*(shard.fingerprint() for shard in self.shards)))
+
+
+class HNSWStore(VectorStore):
+    """Approximate nearest neighbour search over an in-memory HNSW graph, see cyto_ml.data.hnsw
+    The index is persisted to db_name (a pickle) by save(), and loaded from there if it exists.
+    Vectors are held L2-normalised, so get() returns the unit-length embedding"""
+
+    def __init__(
+        self,
+        db_name: str,
+        embedding_len: Optional[int] = 512,
+        M: int = 16,
+        ef_construction: int = 200,
+        ef_search: int = 50,
+    ):
+        self.db_name = db_name
+        if os.path.exists(db_name):
+            with open(db_name, "rb") as f:
+                state = pickle.load(f)
+            self.index = state["index"]
+            self.urls = state["urls"]
+        else:
+            self.index = HNSWIndex(embedding_len, M=M, ef_construction=ef_construction, ef_search=ef_search)
+            self.urls = []
+        self.nodes = {url: node for node, url in enumerate(self.urls)}
+
+    def add(self, url: str, embeddings: List[float]) -> None:
+        self.add_many([url], np.asarray([embeddings], dtype=np.float32))
+
+    def add_many(self, urls: List[str], embeddings: np.ndarray) -> int:
+        """Insert rows into the graph one at a time - call save() to persist them"""
+        for url, vector in zip(urls, embeddings):
+            if url in self.nodes:
+                raise ValueError(f"{url} is already in the index")
+            self.nodes[url] = self.index.add(vector)
+            self.urls.append(url)
+        return len(urls)
+
+    def get(self, url: str) -> List[float]:
+        node = self.nodes.get(url)
+        return None if node is None else self.index.vectors[node]
+
+    def closest(self, url: str, n_results: int = 25, ef_search: Optional[int] = None) -> List:
+        """Approximate N closest examples, as a list of (url, cosine distance) ordered by distance"""
+        embeddings = self.get(url)
+        if embeddings is None:
+            return None
+        return [(self.urls[node], dist) for dist, node in self.index.search(embeddings, n_results, ef_search)]
+
+    def closest_by_vector(
+        self, vector: np.ndarray, k: int = 25, ef_search: Optional[int] = None
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        ids, distances = self.closest_many(np.atleast_2d(vector), k, ef_search=ef_search)
+        return ids[0], distances[0]
+
+    def closest_many(
+        self, queries: np.ndarray, k: int = 25, chunk_size: int = 1024, ef_search: Optional[int] = None
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Graph search for each query in turn"""
+        results = [
+            [(self.urls[node], dist) for dist, node in self.index.search(query, k, ef_search)]
+            for query in np.atleast_2d(queries)
+        ]
+        return stack_results(results, min(k, len(self.urls)))
+
+    def embeddings(self) -> List[List]:
+        return self.embedding_matrix()[0]
+
+    def embedding_matrix(self) -> Tuple[np.ndarray, np.ndarray]:
+        return self.index.vectors[: len(self.index)], np.asarray(self.urls, dtype=object)
+
+    def ids(self) -> List[str]:
+        return list(self.urls)
+
+    def fingerprint(self) -> Tuple[int, Optional[int]]:
+        return len(self.urls), len(self.urls)
+
+    def save(self) -> None:
+        """Pickle the graph and ids to db_name"""
+        pickle_atomic({"index": self.index, "urls": self.urls}, self.db_name)
+
+
+class IVFPQStore(VectorStore):
+    """Product-quantised approximate search, see cyto_ml.data.pq
+    Only the compact codes are held in memory. With a source store (the sqlite collection the codes
+    were built from), queries start from exact vectors and can exactly re-rank their top candidates.
+    Without one, get() and embeddings() return approximate reconstructions.
+    The index must be trained (train() or from_store()) before adding rows; save() persists it to db_name"""
+
+    def __init__(
+        self,
+        db_name: str,
+        embedding_len: Optional[int] = 512,
+        n_lists: int = 256,
+        n_subvectors: Optional[int] = None,
+        source: Optional[SQLiteVecStore] = None,
+    ):
+        self.db_name = db_name
+        self.source = source
+        if os.path.exists(db_name):
+            with open(db_name, "rb") as f:
+                state = pickle.load(f)
+            self.index = state["index"]
+            self.urls = state["urls"]
+        else:
+            self.index = IVFPQIndex(embedding_len, n_lists=n_lists, n_subvectors=n_subvectors)
+            self.urls = []
+        self.positions = {url: position for position, url in enumerate(self.urls)}
+
+    @classmethod
+    def from_store(cls, source: SQLiteVecStore, db_name: str, sample_size: int = 50000, **kwargs) -> "IVFPQStore":
+        """Train codebooks on a random sample of source, then encode every row of it chunk by chunk"""
+        sample = source.get_many(source.sample(sample_size))
+        store = cls(db_name, embedding_len=sample.shape[1], source=source, **kwargs)
+        store.train(sample)
+        for matrix, urls in source.iter_embeddings():
+            store.add_many(list(urls), matrix)
+        return store
+
+    def train(self, sample: np.ndarray) -> None:
+        self.index.train(sample)
+
+    def add(self, url: str, embeddings: List[float]) -> None:
+        self.add_many([url], np.asarray([embeddings], dtype=np.float32))
+
+    def add_many(self, urls: List[str], embeddings: np.ndarray) -> int:
+        """Encode rows into the index - call save() to persist them"""
+        for url in urls:
+            if url in self.positions:
+                raise ValueError(f"{url} is already in the index")
+        for url, position in zip(urls, self.index.add(embeddings)):
+            self.positions[url] = int(position)
+            self.urls.append(url)
+        return len(urls)
+
+    def get(self, url: str) -> List[float]:
+        """The exact vector from the source store if there is one, otherwise the reconstruction"""
+        if url not in self.positions:
+            return None
+        if self.source is not None:
+            return self.source.get_many([url])[0]
+        return self.index.decode(np.array([self.positions[url]]))[0]
+
+    def closest(self, url: str, n_results: int = 25, nprobe: int = 8, rerank: int = 0) -> List:
+        """Approximate N closest examples, as a list of (url, cosine distance) ordered by distance.
+        rerank > 0 re-scores that many of the top candidates with exact vectors from the source store"""
+        query = self.get(url)
+        if query is None:
+            return None
+        return self._search(query, n_results, nprobe, rerank)
+
+    def closest_by_vector(
+        self, vector: np.ndarray, k: int = 25, nprobe: int = 8, rerank: int = 0
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        ids, distances = self.closest_many(np.atleast_2d(vector), k, nprobe=nprobe, rerank=rerank)
+        return ids[0], distances[0]
+
+    def closest_many(
+        self, queries: np.ndarray, k: int = 25, chunk_size: int = 1024, nprobe: int = 8, rerank: int = 0
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Search the codes for each query in turn"""
+        results = [self._search(query, k, nprobe, rerank) for query in np.atleast_2d(queries)]
+        return stack_results(results, min(k, len(self.urls)))
+
+    def _search(self, query: np.ndarray, n_results: int, nprobe: int, rerank: int) -> List:
+        found = self.index.search(query, max(n_results, rerank), nprobe=nprobe)
+        results = [(self.urls[position], dist) for dist, position in found]
+
+        if rerank and self.source is not None:
+            candidates = [url for url, _ in results]
+            exact = normalise(self.source.get_many(candidates)) @ normalise(query)
+            results = sorted(zip(candidates, (1.0 - exact).tolist()), key=lambda r: r[1])
+        return results[:n_results]
+
+    def embeddings(self) -> List[List]:
+        return self.embedding_matrix()[0]
+
+    def embedding_matrix(self) -> Tuple[np.ndarray, np.ndarray]:
+        """Reconstructed (approximate, unit length) vectors for every row"""
+        return self.index.decode(np.arange(len(self.index))), np.asarray(self.urls, dtype=object)
+
+    def ids(self) -> List[str]:
+        return list(self.urls)
+
+    def fingerprint(self) -> Tuple[int, Optional[int]]:
+        return len(self.urls), len(self.urls)
+
+    def save(self) -> None:
+        """Pickle the codebooks, codes and ids to db_name"""
+        pickle_atomic({"index": self.index, "urls": self.urls}, self.db_name)
+
+
+class InMemoryStore(VectorStore):
+    """Exact search over every embedding held in RAM, for collections of up to a few million rows.
+    Embeddings are L2-normalised into one preallocated float32 buffer which doubles when full,
+    so get() returns the unit-length embedding and a cosine top-k is one matrix-vector product.
+    Opening an existing sqlite db_name loads it; nothing is written back"""
+
+    def __init__(self, db_name: Optional[str] = None, embedding_len: Optional[int] = 512, capacity: int = 1024):
+        self.db_name = db_name
+        self.embedding_len = embedding_len
+        self.vectors = np.empty((capacity, embedding_len or 0), dtype=np.float32)
+        self.urls: List[str] = []
+        self.labels: List[str] = []
+        self.positions: Dict[str, int] = {}
+        self._write_lock = threading.Lock()
+        if db_name and os.path.exists(db_name):
+            source = SQLiteVecStore(db_name)
+            self.embedding_len = source.dimensions()
+            self.load(source)
+            source.close()
+
+    @classmethod
+    def from_store(cls, source: VectorStore, chunk_size: int = 10000) -> "InMemoryStore":
+        """Copy every embedding (and classification, if source has them) out of another store"""
+        store = cls(embedding_len=source.dimensions() if hasattr(source, "dimensions") else None, capacity=0)
+        store.load(source, chunk_size)
+        return store
+
+    def load(self, source: VectorStore, chunk_size: int = 10000) -> None:
+        """Add every row of source. If we know the embedding length, the buffer is grown once to fit them,
+        from source.count(), rather than doubling its way there - each doubling briefly holds both buffers,
+        and the last can leave up to twice the room needed"""
+        if self.embedding_len:
+            with self._write_lock:
+                self._reserve(len(self.urls) + source.count(), exact=True)
+        labels = source.classifications() if hasattr(source, "classifications") else {}
+        for matrix, urls in source.iter_embeddings(chunk_size):
+            self.add_many(list(urls), matrix, [labels.get(url, "") for url in urls])
+
+    def add(self, url: str, embeddings: List[float], classification: Optional[str] = "") -> None:
+        self.add_many([url], np.asarray([embeddings], dtype=np.float32), [classification])
+
+    def add_many(self, urls: List[str], embeddings: np.ndarray, classifications: Optional[List[str]] = None) -> int:
+        embeddings = np.atleast_2d(np.asarray(embeddings, dtype=np.float32))
+        if embeddings.shape[0] != len(urls):
+            raise ValueError(f"Expected a matrix with {len(urls)} rows, got shape {embeddings.shape}")
+        with self._write_lock:
+            for url in urls:
+                if url in self.positions:
+                    raise ValueError(f"{url} is already in the store")
+            if self.embedding_len is None or not self.urls:
+                self.embedding_len = embeddings.shape[1]
+            start = len(self.urls)
+            self._reserve(start + len(urls))
+            self.vectors[start : start + len(urls)] = normalise(embeddings)  # noqa: E203
+            self.labels.extend(classifications or [""] * len(urls))
+            for position, url in enumerate(urls, start):
+                self.positions[url] = position
+            # Last, so readers never see a url before its vector is in place
+            self.urls.extend(urls)
+        return len(urls)
+
+    def _reserve(self, size: int, exact: bool = False) -> None:
+        """Grow the buffer to hold at least size rows, doubling so appends are amortised O(1),
+        or to exactly size rows when we know that's all there will be"""
+        if size <= len(self.vectors) and self.vectors.shape[1] == self.embedding_len:
+            return
+        capacity = max(len(self.vectors), 1)
+        while capacity < size:
+            capacity *= 2
+        if exact:
+            capacity = max(size, len(self.urls))
+        grown = np.empty((capacity, self.embedding_len), dtype=np.float32)
+        if self.urls:
+            grown[: len(self.urls)] = self.vectors[: len(self.urls)]
+        self.vectors = grown
+
+    def get(self, url: str) -> List[float]:
+        position = self.positions.get(url)
+        return None if position is None else self.vectors[position]
+
+    def get_many(self, urls: List[str]) -> np.ndarray:
+        return self.vectors[[self.positions[url] for url in urls]]
+
+    def closest(self, url: str, n_results: int = 25) -> List:
+        """Exact N closest examples, as a list of (url, cosine distance) ordered by distance"""
+        vector = self.get(url)
+        if vector is None:
+            return None
+        ids, distances = self.closest_by_vector(vector, n_results)
+        return list(zip(ids.tolist(), distances.tolist()))
+
+    def closest_by_vector(self, vector: np.ndarray, k: int = 25) -> Tuple[np.ndarray, np.ndarray]:
+        """One matrix-vector product over the buffer, then argpartition for the top k"""
+        matrix, ids = self.embedding_matrix()
+        k = min(k, len(ids))
+        if not k:
+            return ids[:0], np.empty(0, dtype=np.float32)
+        distances = 1.0 - matrix @ normalise(vector)
+        top = np.argpartition(distances, k - 1)[:k]
+        top = top[np.argsort(distances[top])]
+        return ids[top], distances[top]
+
+    def closest_many(self, queries: np.ndarray, k: int = 25, chunk_size: int = 1024) -> Tuple[np.ndarray, np.ndarray]:
+        matrix, ids = self.embedding_matrix()
+        positions, distances = top_k(queries, matrix, k, chunk_size, normalised=True)
+        return ids[positions], distances
+
+    def labelled(self, label: str, n_results: int = 50) -> List[str]:
+        return [url for url, url_label in zip(self.urls, self.labels) if url_label == label][:n_results]
+
+    def classes(self) -> List[str]:
+        return list(dict.fromkeys(self.labels))
+
+    def classifications(self) -> Dict[str, str]:
+        return dict(zip(self.urls, self.labels))
+
+    def embeddings(self) -> List[List]:
+        return self.embedding_matrix()[0]
+
+    def embedding_matrix(self) -> Tuple[np.ndarray, np.ndarray]:
+        """A view of the buffer rather than a copy"""
+        count = len(self.urls)
+        return self.vectors[:count], np.asarray(self.urls[:count], dtype=object)
+
+    def ids(self) -> List[str]:
+        return list(self.urls)
+
+    def count(self) -> int:
+        return len(self.urls)
+
+    def sample(self, n: int) -> List[str]:
+        return [self.urls[i] for i in random.sample(range(len(self.urls)), min(n, len(self.urls)))]
+
+    def fingerprint(self) -> Tuple[int, Optional[int]]:
+        return len(self.urls), len(self.urls)
+
+
+# Store types for vector_store(): a VectorStore class (or other callable taking db_name and options),
+# or a "module:attribute" path to one, imported the first time that store type is asked for
+BACKENDS: Dict[str, Union[str, Callable[..., VectorStore]]] = {}
+
+
+def register_backend(store_type: str, backend: Union[str, Callable[..., VectorStore]]) -> None:
+    """Make a backend available as vector_store(store_type, ...). Pass a "module:attribute" string
+    to defer importing the module (and whatever it depends on) until the backend is used"""
+    BACKENDS[store_type] = backend
+
+
+# The built-in backends are all defined here, so there's nothing to defer by registering them by path -
+# chromadb is only imported when a ChromadbStore is created. Paths are for backends in modules of their own
+register_backend("chromadb", ChromadbStore)
+register_backend("postgres", PostgresStore)
+register_backend("sqlite", SQLiteVecStore)
+register_backend("sharded", ShardedStore)
+register_backend("hnsw", HNSWStore)
+register_backend("ivfpq", IVFPQStore)
+register_backend("memory", InMemoryStore)
+
 
 def vector_store(
     store_type: Optional[str] = "chromadb", db_name: Optional[str] = "test_collection", **kwargs
 ) -> VectorStore:
-    if store_type == "chromadb":
-        return ChromadbStore(db_name, **kwargs)
-    elif store_type == "postgres":
-        return PostgresStore(db_name, **kwargs)
-    elif store_type == "sqlite":
-        return SQLiteVecStore(db_name, **kwargs)
-    else:
-        raise ValueError(f"Unknown store type: {store_type}")
+    try:
+        backend = BACKENDS[store_type]
+    except KeyError:
+        raise ValueError(f"Unknown store type: {store_type}") from None
+    if isinstance(backend, str):
+        module, attribute = backend.split(":")
+        backend = BACKENDS[store_type] = getattr(importlib.import_module(module), attribute)
+    return backend(db_name, **kwargs)
@@ -7,6 +7,7 @@
 # * Option to also return embeddings (could be enabled by default)
 import logging
 import os
+from typing import List
 
 import torch
 import uvicorn
@@ -14,9 +15,10 @@ from fastapi import FastAPI, Form
 from fastapi.responses import JSONResponse
 from resnet50_cefas import load_model
 
+from cyto_ml.data.fetch import image_fetcher
 from cyto_ml.data.image import load_image_from_url
 from cyto_ml.data.labels import RESNET18_LABELS
-from cyto_ml.models.utils import flat_embeddings, resnet18
+from cyto_ml.models.utils import flat_embeddings, image_embeddings, resnet18
 
 STATE_FILE = "../../../data/weights/ResNet_18_3classes_RGB.pth"
 
@@ -77,6 +79,18 @@ async def resnet50(url: str = Form(...)) -> JSONResponse:
     return {"embeddings": embeddings}
 
 
+@app.post("/resnet50/batch/")
+async def resnet50_batch(urls: List[str] = Form(...)) -> JSONResponse:
+    """Embeddings for several images, a forward pass per batch of same-sized images, in the order of the urls"""
+    images = {fetched.url: fetched.image async for fetched in image_fetcher().fetch_many(set(urls))}
+    missing = [url for url in urls if images[url] is None]
+    if missing:
+        return JSONResponse(status_code=404, content={"error": f"Could not load {missing}"})
+
+    embeddings = image_embeddings(resnet50_model, [images[url] for url in urls])
+    return {"embeddings": embeddings.tolist()}
+
+
 @app.post("/resnet18/")
 async def resnet18_3(url: str = Form(...)) -> JSONResponse:
     """Use the 3 class Resnet18 model to return both a prediction
@@ -1,5 +1,11 @@
+from typing import Optional, Sequence
+
+import numpy as np
 import torch
 import torchvision
+from PIL import Image
+
+from cyto_ml.data.image import prepare_batch, same_size_batches
 
 # Definitions are from here
 # https://github.com/alan-turing-institute/ViT-LASNet/blob/main/test/test.py
@@ -24,6 +30,35 @@ def resnet18(num_classes: int, filename: str = "", strip_final_layer: bool = Fal
 
 def flat_embeddings(features: torch.Tensor) -> list:
     """Utility function that takes the features returned by the model in truncate_model
-    And flattens them into a list suitable for storing in a vector database"""
-    # TODO: this only returns the 0th tensor in the batch...why?
+    And flattens them into a list suitable for storing in a vector database.
+    prepare_image gives the model a batch of one image, so these are that image's features -
+    use batch_embeddings for a batch of several"""
+    if len(features) != 1:
+        raise ValueError(f"Expected features for a single image, got a batch of {len(features)}")
     return features[0].detach().tolist()
+
+
+def batch_embeddings(model: torch.nn.Module, batch: torch.Tensor) -> np.ndarray:
+    """Embed a prepared (N, C, H, W) batch (see cyto_ml.data.image.prepare_batch) in one forward pass.
+    Returns an (N, D) float32 array, a row per image, as VectorStore.add_many and upsert_many take them"""
+    with torch.no_grad():
+        features = model(batch)
+    return features.reshape(len(features), -1).cpu().numpy().astype(np.float32, copy=False)
+
+
+def image_embeddings(
+    model: torch.nn.Module,
+    images: Sequence[Image.Image],
+    normalise_func: Optional[str] = "base_normalise",
+    batch_size: int = 32,
+) -> np.ndarray:
+    """Embed images, a forward pass per batch of up to batch_size that are prepared to the same size
+    (see cyto_ml.data.image.same_size_batches), so each gets the embedding it would get on its own.
+    Returns an (N, D) float32 array, a row per image in the order given"""
+    embeddings = np.empty((len(images), 0), dtype=np.float32)
+    for positions in same_size_batches(images, normalise_func, batch_size):
+        rows = batch_embeddings(model, prepare_batch([images[i] for i in positions], normalise_func))
+        if not embeddings.shape[1]:
+            embeddings = np.empty((len(images), rows.shape[1]), dtype=np.float32)
+        embeddings[positions] = rows
+    return embeddings
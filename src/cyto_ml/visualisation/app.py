@@ -10,27 +10,33 @@ based on their embeddings from a deep learning model
 
 import logging
 import os
-import random
-from io import BytesIO
-from typing import List, Optional
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
 
+import numpy as np
 import pandas as pd
 import plotly.express as px
 import plotly.graph_objects as go
-import requests
 import streamlit as st
 from dotenv import load_dotenv
 from PIL import Image
 
-from cyto_ml.data.db_config import OPTIONS
+from cyto_ml.data.db_config import DEFAULT_MODEL, OPTIONS
+from cyto_ml.data.fetch import image_fetcher
 from cyto_ml.data.image import normalise_flowlr
-from cyto_ml.data.vectorstore import vector_store
+from cyto_ml.data.snapshot import snapshot
+from cyto_ml.data.vectorstore import InMemoryStore, VectorStore, vector_store
 from cyto_ml.visualisation.config import COLLECTIONS
 
 logging.basicConfig(level=logging.INFO)
 load_dotenv()
 
 STORE_TYPE = "sqlite"
+# Collections whose embeddings fit in this many bytes are searched in memory rather than on disk
+MEMORY_LIMIT = int(os.environ.get("VECTOR_STORE_MEMORY_LIMIT", str(2 * 1024**3)))
+# Seconds between checks for changes to a collection held in memory
+RELOAD_INTERVAL = float(os.environ.get("VECTOR_STORE_RELOAD_INTERVAL", "30"))
 
 
 def collections() -> List[str]:
@@ -38,19 +44,91 @@ def collections() -> List[str]:
     return COLLECTIONS
 
 
+def data_path(coll: str) -> str:
+    """Collection databases (and their snapshots) live in project_root/data"""
+    return os.path.join(os.path.abspath(os.path.dirname(__file__)), "../../../data", coll)
+
+
 @st.cache_resource
-def store(coll: str) -> None:
+def disk_store(coll: str) -> None:
     """
-    Load the vector store with image embeddings.
+    Open the collection's database, shared between sessions
     """
-    # TODO stop recreating the connection on every call
-    # E.g. chroma will have one store per collection...
-    db_name = os.path.join(os.path.abspath(os.path.dirname(__file__)), "../../../data", f"{coll}.db")
+    return vector_store(STORE_TYPE, f"{data_path(coll)}.db", **OPTIONS[STORE_TYPE])
 
-    return vector_store(STORE_TYPE, db_name, **OPTIONS[STORE_TYPE])
+
+@st.cache_resource
+def loaded_stores() -> Dict[str, Tuple[Tuple[int, int], float, VectorStore]]:
+    """The store each collection is searched in (see store()), with the (row count, last row id) it holds
+    and when the database was last checked for changes, shared between sessions"""
+    return {}
+
+
+@st.cache_resource
+def loading_lock() -> threading.Lock:
+    return threading.Lock()
+
+
+def store(coll: str) -> VectorStore:
+    """
+    The vector store with image embeddings.
+    If the whole collection fits within MEMORY_LIMIT, it's copied into an InMemoryStore for exact search in RAM.
+    At most every RELOAD_INTERVAL seconds the database is checked for new rows (e.g. from the embedding pipeline),
+    which are appended to the copy. It's only copied again in full if rows were removed or replaced -
+    writes that leave the rows as they were, like update_knn(), don't count.
+    One session checks at a time; the others carry on with the copy they have meanwhile
+    """
+    loaded = loaded_stores().get(coll)
+    if loaded is not None and time.monotonic() - loaded[1] < RELOAD_INTERVAL:
+        return loaded[2]
+    lock = loading_lock()
+    if not lock.acquire(blocking=loaded is None):
+        return loaded[2]
+    try:
+        # Perhaps brought up to date by another session while we waited
+        loaded = loaded_stores().get(coll)
+        if loaded is None or time.monotonic() - loaded[1] >= RELOAD_INTERVAL:
+            loaded = loaded_stores()[coll] = refreshed(coll, loaded)
+    finally:
+        lock.release()
+    return loaded[2]
+
+
+def refreshed(
+    coll: str, loaded: Optional[Tuple[Tuple[int, int], float, VectorStore]]
+) -> Tuple[Tuple[int, int], float, VectorStore]:
+    """loaded brought up to date with the database, see store(). The caller holds loading_lock()"""
+    s = disk_store(coll)
+    count, last_id, _ = s.fingerprint()
+    fits = count * s.dimensions() * 4 <= MEMORY_LIMIT
+    if loaded is not None:
+        rows, _, copy = loaded
+        if rows == (count, last_id):
+            return rows, time.monotonic(), copy
+        if isinstance(copy, InMemoryStore) and fits and last_id > rows[1]:
+            labels = s.classifications()
+            try:
+                for matrix, urls in s.iter_embeddings(after=rows[1]):
+                    copy.add_many(list(urls), matrix, [labels.get(url, "") for url in urls])
+            except ValueError:
+                # A url we already had, stored again under a new row id - copy it all again below
+                pass
+            else:
+                # Otherwise rows were removed as well as added
+                if copy.count() == count:
+                    logging.info(f"Added {count - rows[0]} new rows of {coll} to the copy in memory")
+                    return (count, last_id), time.monotonic(), copy
+    # Let go of the old copy first (our references too), so there's only ever one in memory
+    loaded_stores().pop(coll, None)
+    loaded = copy = None
+    if fits:
+        logging.info(f"Loading {coll} into memory")
+        copy = InMemoryStore.from_store(s)
+    else:
+        copy = s
+    return (count, last_id), time.monotonic(), copy
 
 
-@st.cache_data
 def image_ids(coll: str) -> list:
     """
     Retrieve image embeddings from chroma database.
@@ -59,16 +137,55 @@ def image_ids(coll: str) -> list:
     return store(coll).ids()
 
 
-@st.cache_data
-def image_embeddings() -> list:
-    return store(st.session_state["collection"]).embeddings()
+def image_embeddings(coll: str) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    All the embeddings in a collection as one float32 matrix, plus ids in the same order.
+    Memory-mapped from a snapshot file shared between processes, refreshed if the store has changed.
+    """
+    s = store(coll)
+    if isinstance(s, InMemoryStore):
+        # Already in RAM, so a view of its buffer
+        return s.embedding_matrix()
+    return snapshot_embeddings(coll, s.generation())
+
+
+@st.cache_resource(max_entries=len(COLLECTIONS))
+def snapshot_embeddings(coll: str, generation: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    The collection's snapshot as it was at generation, which is only there as part of the cache key.
+    cache_resource rather than cache_data, which would copy the whole matrix on every call
+    """
+    return snapshot(disk_store(coll), f"{data_path(coll)}.snapshot")
+
+
+def cluster_embeddings(coll: str) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Embeddings to cluster on, plus ids in the same order - the collection's projected embeddings
+    if it has a fitted projection (see scripts/fit_projection.py), which are far quicker to cluster
+    """
+    s = disk_store(coll)
+    if s.projection() is not None:
+        return reduced_embeddings(coll, s.generation())
+    return image_embeddings(coll)
+
+
+@st.cache_resource(max_entries=len(COLLECTIONS))
+def reduced_embeddings(coll: str, generation: int) -> Tuple[np.ndarray, np.ndarray]:
+    """The collection's projected embeddings as they were at generation, see snapshot_embeddings"""
+    return disk_store(coll).reduced_matrix()
 
 
 def closest_n(url: str, n: Optional[int] = 26) -> list:
     """
-    Given an image URL return the N closest ones by cosine distance
+    Given an image URL return the N closest ones by cosine distance,
+    between the embeddings from the chosen model
     """
-    s = store(st.session_state["collection"])
+    coll = st.session_state["collection"]
+    model = st.session_state.get("model", DEFAULT_MODEL)
+    if model != DEFAULT_MODEL:
+        # Only the default model's embeddings are loaded into memory
+        return disk_store(coll).closest(url, n_results=n, model=model)
+    s = store(coll)
 
     results = s.closest(url, n_results=n)
     # logging.info(results)
@@ -82,12 +199,12 @@ def cached_image(url: str) -> Image:
     Hopefully caches this per-image, so it'll speed up
     We tried streamlit_clickable_images but no tiff support
     """
-    response = requests.get(url)
-    image = Image.open(BytesIO(response.content))
+    # Through the fetcher shared with the rest of cyto_ml, which pools connections and retries
+    image = image_fetcher().fetch(url).image
 
     # Special handling for Flow Cytometer images,
     # All 16 bit greyscale in low range of values
-    if image.mode == "I;16":
+    if image is not None and image.mode == "I;16":
         image = normalise_flowlr(image)
 
     return image
@@ -147,10 +264,8 @@ def create_figure(df: pd.DataFrame) -> go.Figure:
 
 
 def random_image() -> str:
-    ids = image_ids(st.session_state["collection"])
-    # starting image
-    test_image_url = random.choice(ids)
-    return test_image_url
+    # starting image, picked by row id rather than loading every id
+    return store(st.session_state["collection"]).sample(1)[0]
 
 
 def pick_image(image: str) -> None:
@@ -176,7 +291,7 @@ def main() -> None:
     st.set_page_config(layout="wide", page_title="Plankton image embeddings")
 
     st.title("Image embeddings")
-    st.write(f"{len(image_ids(st.session_state['collection']))} images in {st.session_state['collection']}")
+    st.write(f"{store(st.session_state['collection']).count()} images in {st.session_state['collection']}")
     # the generated HTML is not lovely at all
 
     st.selectbox(
@@ -184,6 +299,10 @@ def main() -> None:
         colls,
         key="collection",
     )
+    # Collections can hold embeddings from more than one model, see scripts/image_embeddings.py
+    models = list(disk_store(st.session_state["collection"]).models())
+    if len(models) > 1:
+        st.selectbox("embedding model", models, key="model")
 
     if "start_img" not in st.session_state or st.session_state["start_img"] is None:
         st.session_state["start_img"] = random_image()
@@ -3,7 +3,7 @@ import logging
 import streamlit as st
 from sklearn.cluster import KMeans
 
-from cyto_ml.visualisation.app import cached_image, collections, image_embeddings, image_ids
+from cyto_ml.visualisation.app import cached_image, cluster_embeddings, collections
 
 logging.basicConfig(level=logging.INFO)
 
@@ -16,7 +16,7 @@ def kmeans_cluster() -> KMeans:
     K-means cluster the embeddings, option in session for default size
 
     """
-    X = image_embeddings()
+    X, _ = cluster_embeddings(st.session_state["collection"])
     logging.info(len(X))
     logging.info(st.session_state["n_clusters"])
     n_clusters = st.session_state["n_clusters"]
@@ -34,7 +34,9 @@ def image_labels() -> dict:
     km = kmeans_cluster()
     clusters = dict(zip(set(km.labels_), [[] for _ in range(len(set(km.labels_)))]))
 
-    for index, _id in enumerate(image_ids(st.session_state["collection"])):
+    # ids come back in the same order as the rows that were clustered
+    _, ids = cluster_embeddings(st.session_state["collection"])
+    for index, _id in enumerate(ids):
         label = km.labels_[index]
         clusters[label].append(_id)
     return clusters
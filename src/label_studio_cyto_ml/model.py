@@ -4,13 +4,14 @@ import pickle
 from pathlib import Path
 from typing import Any, Dict, List, Literal, Optional
 
+import numpy as np
 from dotenv import load_dotenv
 from label_studio_ml.model import LabelStudioMLBase
 from label_studio_ml.response import ModelResponse, PredictionValue
 from resnet50_cefas import load_model
 
-from cyto_ml.data.image import load_image_from_url
-from cyto_ml.models.utils import flat_embeddings
+from cyto_ml.data.fetch import image_fetcher
+from cyto_ml.models.utils import image_embeddings
 
 # Set AWS_URL_ENDPOINT in here
 # Used to convert s3:// URLs coming from Label Studio to https:// URLs
@@ -52,12 +53,15 @@ class NewModel(LabelStudioMLBase):
         Parsed JSON Label config: {self.parsed_label_config}
         Extra params: {self.extra_params}""")
 
+        # Extract image embeddings for every task with a ResNet, a forward pass per group of same-sized images
+        embeddings = self.task_embeddings(tasks)
+
         # TODO as below, check what the response format should really be (try it!)
         predictions = []
-        for task in tasks:
+        for task, task_embeddings in zip(tasks, embeddings):
             logging.debug(task)
             try:
-                annotated = self.predict_task(task)
+                annotated = self.predict_task(task, task_embeddings.tolist())
                 predictions.append(annotated)
             except KeyError as err:
                 # Return 500 with detail
@@ -95,20 +99,23 @@ class NewModel(LabelStudioMLBase):
 
         return bucket
 
-    def predict_task(self, task: dict) -> dict:
+    def task_embeddings(self, tasks: List[Dict]) -> np.ndarray:
+        """Image embeddings for a list of tasks, a row per task, batching same-sized images through the ResNet"""
+        urls = [self.convert_url(task["data"]["image"]) for task in tasks]
+        # Download the images concurrently, then embed them in task order
+        images = {fetched.url: fetched.image for fetched in image_fetcher().iter_many(set(urls))}
+        missing = [url for url in urls if images[url] is None]
+        if missing:
+            raise ImageNotFoundError(f"Could not load {missing}")
+        return image_embeddings(resnet50_model, [images[url] for url in urls])
+
+    def predict_task(self, task: dict, embeddings: List[float]) -> dict:
         """Receive a single task definition as described here https://labelstud.io/guide/task_format.html
+        and its image embeddings (see task_embeddings)
         Return the task decorated with predictions as described here
         https://labelstud.io/guide/export.html#Label-Studio-JSON-format-of-annotated-tasks
         """
-        # We use two models here:
-        # Extract image embeddings with a ResNet
-        try:
-            image_url = task.get("data").get("image")
-        except KeyError as err:
-            raise (err)
-
-        features = resnet50_model(load_image_from_url(self.convert_url(image_url)))
-        embeddings = flat_embeddings(features)
+        image_url = task["data"]["image"]
 
         # Classify embeddings (KNN to start, many improvements possible!) and return a label
         # This allows us one prediction model per s3 bucket, but it could be an ensemble.
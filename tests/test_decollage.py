@@ -4,6 +4,7 @@ from cyto_ml.data.flowcam import (
     lst_metadata,
     window_slice,
     headers_from_filename,
+    filename_metadata,
     write_headers,
     read_headers,
 )
@@ -25,6 +26,12 @@ def test_headers_from_filename(collage_file):
     assert "GPSLatitude" in h and h["GPSLatitude"]
 
 
+def test_filename_metadata():
+    meta = filename_metadata("s3://bucket/MicrobialMethane_MESO_Tank10_54.0143_-2.7770_04052023_1_1.tif")
+    assert meta == {"lat": 54.0143, "lon": -2.777, "date": "2023-05-04", "session": "1"}
+    assert filename_metadata("s3://bucket/vignette_1.tif") == {"lat": None, "lon": None, "date": None, "session": None}
+
+
 def test_write_headers(exiftest_file):
     # Check we don't have a tagged version from a previous run
 
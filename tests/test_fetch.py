@@ -0,0 +1,172 @@
+import asyncio
+import hashlib
+import os
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from cyto_ml.data.fetch import ImageFetcher
+from cyto_ml.data.image_cache import ImageCache
+
+FIXTURES = os.path.join(os.path.abspath(os.path.dirname(__file__)), "fixtures")
+
+
+class StandIn(BaseHTTPRequestHandler):
+    """Object store stand-in: images with ETags, and paths that misbehave"""
+
+    images = {}
+    requests = Counter()
+    in_flight = 0
+    most_in_flight = 0
+    lock = threading.Lock()
+
+    def log_message(self, *args) -> None:
+        pass
+
+    def do_GET(self) -> None:
+        cls = type(self)
+        with cls.lock:
+            cls.requests[self.path] += 1
+            cls.in_flight += 1
+            cls.most_in_flight = max(cls.most_in_flight, cls.in_flight)
+        # Enough for requests to overlap when there are several in flight
+        time.sleep(0.05)
+        # Counted out before responding, as the client can send its next request as soon as it has the response
+        with cls.lock:
+            cls.in_flight -= 1
+        self.respond()
+
+    def respond(self) -> None:
+        name = self.path.strip("/")
+        if name.startswith("flaky") and self.requests[self.path] <= 2:
+            return self.send_error(503)
+        if name == "slow":
+            time.sleep(1)
+        if name == "broken":
+            return self.send_body(b"not an image", "broken")
+        image = self.images.get(name.replace("flaky", "").replace("slow", "") or "single")
+        if image is None:
+            return self.send_error(404)
+        etag = hashlib.md5(image).hexdigest()
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_body(image, etag)
+
+    def send_body(self, body: bytes, etag: str) -> None:
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def server():
+    with open(os.path.join(FIXTURES, "test_images", "testymctestface_36.tif"), "rb") as f:
+        image = f.read()
+    StandIn.images = {f"image_{i}": image for i in range(20)}
+    StandIn.images["single"] = image
+    with open(os.path.join(FIXTURES, "greyscale", "TC18_280524_4840.tif"), "rb") as f:
+        StandIn.images["greyscale"] = f.read()
+    StandIn.requests = Counter()
+    StandIn.most_in_flight = 0
+
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), StandIn)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{httpd.server_port}"
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_fetch(server):
+    fetcher = ImageFetcher(backoff=0)
+    fetched = fetcher.fetch(f"{server}/greyscale")
+    assert fetched.status == 200
+    assert fetched.image.mode == "I;16"
+    assert fetched.content == StandIn.images["greyscale"]
+    assert fetched.etag == hashlib.md5(fetched.content).hexdigest()
+
+    # Unchanged since the ETag we had
+    unchanged = fetcher.fetch(f"{server}/greyscale", etag=fetched.etag)
+    assert unchanged.not_modified
+    assert unchanged.image is None
+
+    missing = fetcher.fetch(f"{server}/missing")
+    assert missing.status == 404
+    assert missing.image is None
+
+    broken = fetcher.fetch(f"{server}/broken")
+    assert broken.status == 200
+    assert broken.image is None
+    fetcher.close()
+
+
+def test_fetch_retries(server):
+    # Two 503s, then the image
+    fetched = ImageFetcher(retries=3, backoff=0).fetch(f"{server}/flaky")
+    assert fetched.image is not None
+    assert StandIn.requests["/flaky"] == 3
+
+    fetched = ImageFetcher(retries=1, backoff=0).fetch(f"{server}/flakyagain")
+    assert fetched.status == 503
+    assert fetched.image is None
+
+
+def test_fetch_timeout(server):
+    fetched = ImageFetcher(retries=0, timeout=(1, 0.2)).fetch(f"{server}/slow")
+    assert fetched.status is None
+    assert fetched.image is None
+
+
+def test_fetch_many(server):
+    fetcher = ImageFetcher(concurrency=4, backoff=0)
+    urls = [f"{server}/image_{i}" for i in range(20)] + [f"{server}/missing"]
+
+    async def fetch_all() -> list:
+        return [fetched async for fetched in fetcher.fetch_many(urls)]
+
+    results = asyncio.run(fetch_all())
+    assert sorted(fetched.url for fetched in results) == sorted(urls)
+    assert sum(fetched.image is not None for fetched in results) == 20
+    # Concurrent, but no more than asked for
+    assert 1 < StandIn.most_in_flight <= 4
+
+    # The same from a generator, for code that isn't async, with an ETag for one of them
+    etags = {urls[0]: hashlib.md5(StandIn.images["image_0"]).hexdigest()}
+    results = {fetched.url: fetched for fetched in fetcher.iter_many(iter(urls), etags)}
+    assert set(results) == set(urls)
+    assert results[urls[0]].not_modified
+    assert results[urls[1]].image is not None
+    fetcher.close()
+
+
+def test_fetch_cache(server, tmp_path):
+    cache = ImageCache(str(tmp_path))
+    fetcher = ImageFetcher(backoff=0, cache=cache)
+    downloaded = fetcher.fetch(f"{server}/greyscale")
+    assert StandIn.requests["/greyscale"] == 1
+
+    # From disk, without asking the server
+    cached = fetcher.fetch(f"{server}/greyscale")
+    assert StandIn.requests["/greyscale"] == 1
+    assert cached.content == downloaded.content
+    assert cached.etag == downloaded.etag
+    assert cached.image.mode == "I;16"
+    assert fetcher.fetch(f"{server}/greyscale", etag=downloaded.etag).not_modified
+
+    # Checked with the server, which says it hasn't changed, so still from disk
+    revalidating = ImageFetcher(backoff=0, cache=cache, revalidate=True)
+    cached = revalidating.fetch(f"{server}/greyscale")
+    assert StandIn.requests["/greyscale"] == 2
+    assert cached.image is not None
+
+    stats = cache.stats()
+    assert stats["misses"] == 1
+    assert stats["hits"] == 3
+
@@ -0,0 +1,67 @@
+import os
+from multiprocessing import get_context
+
+from cyto_ml.data.image_cache import ImageCache
+
+
+def test_image_cache(tmp_path):
+    cache = ImageCache(str(tmp_path))
+    assert cache.lookup("https://example.com/a.tif") is None
+
+    cache.put("https://example.com/a.tif", b"a" * 100, etag="etag-a")
+    assert cache.lookup("https://example.com/a.tif") == (b"a" * 100, "etag-a")
+    cache.hit("https://example.com/a.tif")
+
+    # The same contents from another url are kept once
+    cache.put("https://example.com/copy-of-a.tif", b"a" * 100)
+    stats = cache.stats()
+    assert stats["files"] == 1
+    assert stats["bytes"] == 100
+    assert stats["hits"] == 1
+    assert stats["misses"] == 2
+
+    # A file that's gone from disk is a miss, and forgotten
+    os.remove(cache.path(cache.db.execute("select hash from blobs").fetchone()[0]))
+    assert cache.lookup("https://example.com/a.tif") is None
+    assert cache.lookup("https://example.com/copy-of-a.tif") is None
+    assert cache.stats()["bytes"] == 0
+
+
+def test_image_cache_eviction(tmp_path):
+    cache = ImageCache(str(tmp_path), max_bytes=250)
+    cache.put("a", b"a" * 100)
+    cache.put("b", b"b" * 100)
+    # a is used again, so b is the least recently used when c doesn't fit
+    cache.hit("a")
+    cache.put("c", b"c" * 100)
+
+    assert cache.lookup("b") is None
+    assert cache.lookup("a") == (b"a" * 100, None)
+    assert cache.lookup("c") == (b"c" * 100, None)
+    stats = cache.stats()
+    assert stats["evictions"] == 1
+    assert stats["bytes"] == 200
+    files = [name for _, _, names in os.walk(tmp_path) for name in names if not name.startswith("index.db")]
+    assert len(files) == 2
+
+
+def fill(directory: str, worker: int) -> None:
+    cache = ImageCache(directory, max_bytes=20000)
+    for i in range(50):
+        cache.put(f"https://example.com/{worker}/{i}.tif", bytes([worker, i]) * 250)
+        cache.lookup(f"https://example.com/{worker}/{i // 2}.tif")
+
+
+def test_image_cache_processes(tmp_path):
+    # Several processes filling and evicting from one cache at once
+    with get_context("spawn").Pool(4) as pool:
+        pool.starmap(fill, [(str(tmp_path), worker) for worker in range(4)])
+
+    cache = ImageCache(str(tmp_path), max_bytes=20000)
+    stats = cache.stats()
+    assert stats["misses"] == 200
+    assert stats["evictions"] == 200 - stats["files"]
+    sizes = [size for (size,) in cache.db.execute("select size from blobs")]
+    assert stats["bytes"] == sum(sizes) <= 20000
+    for (digest,) in cache.db.execute("select hash from blobs"):
+        assert os.path.getsize(cache.path(digest)) == 500
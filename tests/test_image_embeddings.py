@@ -1,7 +1,17 @@
+import numpy as np
+import pytest
 import torch
 from PIL import Image
-from cyto_ml.models.utils import flat_embeddings
-from cyto_ml.data.image import load_image, normalise_flowlr, prepare_image
+from cyto_ml.models.utils import batch_embeddings, flat_embeddings, image_embeddings
+from cyto_ml.data.image import (
+    convert_3_band,
+    load_image,
+    normalise_flowlr,
+    normalise_flowlr_batch,
+    pad_and_stack,
+    prepare_batch,
+    prepare_image,
+)
 
 
 def test_embeddings(resnet_model, single_image, greyscale_image):
@@ -21,9 +31,43 @@ def test_embeddings(resnet_model, single_image, greyscale_image):
     assert len(embeddings) == features.size()[1]
 
 
+def test_batch_embeddings(resnet_model, single_image, greyscale_image):
+    images = [Image.open(single_image), Image.open(greyscale_image)]
+    features = resnet_model(prepare_batch(images))
+    # One image's features at a time
+    with pytest.raises(ValueError):
+        flat_embeddings(features)
+
+    embeddings = batch_embeddings(resnet_model, prepare_batch(images))
+    assert embeddings.shape == (2, features.size()[1])
+    assert embeddings.dtype == np.float32
+
+    # Without padding, each row is what the image gets on its own
+    embeddings = batch_embeddings(resnet_model, prepare_batch(images, "resize_normalise"))
+    for image, row in zip([single_image, greyscale_image], embeddings):
+        alone = flat_embeddings(resnet_model(load_image(image, normalise_func="resize_normalise")))
+        assert np.allclose(row, alone, atol=1e-4)
+
+
+def test_image_embeddings(resnet_model, single_image, greyscale_image):
+    # Differently sized, in an order that interleaves the sizes
+    paths = [single_image, greyscale_image, single_image, greyscale_image, single_image]
+    images = [Image.open(path) for path in paths]
+    embeddings = image_embeddings(resnet_model, images, batch_size=2)
+    assert len(embeddings) == 5
+    assert embeddings.dtype == np.float32
+
+    # Each row is what the image gets on its own, whatever else is in the batch
+    for path, row in zip(paths, embeddings):
+        alone = flat_embeddings(resnet_model(load_image(path)))
+        assert np.allclose(row, alone, atol=1e-4)
+
+
 def test_normalise_flowlr(greyscale_image):
     # Normalise first, hand the tensorize function an array
     image = normalise_flowlr(Image.open(greyscale_image))
+    assert image.dtype == np.float32
+    assert image.max() == 1.0
     prepared_image = prepare_image(image)
 
     assert torch.all((prepared_image >= 0.0) & (prepared_image <= 1.0))
@@ -32,3 +76,20 @@ def test_normalise_flowlr(greyscale_image):
     prepared_image = prepare_image(Image.open(greyscale_image))
 
     assert torch.all((prepared_image >= 0.0) & (prepared_image <= 1.0))
+
+
+def test_normalise_flowlr_batch(greyscale_image):
+    image = Image.open(greyscale_image)
+    small = image.crop((0, 0, 100, 50))
+    batch = normalise_flowlr_batch([image, small])
+
+    assert batch.shape == (2, image.height, image.width)
+    assert np.array_equal(batch[0], normalise_flowlr(image))
+    assert np.array_equal(batch[1, :50, :100], normalise_flowlr(small))
+    assert not batch[1, 50:].any()
+
+    # The batched path gives what preparing each image and padding them does
+    batched = prepare_batch([image, small])
+    assert torch.equal(batched, pad_and_stack([prepare_image(image), prepare_image(small)]))
+    three_band = np.ascontiguousarray(convert_3_band(batch[0]))
+    assert torch.equal(prepare_image(image)[0], torch.from_numpy(three_band).permute(2, 0, 1))
@@ -23,6 +23,19 @@ def test_resnet50_endpoint():
     assert "embeddings" in doc
 
 
+def test_resnet50_batch_endpoint():
+    url = "https://cdn.oceanservice.noaa.gov/oceanserviceprod/facts/nasa-copepod.jpg"
+
+    params = {"urls": [url, url]}
+    response = client.post("/resnet50/batch/", data=params)
+
+    assert response.status_code == 200
+
+    doc = response.json()
+    assert len(doc["embeddings"]) == 2
+    assert len(doc["embeddings"][0]) == len(doc["embeddings"][1])
+
+
 def test_resnet18_endpoint():
     url = "https://cdn.oceanservice.noaa.gov/oceanserviceprod/facts/nasa-copepod.jpg"
 
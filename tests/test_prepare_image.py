@@ -1,7 +1,18 @@
 # test_prepare_image.py
 import pytest
 import torch
-from cyto_ml.data.image import load_image
+from PIL import Image
+from cyto_ml.data.image import (
+    ImageProcessingError,
+    Normalise,
+    load_image,
+    pad_and_stack,
+    prepare_batch,
+    prepare_image,
+    register_normalise,
+    resize_normalise,
+    same_size_batches,
+)
 
 # https://github.com/intake/intake-xarray/blob/d0418f787181d638629b76c2982a9a215a3697be/intake_xarray/image.py#L323
 
@@ -26,5 +37,65 @@ def test_greyscale_image(greyscale_image):
     assert torch.all((prepared_image >= 0.0) & (prepared_image <= 1.0))
 
 
+def test_prepare_batch(single_image, greyscale_image):
+    single = load_image(single_image)
+    greyscale = load_image(greyscale_image)
+    batch = prepare_batch([Image.open(single_image), Image.open(greyscale_image)])
+
+    # Padded to the largest height and width in the batch
+    height = max(single.shape[2], greyscale.shape[2])
+    width = max(single.shape[3], greyscale.shape[3])
+    assert batch.shape == torch.Size([2, 3, height, width])
+    assert torch.equal(batch[0, :, : single.shape[2], : single.shape[3]], single[0])
+    assert torch.all(batch[0, :, single.shape[2] :, :] == 0)
+
+    # Images resized to the same size need no padding
+    batch = prepare_batch([Image.open(single_image), Image.open(greyscale_image)], "resize_normalise")
+    assert batch.shape == torch.Size([2, 3, 256, 256])
+
+
+def test_resize_batch(single_image, greyscale_image):
+    # Resized and tensorised as one stacked array, the same as image by image
+    images = [Image.open(single_image), Image.open(single_image).rotate(90)]
+    batch = prepare_batch(images, "resize_normalise")
+    assert torch.allclose(batch, pad_and_stack([prepare_image(image, "resize_normalise") for image in images]))
+
+    prepared_image = load_image(greyscale_image, normalise_func="resize_normalise")
+    assert prepared_image.shape == torch.Size([1, 3, 256, 256])
+
+    # The function of the same name is the registered pipeline, still usable as a transform on its own
+    assert torch.equal(resize_normalise()(images[0]), prepare_image(images[0], "resize_normalise")[0])
+
+
+def test_same_size_batches(single_image, greyscale_image):
+    images = [Image.open(path) for path in [single_image, greyscale_image, single_image, single_image]]
+    assert list(same_size_batches(images, batch_size=2)) == [[0, 2], [3], [1]]
+    # Resized, they're all the same size
+    assert list(same_size_batches(images, "resize_normalise", batch_size=3)) == [[0, 1, 2], [3]]
+
+
+def test_register_normalise(single_image):
+    from torchvision import transforms
+
+    built = []
+
+    def standardise():
+        built.append(True)
+        return Normalise((224, 224), [transforms.Normalize([0.5, 0.5, 0.5], [0.25, 0.25, 0.25])])
+
+    register_normalise("test_standardise", standardise)
+    prepared_image = load_image(single_image, normalise_func="test_standardise")
+    assert prepared_image.shape == torch.Size([1, 3, 224, 224])
+    assert prepared_image.min() < 0
+
+    batch = prepare_batch([Image.open(single_image)] * 2, "test_standardise")
+    assert torch.allclose(batch[0], prepared_image[0])
+    # Built once, on first use
+    assert len(built) == 1
+
+    with pytest.raises(ImageProcessingError):
+        load_image(single_image, normalise_func="no_such_normalise")
+
+
 if __name__ == "__main__":
     pytest.main()
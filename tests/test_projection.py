@@ -0,0 +1,43 @@
+import numpy as np
+import pytest
+
+from cyto_ml.data.projection import Projection
+
+
+def test_fit_pca():
+    rng = np.random.default_rng(0)
+    # most of the variance is in the first 4 dimensions
+    matrix = (rng.standard_normal((500, 32)) * np.array([10] * 4 + [0.1] * 28)).astype(np.float32)
+    # uneven chunks, including ones shorter than the number of components
+    chunks = [matrix[:3], matrix[3:200], matrix[200:205], matrix[205:]]
+    projection = Projection.fit_pca(iter(chunks), dim=4)
+    assert projection.dim == 4
+    assert projection.input_dim == 32
+
+    reduced = projection.transform(matrix)
+    assert reduced.shape == (500, 4)
+    assert reduced.dtype == np.float32
+    # keeps nearly all of the variance
+    assert reduced.var(axis=0).sum() / matrix.var(axis=0).sum() > 0.99
+
+    with pytest.raises(ValueError):
+        Projection.fit_pca(iter([matrix[:3]]), dim=4)
+
+
+def test_random_projection():
+    projection = Projection.random(512, 64, seed=1)
+    assert np.array_equal(projection.components, Projection.random(512, 64, seed=1).components)
+
+    matrix = np.random.rand(100, 512).astype(np.float32)
+    reduced = projection.transform(matrix)
+    # roughly preserves lengths
+    ratio = np.linalg.norm(reduced, axis=1) / np.linalg.norm(matrix, axis=1)
+    assert 0.7 < ratio.mean() < 1.3
+
+
+def test_projection_bytes():
+    projection = Projection.random(16, 4)
+    restored = Projection.from_bytes(projection.to_bytes())
+    assert restored.method == "random"
+    assert np.array_equal(restored.components, projection.components)
+    assert np.array_equal(restored.mean, projection.mean)
@@ -0,0 +1,68 @@
+import numpy as np
+
+from cyto_ml.data.snapshot import is_fresh, load_snapshot, snapshot, write_snapshot
+from cyto_ml.data.vectorstore import vector_store
+
+
+def test_snapshot_round_trip(tmp_path):
+    store = vector_store("sqlite", f"{tmp_path}/tmp.db")
+    urls = [f"https://example.com/filename{i}.tif" for i in range(0, 10)]
+    embeddings = np.random.rand(10, 512).astype(np.float32)
+    store.add_many(urls, embeddings)
+
+    path = f"{tmp_path}/tmp.snapshot"
+    assert not is_fresh(store, path)
+    write_snapshot(store, path)
+    assert is_fresh(store, path)
+
+    matrix, ids = load_snapshot(path)
+    assert isinstance(matrix, np.memmap)
+    assert np.array_equal(matrix, embeddings)
+    assert list(ids) == urls
+
+
+def test_snapshot_invalidated_by_writes(tmp_path):
+    store = vector_store("sqlite", f"{tmp_path}/tmp.db")
+    path = f"{tmp_path}/tmp.snapshot"
+    matrix, ids = snapshot(store, path)
+    assert len(matrix) == len(ids) == 0
+
+    store.add("https://example.com/filename0.tif", list(np.random.rand(512)))
+    matrix, _ = snapshot(store, path)
+    assert matrix.shape == (1, 512)
+
+    # the row count changes, so the next call rewrites the snapshot
+    store.add("https://example.com/filename1.tif", list(np.random.rand(512)))
+    assert not is_fresh(store, path)
+    matrix, ids = snapshot(store, path)
+    assert matrix.shape == (2, 512)
+    assert ids[-1] == "https://example.com/filename1.tif"
+
+    # so does an embedding changed in place, which leaves the row count and last id alone
+    changed = np.random.rand(1, 512).astype(np.float32)
+    store.upsert_many(["https://example.com/filename0.tif"], changed, ["changed"])
+    assert not is_fresh(store, path)
+    matrix, _ = snapshot(store, path)
+    assert np.array_equal(matrix[0], changed[0])
+
+
+def test_snapshot_sized_by_rows_read(tmp_path, monkeypatch):
+    store = vector_store("sqlite", f"{tmp_path}/tmp.db", embedding_len=8)
+    store.register_model("resnet50", 16)
+    urls = [f"https://example.com/filename{i}.tif" for i in range(0, 10)]
+    embeddings = np.random.rand(10, 8).astype(np.float32)
+    store.add_many(urls, embeddings)
+    # a row with no default embedding isn't part of the snapshot, or its count
+    store.add("https://example.com/other.tif", list(np.random.rand(16)), model="resnet50")
+
+    path = f"{tmp_path}/tmp.snapshot"
+    matrix, ids = snapshot(store, path)
+    assert matrix.shape == (10, 8)
+    assert list(ids) == urls
+
+    # a row that loses its embedding between counting and reading
+    monkeypatch.setattr(store, "count", lambda: 11)
+    write_snapshot(store, path)
+    matrix, ids = load_snapshot(path)
+    assert matrix.shape == (10, 8)
+    assert np.array_equal(matrix, embeddings)
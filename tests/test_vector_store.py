@@ -1,14 +1,28 @@
 from cyto_ml.data.vectorstore import (
     vector_store,
+    register_backend,
     STORE,
+    HNSWStore,
+    InMemoryStore,
+    IVFPQStore,
+    ShardedStore,
     SQLiteVecStore,
     serialize_f32,
     deserialize,
 )
 
+from cyto_ml.data import vectorstore
+from cyto_ml.data.db_config import SCHEMA_VERSION
+
 import numpy as np
 import pytest
+import logging
 import math
+import sqlite3
+import sqlite_vec
+import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor
 
 
 @pytest.fixture
@@ -69,6 +83,15 @@ def test_queries(store_type, temp_dir):
     embeddings = store.embeddings()
     assert len(embeddings) == len(ids)
 
+    matrix, matrix_ids = store.embedding_matrix()
+    assert matrix.dtype == np.float32
+    assert matrix.shape[0] == len(matrix_ids)
+
+    # each row's own embedding is its nearest neighbour
+    close_ids, distances = store.closest_many(matrix[:3], k=2)
+    assert close_ids.shape == distances.shape == (3, 2)
+    assert list(close_ids[:, 0]) == list(matrix_ids[:3])
+
 
 def test_sqlite_store(temp_dir):
     store = vector_store("sqlite", f"{temp_dir}/tmp.db")
@@ -94,6 +117,767 @@ def test_closest_sqlite(temp_dir):
     assert len(close)
 
 
+def test_closest_sqlite_cosine(temp_dir):
+    store = vector_store("sqlite", f"{temp_dir}/tmp.db")
+    urls = [f"https://example.com/filename{i}.tif" for i in range(0, 20)]
+    embeddings = np.random.rand(20, 512).astype(np.float32)
+    store.add_many(urls, embeddings)
+
+    close = store.closest(urls[0], n_results=5)
+    assert len(close) == 5
+    # the query image is its own nearest neighbour, distances come back ascending
+    assert close[0][0] == urls[0]
+    distances = [distance for _, distance in close]
+    assert distances == sorted(distances)
+
+    # distance is cosine, not L2
+    normed = embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+    expected = 1 - normed @ normed[0]
+    assert math.isclose(close[1][1], np.sort(expected)[1], rel_tol=1e-4)
+
+    assert store.closest("https://example.com/missing.tif") is None
+
+
+def test_migrate_legacy_sqlite(temp_dir):
+    """Databases made before the cosine metric was declared get rebuilt from images"""
+    db_name = f"{temp_dir}/legacy.db"
+    db = sqlite3.connect(db_name)
+    db.enable_load_extension(True)
+    sqlite_vec.load(db)
+    db.execute("create table images (id integer primary key, url text not null, classification text not null, embedding blob)")
+    db.execute("create virtual table images_vec using vec0(id integer primary key, embedding float[512])")
+    for i in range(0, 5):
+        vec = serialize_f32(list(np.random.rand(512)))
+        db.execute("insert into images values (?, ?, '', ?)", [i + 1, f"https://example.com/filename{i}.tif", vec])
+        db.execute("insert into images_vec values (?, ?)", [i + 1, vec])
+    # nothing stopped the same url being added twice
+    vec = serialize_f32(list(np.random.rand(512)))
+    db.execute("insert into images values (6, 'https://example.com/filename0.tif', '', ?)", [vec])
+    db.execute("insert into images_vec values (6, ?)", [vec])
+    db.commit()
+    db.close()
+
+    store = SQLiteVecStore(db_name)
+    assert store.schema_version() == 0
+    assert store.pending_migrations() == [
+        "cosine_metric",
+        "content_hash",
+        "unique_url",
+        "filter_columns",
+        "single_copy",
+    ]
+    assert store.migrate()
+    assert not store.needs_migration()
+    assert not store.migrate()
+    assert store.schema_version() == SCHEMA_VERSION
+    assert "embedding" not in store._table_sql("images")
+
+    close = store.closest("https://example.com/filename0.tif", n_results=5)
+    # the duplicated url is down to its most recent row
+    assert len(close) == 5
+    assert close[0][0] == "https://example.com/filename0.tif"
+    assert store.count() == 5
+    assert store.get("https://example.com/filename0.tif") == vec
+    with pytest.raises(sqlite3.IntegrityError):
+        store.add("https://example.com/filename0.tif", list(np.random.rand(512)))
+
+
+def test_single_copy_sqlite(temp_dir):
+    """Embeddings are only held in images_vec, and read back from there"""
+    store = SQLiteVecStore(f"{temp_dir}/single.db", embedding_len=16)
+    assert store.schema_version() == SCHEMA_VERSION
+    assert "embedding" not in store._table_sql("images")
+
+    rng = np.random.default_rng(42)
+    embeddings = rng.random((2500, 16), dtype=np.float32)
+    urls = [f"https://example.com/filename{i}.tif" for i in range(0, 2500)]
+    store.add_many(urls, embeddings)
+    # spans several vec0 chunks, and reads back in row order
+    matrix, ids = store.embedding_matrix()
+    assert np.array_equal(matrix, embeddings)
+    assert list(ids) == urls
+    assert np.array_equal(np.concatenate([m for m, _ in store.iter_embeddings(chunk_size=700)]), embeddings)
+    assert np.array_equal(store.get_many([urls[2000], urls[3]]), embeddings[[2000, 3]])
+    assert store.get(urls[1]) == embeddings[1].tobytes()
+    assert store.get("https://example.com/missing.tif") is None
+    with pytest.raises(ValueError, match="missing.tif"):
+        store.get_many([urls[0], "https://example.com/missing.tif"])
+
+    # a changed row moves within images_vec
+    store.upsert_many([urls[3]], embeddings[[4]], ["changed"])
+    assert np.array_equal(store.embedding_matrix()[0][3], embeddings[4])
+
+
+def test_models_sqlite(temp_dir):
+    """Several models' embeddings of the same images, each compared in its own space"""
+    rng = np.random.default_rng(42)
+    small = rng.random((50, 8), dtype=np.float32)
+    large = rng.random((50, 32), dtype=np.float32)
+    urls = [f"https://example.com/filename{i}.tif" for i in range(0, 50)]
+
+    store = SQLiteVecStore(f"{temp_dir}/models.db", embedding_len=8)
+    store.register_model("resnet50", 32)
+    store.register_model("resnet50", 32)
+    assert store.models() == {"default": 8, "resnet50": 32}
+    with pytest.raises(ValueError):
+        store.register_model("resnet50", 64)
+    with pytest.raises(ValueError):
+        store.register_model("resnet 50", 32)
+    with pytest.raises(ValueError):
+        store.closest(urls[0], model="missing")
+
+    assert store.upsert_many(urls, small, ["a"] * 50)["new"] == urls
+    # the same images, so no new rows
+    assert store.upsert_many(urls, large, ["a"] * 50, model="resnet50")["new"] == urls
+    assert store.count() == 50
+    assert store.upsert_many(urls, large, ["a"] * 50, model="resnet50")["unchanged"] == urls
+
+    assert np.array_equal(store.embedding_matrix()[0], small)
+    assert np.array_equal(store.embedding_matrix("resnet50")[0], large)
+    assert store.dimensions("resnet50") == 32
+
+    normed = large / np.linalg.norm(large, axis=1, keepdims=True)
+    expected = np.argsort(1 - normed @ normed[0])[:5]
+    assert [url for url, _ in store.closest(urls[0], n_results=5, model="resnet50")] == [urls[i] for i in expected]
+    assert store.closest(urls[0], n_results=5) != store.closest(urls[0], n_results=5, model="resnet50")
+
+    # a changed image drops the other model's embedding until it's written again
+    store.upsert_many(urls[:1], small[1:2], ["b"])
+    assert urls[0] not in store.content_hashes("resnet50")
+    assert store.upsert_many(urls[:1], large[1:2], ["b"], model="resnet50")["new"] == urls[:1]
+    assert store.content_hashes("resnet50")[urls[0]] == "b"
+
+    # an image can arrive through any model first
+    store.add("https://example.com/late.tif", list(large[2]), model="resnet50")
+    assert store.get("https://example.com/late.tif") is None
+    store.add("https://example.com/late.tif", list(small[2]))
+    assert store.get("https://example.com/late.tif") == small[2].tobytes()
+    with pytest.raises(sqlite3.IntegrityError):
+        store.add("https://example.com/late.tif", list(small[2]))
+
+
+def test_default_embedding_rows_sqlite(temp_dir):
+    """Rows only another model has embedded are left out of anything that reads the default embeddings"""
+    rng = np.random.default_rng(42)
+    small = rng.random((40, 8), dtype=np.float32)
+    large = rng.random((40, 32), dtype=np.float32)
+    urls = [f"https://example.com/filename{i}.tif" for i in range(0, 40)]
+
+    store = SQLiteVecStore(f"{temp_dir}/models.db", embedding_len=8)
+    store.register_model("resnet50", 32)
+    store.add_many(urls[:30], small[:30])
+    store.fit_projection(dim=4, method="random")
+    # embedded by the other model first
+    store.add_many(urls[30:], large[30:], model="resnet50")
+
+    assert store.count() == 30
+    assert store.fingerprint()[:2] == (30, 30)
+    assert set(store.sample(40)) == set(urls[:30])
+    assert len(store.embedding_matrix()[1]) == store.count()
+
+    # and once they have a default embedding, they're projected as well
+    store.add_many(urls[30:35], small[30:35])
+    store.upsert_many(urls[35:], small[35:], ["a"] * 5)
+    assert store.count() == 40
+    assert set(store.sample(40)) == set(urls)
+    matrix, ids = store.reduced_matrix()
+    assert list(ids) == urls
+    assert np.allclose(matrix, store.projection().transform(small), atol=1e-6)
+
+
+def test_int8_sqlite(temp_dir):
+    rng = np.random.default_rng(42)
+    embeddings = rng.random((200, 16), dtype=np.float32)
+    urls = [f"https://example.com/filename{i}.tif" for i in range(0, 200)]
+
+    exact = SQLiteVecStore(f"{temp_dir}/float.db", embedding_len=16)
+    exact.add_many(urls, embeddings)
+    store = SQLiteVecStore(f"{temp_dir}/int8.db", embedding_len=16, precision="int8")
+    store.add_many(urls, embeddings)
+    assert store.precision == "int8"
+    # reopened with the default, the db keeps its precision
+    assert SQLiteVecStore(f"{temp_dir}/int8.db", embedding_len=16).precision == "int8"
+
+    # only the direction is kept
+    matrix, _ = store.embedding_matrix()
+    assert np.allclose(matrix, embeddings / embeddings.max(axis=1, keepdims=True), atol=1 / 127)
+    close = store.closest(urls[0], n_results=10)
+    assert close[0][0] == urls[0]
+    assert len({url for url, _ in close} & {url for url, _ in exact.closest(urls[0], n_results=10)}) >= 8
+    assert store.closest(urls[0], n_results=5, where={"classification": ""})[0][0] == urls[0]
+
+    store.upsert_many([urls[1]], embeddings[[2]], ["changed"])
+    assert {url for url, _ in store.closest(urls[1], n_results=2)} == {urls[1], urls[2]}
+
+    # converting keeps every row
+    assert exact.set_precision("int8")
+    assert not exact.set_precision("int8")
+    assert exact.count() == 200
+    assert np.allclose(exact.embedding_matrix()[0], matrix, atol=1 / 127)
+    with pytest.raises(ValueError):
+        SQLiteVecStore(f"{temp_dir}/float16.db", precision="float16")
+
+
+def test_sqlite_concurrent_readers(temp_dir):
+    store = vector_store("sqlite", f"{temp_dir}/tmp.db", check_same_thread=False, read_pool_size=3)
+    assert store.db.execute("pragma journal_mode").fetchone()[0] == "wal"
+    urls = [f"https://example.com/filename{i}.tif" for i in range(0, 50)]
+    store.add_many(urls, np.random.rand(50, 512).astype(np.float32))
+
+    def browse(i):
+        # reads on pooled connections, interleaved with writes on the writer
+        if i % 5 == 0:
+            store.add(f"https://example.com/new{i}.tif", list(np.random.rand(512)))
+        return store.closest(urls[i % 50], n_results=5)[0][0]
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        results = list(pool.map(browse, range(0, 100)))
+    assert results == [urls[i % 50] for i in range(0, 100)]
+    # never opens more readers than the pool allows
+    assert store._reader_count <= 3
+    assert len(store.ids()) == 70
+
+    # pooled connections are read-only
+    with store.reader() as db:
+        with pytest.raises(sqlite3.OperationalError):
+            db.execute("delete from images")
+    store.close()
+
+
+def test_sqlite_concurrent_writers(temp_dir):
+    """Processes adding to the same db at once don't give two rows the same id"""
+    vector_store("sqlite", f"{temp_dir}/tmp.db", embedding_len=8)
+    code = """
+import sys
+import numpy as np
+from cyto_ml.data.vectorstore import vector_store
+store = vector_store("sqlite", sys.argv[1], embedding_len=8)
+for i in range(0, 50):
+    store.add_many([f"https://example.com/{sys.argv[2]}_{i}_{j}.tif" for j in range(0, 4)], np.random.rand(4, 8))
+"""
+    writers = [subprocess.Popen([sys.executable, "-c", code, f"{temp_dir}/tmp.db", name]) for name in "abc"]
+    assert [writer.wait(timeout=120) for writer in writers] == [0, 0, 0]
+    store = vector_store("sqlite", f"{temp_dir}/tmp.db", embedding_len=8)
+    assert store.count() == 600
+    assert len(set(store.ids())) == 600
+
+
+def test_upsert_sqlite(temp_dir):
+    store = vector_store("sqlite", f"{temp_dir}/tmp.db")
+    urls = [f"https://example.com/filename{i}.tif" for i in range(0, 10)]
+    embeddings = np.random.rand(10, 512).astype(np.float32)
+    hashes = [f"hash{i}" for i in range(0, 10)]
+    report = store.upsert_many(urls, embeddings, hashes, classifications=["diatom"] * 10)
+    assert report == {"new": urls, "changed": [], "unchanged": []}
+    assert store.content_hashes() == dict(zip(urls, hashes))
+
+    # rerun with two images changed and two new ones
+    writes = store.writes
+    urls = urls + ["https://example.com/new0.tif", "https://example.com/new1.tif"]
+    embeddings = np.concatenate([embeddings, np.random.rand(2, 512).astype(np.float32)])
+    embeddings[3] = np.random.rand(512)
+    hashes = hashes + ["new0", "new1"]
+    hashes[3], hashes[7] = "changed3", "changed7"
+    report = store.upsert_many(urls, embeddings, hashes)
+    assert report["new"] == urls[10:]
+    assert report["changed"] == [urls[3], urls[7]]
+    assert len(report["unchanged"]) == 8
+    assert store.writes == writes + 1
+
+    assert store.count() == 12
+    assert store.content_hashes()[urls[3]] == "changed3"
+    # the index follows the updated embedding, and classifications weren't overwritten
+    assert np.array_equal(store.get_many([urls[3]])[0], embeddings[3])
+    assert store.closest(urls[3], n_results=1)[0][0] == urls[3]
+    assert len(store.labelled("diatom")) == 10
+
+    # nothing to do second time round
+    writes = store.writes
+    report = store.upsert_many(urls, embeddings, hashes)
+    assert len(report["unchanged"]) == 12
+    assert store.writes == writes
+
+
+def test_closest_where_sqlite(temp_dir):
+    store = vector_store("sqlite", f"{temp_dir}/tmp.db")
+    # coordinates, date and session in the filename, as in the flowcam collections
+    urls = [
+        f"https://example.com/flowcam/sample_{50 + i % 2}.0_-3.5_0{i % 3 + 1}052023_{i % 4}_{i}.tif" for i in range(0, 60)
+    ]
+    classifications = ["copepod" if i % 5 == 0 else "detritus" for i in range(0, 60)]
+    store.add_many(urls, np.random.rand(60, 512).astype(np.float32), classifications)
+
+    close = store.closest(urls[1], n_results=5, where={"classification": "copepod"})
+    assert len(close) == 5
+    assert all(classifications[urls.index(url)] == "copepod" for url, _ in close)
+
+    # conditions on several columns are combined, and each returns as many results as match
+    where = {"date": {"$gte": "2023-05-02"}, "lat": 51.0, "session": {"$in": ["1", "3"]}}
+    close = store.closest(urls[0], n_results=50, where=where)
+    expected = {url for i, url in enumerate(urls) if i % 3 >= 1 and i % 2 == 1}
+    assert {url for url, _ in close} == expected
+
+    # the filter is part of the cache key
+    assert len(store.closest(urls[0], n_results=50)) == 50
+    ids, _ = store.closest_by_vector(store.get_many([urls[0]])[0], k=5, where={"classification": "copepod"})
+    assert list(ids) == [url for url, _ in store.closest(urls[0], n_results=5, where={"classification": "copepod"})]
+
+    with pytest.raises(ValueError):
+        store.closest(urls[0], where={"embedding": "anything"})
+
+    # the id set comes from an index, not a scan of images
+    with store.reader() as db:
+        plan = db.execute("explain query plan select id from images where classification = ?", ["copepod"]).fetchall()
+    assert "images_classification" in str(plan)
+
+
+def test_knn_graph_sqlite(temp_dir):
+    # low dimensional, so neighbours aren't near-ties that float32 rounding could reorder
+    store = vector_store("sqlite", f"{temp_dir}/tmp.db", embedding_len=8)
+    urls = [f"https://example.com/filename{i}.tif" for i in range(0, 120)]
+    embeddings = np.random.default_rng(1).standard_normal((120, 8), dtype=np.float32)
+    store.add_many(urls[:100], embeddings[:100])
+
+    with pytest.raises(ValueError):
+        store.update_knn()
+    assert store.build_knn(depth=10, chunk_size=16, workers=2) == 100
+    live = [store._knn(store.get(url), 10) for url in urls[:100]]
+    # served from the graph, matching the live query
+    for url, expected in zip(urls[:100], live):
+        graph = store._graph_neighbours(url, 10)
+        assert [u for u, _ in graph] == [u for u, _ in expected]
+        assert np.allclose([d for _, d in graph], [d for _, d in expected], atol=1e-5)
+        assert store.closest(url, n_results=10) == graph
+    # deeper than the graph goes, so queried live
+    assert len(store.closest(urls[0], n_results=20)) == 20
+
+    # new rows get lists of their own, and join the existing lists they belong in
+    store.add_many(urls[100:], embeddings[100:])
+    assert store._graph_neighbours(urls[100], 10) == []
+    store.update_knn(chunk_size=8)
+    for url in urls:
+        graph = store._graph_neighbours(url, 10)
+        assert [u for u, _ in graph] == [u for u, _ in store._knn(store.get(url), 10)]
+
+    # a near duplicate added after the graph was built is found straight away, by a live query
+    # (not an exact one, which would tie with urls[0] in the comparisons below)
+    store.add("https://example.com/duplicate.tif", list(embeddings[0] + 0.01 * embeddings[1]))
+    assert store._graph_neighbours(urls[0], 10) == []
+    assert "https://example.com/duplicate.tif" in [u for u, _ in store.closest(urls[0], n_results=10)]
+    store.update_knn()
+    graph = store._graph_neighbours(urls[0], 10)
+    assert "https://example.com/duplicate.tif" in [u for u, _ in graph]
+    assert store.closest(urls[0], n_results=10) == graph
+
+    # changing an embedding drops the lists it's part of until they're recomputed
+    changed = np.random.default_rng(2).standard_normal((1, 8), dtype=np.float32)
+    store.upsert_many([urls[5]], changed, ["changed"])
+    assert store._graph_neighbours(urls[5], 10) == []
+    store.update_knn()
+    for url in urls:
+        graph = store._graph_neighbours(url, 10)
+        assert [u for u, _ in graph] == [u for u, _ in store._knn(store.get(url), 10)]
+
+    # chunks sized from a memory budget, here a row at a time, give the same graph
+    before = [store._graph_neighbours(url, 10) for url in urls]
+    assert store.build_knn(depth=10, workers=2, memory=1) == 121
+    assert [[u for u, _ in store._graph_neighbours(url, 10)] for url in urls] == [[u for u, _ in b] for b in before]
+
+
+def test_projection_sqlite(temp_dir):
+    db_name = f"{temp_dir}/tmp.db"
+    store = vector_store("sqlite", db_name, embedding_len=128)
+    urls = [f"https://example.com/filename{i}.tif" for i in range(0, 300)]
+    # structure in a few directions, as with real embeddings
+    rng = np.random.default_rng(0)
+    embeddings = (rng.standard_normal((300, 8)) @ rng.standard_normal((8, 128))).astype(np.float32)
+    store.add_many(urls[:250], embeddings[:250])
+
+    with pytest.raises(ValueError):
+        store.closest_reduced(urls[0])
+    store.fit_projection(dim=16, method="pca", chunk_size=100)
+    # rows added after fitting are projected too
+    store.add_many(urls[250:], embeddings[250:])
+    matrix, ids = store.reduced_matrix()
+    assert matrix.shape == (300, 16)
+    assert list(ids) == urls
+
+    # coarse search then exact re-ranking finds the same neighbours as exact search
+    for url in urls[::30]:
+        exact = store.closest(url, n_results=10)
+        reranked = store.closest_reduced(url, n_results=10, candidates=40)
+        assert [u for u, _ in reranked] == [u for u, _ in exact]
+        assert np.allclose([d for _, d in reranked], [d for _, d in exact], atol=1e-4)
+
+    # the projection is kept with the collection
+    reopened = SQLiteVecStore(db_name)
+    assert np.array_equal(reopened.projection().components, store.projection().components)
+    store.fit_projection(dim=8, method="random")
+    assert store.reduced_matrix()[0].shape == (300, 8)
+
+
+def test_closest_many_sqlite(temp_dir):
+    store = vector_store("sqlite", f"{temp_dir}/tmp.db")
+    urls = [f"https://example.com/filename{i}.tif" for i in range(0, 200)]
+    embeddings = np.random.rand(200, 512).astype(np.float32)
+    store.add_many(urls, embeddings)
+
+    # the in-memory block search agrees with the vec0 index, whatever the chunking
+    ids, distances = store.closest_many(embeddings[:30], k=10, chunk_size=7)
+    assert ids.shape == distances.shape == (30, 10)
+    assert distances.dtype == np.float32
+    assert np.all(np.diff(distances, axis=1) >= 0)
+    for i in range(0, 30):
+        close = store.closest(urls[i], n_results=10)
+        assert list(ids[i]) == [url for url, _ in close]
+        assert np.allclose(distances[i], [distance for _, distance in close], atol=1e-5)
+
+    by_vector, vector_distances = store.closest_by_vector(embeddings[5], k=10)
+    assert list(by_vector) == list(ids[5])
+    assert np.allclose(vector_distances, distances[5], atol=1e-5)
+
+    # k larger than the collection
+    ids, _ = store.closest_many(embeddings[:2], k=500)
+    assert ids.shape == (2, 200)
+
+
+def test_memory_store(temp_dir):
+    store = vector_store("memory", embedding_len=64, capacity=4)
+    urls = [f"https://example.com/filename{i}.tif" for i in range(0, 50)]
+    embeddings = np.random.rand(50, 64).astype(np.float32)
+    store.add_many(urls[:3], embeddings[:3], ["diatom"] * 3)
+    for url, embedding in zip(urls[3:], embeddings[3:]):
+        store.add(url, list(embedding))
+    # grew by doubling as rows went in
+    assert len(store.vectors) == 64
+    assert store.ids() == urls
+    assert np.allclose(np.linalg.norm(store.embedding_matrix()[0], axis=1), 1)
+    with pytest.raises(ValueError):
+        store.add(urls[0], list(embeddings[0]))
+
+    normed = embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+    exact = np.argsort(1 - normed @ normed[7])[:10]
+    close = store.closest(urls[7], n_results=10)
+    assert [url for url, _ in close] == [urls[i] for i in exact]
+    ids, _ = store.closest_many(embeddings[:5], k=10)
+    assert list(ids[:, 0]) == urls[:5]
+    assert store.labelled("diatom") == urls[:3]
+
+    # loads an existing sqlite collection, with its classifications
+    sqlite_store = vector_store("sqlite", f"{temp_dir}/tmp.db", embedding_len=64)
+    sqlite_store.add_many(urls, embeddings, ["diatom"] * 10 + ["detritus"] * 40)
+    loaded = vector_store("memory", f"{temp_dir}/tmp.db")
+    assert loaded.ids() == urls
+    # sized for the collection up front, rather than doubling past it
+    assert loaded.vectors.shape == (50, 64)
+    assert sorted(loaded.classes()) == ["detritus", "diatom"]
+    assert [url for url, _ in loaded.closest(urls[7], n_results=10)] == [
+        url for url, _ in sqlite_store.closest(urls[7], n_results=10)
+    ]
+    copied = InMemoryStore.from_store(sqlite_store)
+    assert copied.vectors.shape == (50, 64)
+    assert np.array_equal(copied.embedding_matrix()[0], loaded.embedding_matrix()[0])
+
+
+def test_add_many_sqlite(temp_dir):
+    store = vector_store("sqlite", f"{temp_dir}/tmp.db")
+    urls = [f"https://example.com/filename{i}.tif" for i in range(0, 25)]
+    embeddings = np.random.rand(25, 512).astype(np.float32)
+    # small chunks so the transaction boundary gets exercised
+    added = store.add_many(urls, embeddings, chunk_size=10)
+    assert added == 25
+    assert store.ids() == urls
+
+    # the single row path still works alongside the bulk one
+    store.add("https://example.com/single.tif", list(np.random.rand(512)))
+    assert len(store.ids()) == 26
+
+    # images and images_vec stay linked by id
+    close = store.closest(urls[3], n_results=1)
+    assert close[0][0] == urls[3]
+
+    with pytest.raises(ValueError):
+        store.add_many(urls, embeddings[:5])
+
+
+def test_embedding_matrix_sqlite(temp_dir):
+    store = vector_store("sqlite", f"{temp_dir}/tmp.db")
+    matrix, ids = store.embedding_matrix()
+    assert matrix.shape == (0, 512)
+
+    urls = [f"https://example.com/filename{i}.tif" for i in range(0, 10)]
+    embeddings = np.random.rand(10, 512).astype(np.float32)
+    store.add_many(urls, embeddings)
+
+    matrix, ids = store.embedding_matrix()
+    assert matrix.shape == (10, 512)
+    assert matrix.dtype == np.float32
+    assert matrix.flags["C_CONTIGUOUS"]
+    assert list(ids) == urls
+    assert np.array_equal(matrix, embeddings)
+
+
+@pytest.mark.parametrize("precision", ["float32", "int8"])
+def test_vec0_layout_sqlite(temp_dir, precision, monkeypatch, caplog):
+    rng = np.random.default_rng(42)
+    embeddings = rng.random((300, 16), dtype=np.float32)
+    urls = [f"https://example.com/filename{i}.tif" for i in range(0, 300)]
+    store = SQLiteVecStore(f"{temp_dir}/chunked.db", embedding_len=16, precision=precision)
+    # Nothing to compare yet, so not decided
+    assert store._chunked()
+    assert "images_vec" not in store._layouts
+    store.add_many(urls, embeddings)
+    assert store._chunked()
+    assert store._layouts["images_vec"]
+    # No shadow tables to read
+    assert store._check_layout("images", precision) is False
+
+    # Shadow tables with the columns we read, whose chunk holds something other than what vec0 returns
+    store.db.execute("create table fake_rowids(rowid integer primary key, id, chunk_id, chunk_offset)")
+    store.db.execute("create table fake_vector_chunks00(rowid integer primary key, vectors blob)")
+    store.db.execute("create table fake(id integer primary key, embedding blob)")
+    store.db.execute("insert into fake_rowids values (1, null, 1, 1)")
+    store.db.execute("insert into fake_vector_chunks00 values (1, ?)", [b"abcdefgh"])
+    store.db.execute("insert into fake values (1, ?)", [b"efgh"])
+    assert store._check_layout("fake", precision) is True
+    store.db.execute("update fake set embedding = ?", [b"abcd"])
+    assert store._check_layout("fake", precision) is False
+    store.db.rollback()
+
+    # As if sqlite-vec had laid its shadow tables out some other way: read through vec0 instead
+    monkeypatch.setattr(SQLiteVecStore, "_check_layout", lambda self, table, precision: False)
+    with caplog.at_level(logging.WARNING):
+        fallback = SQLiteVecStore(f"{temp_dir}/chunked.db", embedding_len=16)
+    assert "isn't laid out as sqlite-vec 0.1 does" in caplog.text
+    assert not fallback._chunked()
+    assert fallback.count() == 300
+    # both paths read the same matrix
+    assert np.array_equal(fallback.embedding_matrix()[0], store.embedding_matrix()[0])
+    assert list(fallback.embedding_matrix()[1]) == list(store.embedding_matrix()[1])
+    chunks = list(fallback.iter_embeddings(chunk_size=128))
+    assert np.array_equal(np.concatenate([matrix for matrix, _ in chunks]), store.embedding_matrix()[0])
+    assert list(np.concatenate([ids for _, ids in chunks])) == urls
+    with pytest.raises(sqlite3.IntegrityError):
+        fallback.add_many(urls[:1], embeddings[:1])
+    fallback.upsert_many(urls[:2] + ["https://example.com/new.tif"], embeddings[[5, 6, 7]], ["a", "b", "c"])
+    assert fallback.count() == 301
+    assert np.array_equal(fallback.embedding_matrix()[0], store.embedding_matrix()[0])
+    assert np.allclose(fallback.get_many(urls[:2]), store.embedding_matrix()[0][[5, 6]])
+
+
+def test_sharded_store(temp_dir):
+    store = vector_store("sharded", f"{temp_dir}/tmp.db", n_shards=3)
+    assert isinstance(store, ShardedStore)
+    urls = [f"https://example.com/filename{i}.tif" for i in range(0, 60)]
+    embeddings = np.random.rand(60, 512).astype(np.float32)
+    assert store.add_many(urls, embeddings) == 60
+
+    # every shard got a share, and each url always maps to the same one
+    assert all(len(shard.ids()) for shard in store.shards)
+    assert sorted(store.ids()) == sorted(urls)
+    assert store.shard(urls[0]) is store.shard(urls[0])
+
+    # merged results match a single unsharded store
+    single = vector_store("sqlite", f"{temp_dir}/single.db")
+    single.add_many(urls, embeddings)
+    close = store.closest(urls[0], n_results=10)
+    assert [url for url, _ in close] == [url for url, _ in single.closest(urls[0], n_results=10)]
+
+    matrix, ids = store.embedding_matrix()
+    assert matrix.shape == (60, 512)
+    assert sorted(ids) == sorted(urls)
+
+    # rows as lists, like the other stores take
+    more = [f"https://example.com/more{i}.tif" for i in range(0, 6)]
+    assert store.add_many(more, np.random.rand(6, 512).tolist()) == 6
+    report = store.upsert_many(more[:3], embeddings[:3].tolist(), ["a", "b", "c"])
+    assert sorted(report["changed"]) == sorted(more[:3])
+    assert np.allclose(store.shard(more[0]).get_many(more[:1]), embeddings[:1])
+
+
+def test_hnsw_store(temp_dir):
+    db_name = f"{temp_dir}/hnsw.pkl"
+    store = vector_store("hnsw", db_name, embedding_len=32, M=8, ef_construction=100)
+    assert isinstance(store, HNSWStore)
+
+    urls = [f"https://example.com/filename{i}.tif" for i in range(0, 300)]
+    embeddings = np.random.default_rng(0).random((300, 32), dtype=np.float32)
+    store.add_many(urls, embeddings)
+
+    # compare against exact cosine search
+    normed = embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+    recalls = []
+    for i in range(0, 20):
+        exact = set(np.argsort(1 - normed @ normed[i])[:10])
+        close = store.closest(urls[i], n_results=10, ef_search=100)
+        assert close[0][0] == urls[i]
+        recalls.append(len(exact & {urls.index(url) for url, _ in close}) / 10)
+    assert np.mean(recalls) > 0.9
+
+    ids, distances = store.closest_many(embeddings[:20], k=10, ef_search=100)
+    assert ids.shape == distances.shape == (20, 10)
+    assert list(ids[:, 0]) == urls[:20]
+    assert list(store.closest_by_vector(embeddings[3], k=10)[0]) == [url for url, _ in store.closest(urls[3], 10)]
+
+    with pytest.raises(ValueError):
+        store.add(urls[0], list(embeddings[0]))
+
+    # persists, and keeps accepting inserts after reloading
+    store.save()
+    reloaded = vector_store("hnsw", db_name)
+    assert reloaded.ids() == urls
+    assert reloaded.closest(urls[5], n_results=10) == store.closest(urls[5], n_results=10)
+    reloaded.add("https://example.com/new.tif", list(np.random.rand(32)))
+    assert reloaded.closest("https://example.com/new.tif", n_results=1)[0][0] == "https://example.com/new.tif"
+
+
+def test_ivfpq_store(temp_dir):
+    source = vector_store("sqlite", f"{temp_dir}/tmp.db", embedding_len=32)
+    urls = [f"https://example.com/filename{i}.tif" for i in range(0, 600)]
+    embeddings = np.random.default_rng(0).random((600, 32), dtype=np.float32)
+    source.add_many(urls, embeddings)
+
+    db_name = f"{temp_dir}/ivfpq.pkl"
+    store = IVFPQStore.from_store(source, db_name, n_lists=4, n_subvectors=8)
+    assert store.ids() == urls
+    # one byte per subvector
+    assert store.index.codes.shape == (600, 8)
+    assert store.index.codes.dtype == np.uint8
+
+    normed = embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+    exact = [set(np.argsort(1 - normed @ normed[i])[:10]) for i in range(0, 20)]
+
+    def recall(**kwargs):
+        found = [{urls.index(url) for url, _ in store.closest(urls[i], n_results=10, **kwargs)} for i in range(0, 20)]
+        return np.mean([len(f & e) / 10 for f, e in zip(found, exact)])
+
+    approximate = recall(nprobe=4)
+    reranked = recall(nprobe=4, rerank=50)
+    assert reranked >= approximate
+    assert reranked > 0.9
+
+    # Reconstructions are close to the unit vectors they encode
+    assert np.mean(np.sum(store.embedding_matrix()[0] * normed, axis=1)) > 0.95
+
+    store.save()
+    reloaded = vector_store("ivfpq", db_name, source=source)
+    assert reloaded.closest(urls[0], n_results=5) == store.closest(urls[0], n_results=5)
+
+    # added a few at a time, into each cell's postings, it's the same index
+    piecemeal = IVFPQStore(f"{temp_dir}/piecemeal.pkl", embedding_len=32, n_lists=4, n_subvectors=8, source=source)
+    piecemeal.index.centroids, piecemeal.index.codebooks = store.index.centroids, store.index.codebooks
+    for offset in range(0, 600, 7):
+        piecemeal.add_many(urls[offset : offset + 7], embeddings[offset : offset + 7])
+        piecemeal.closest(urls[0], n_results=5)
+    assert np.array_equal(piecemeal.index.codes, store.index.codes)
+    for i in range(0, 20):
+        assert piecemeal.closest(urls[i], n_results=10, nprobe=2) == store.closest(urls[i], n_results=10, nprobe=2)
+
+
+def test_iterate_sqlite(temp_dir):
+    store = vector_store("sqlite", f"{temp_dir}/tmp.db")
+    assert store.count() == 0
+    assert store.sample(5) == []
+
+    urls = [f"https://example.com/filename{i}.tif" for i in range(0, 25)]
+    embeddings = np.random.rand(25, 512).astype(np.float32)
+    store.add_many(urls, embeddings)
+    assert store.count() == 25
+
+    chunks = list(store.iter_ids(chunk_size=10))
+    assert [len(chunk) for chunk in chunks] == [10, 10, 5]
+    assert list(np.concatenate(chunks)) == urls
+
+    matrices, ids = zip(*store.iter_embeddings(chunk_size=10))
+    assert np.array_equal(np.concatenate(matrices), embeddings)
+    assert list(np.concatenate(ids)) == urls
+
+    sample = store.sample(10)
+    assert len(sample) == len(set(sample)) == 10
+    assert set(sample) <= set(urls)
+    # asking for more than there is returns everything
+    assert sorted(store.sample(100)) == sorted(urls)
+    # only rows added since a fingerprint was taken
+    _, last_id, _ = store.fingerprint()
+    store.add_many(["https://example.com/new.tif"], embeddings[:1])
+    assert [list(ids) for _, ids in store.iter_embeddings(after=last_id)] == [["https://example.com/new.tif"]]
+
+
+@pytest.mark.skipif(not hasattr(sqlite3.Connection, "setlimit"), reason="Connection.setlimit is python 3.11+")
+def test_sample_large_sqlite():
+    """More candidate ids than sqlite allows bound parameters - 32766 by default, lowered here"""
+    store = vector_store("sqlite", ":memory:", embedding_len=2)
+    store.db.setlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER, 1000)
+    urls = [f"https://example.com/filename{i}.tif" for i in range(0, 3000)]
+    store.add_many(urls, np.random.rand(3000, 2).astype(np.float32))
+    sample = store.sample(1500)
+    assert len(set(sample)) == 1500
+
+
+def test_closest_cache_sqlite(temp_dir):
+    store = vector_store("sqlite", f"{temp_dir}/tmp.db")
+    urls = [f"https://example.com/filename{i}.tif" for i in range(0, 10)]
+    embeddings = np.random.rand(10, 512).astype(np.float32)
+    store.add_many(urls, embeddings)
+
+    first = store.closest(urls[0], n_results=5)
+    # callers can modify what they get back without spoiling the cache
+    first.pop()
+    second = store.closest(urls[0], n_results=5)
+    assert len(second) == 5
+    assert store.cache.stats()["hits"] == 1
+    assert store.cache.stats()["misses"] == 1
+
+    # a different k is a different query
+    store.closest(urls[0], n_results=3)
+    assert store.cache.stats()["misses"] == 2
+
+    # a write moves the generation on, so the next lookup is recomputed and sees the new row
+    store.add("https://example.com/twin.tif", list(embeddings[0]))
+    third = store.closest(urls[0], n_results=5)
+    assert store.cache.stats()["misses"] == 3
+    assert "https://example.com/twin.tif" in [url for url, _ in third[:2]]
+
+    # as do writes through another connection, as from another process - even ones that add no rows
+    other = SQLiteVecStore(f"{temp_dir}/tmp.db")
+    generation = store.generation()
+    other.upsert_many([urls[1]], embeddings[[0]], ["changed"])
+    assert store.generation() != generation
+    assert urls[1] in [url for url, _ in store.closest(urls[0], n_results=3)]
+    generation = store.generation()
+    other.build_knn(depth=5)
+    assert store.generation() != generation
+
+
+def test_lazy_imports():
+    """Importing the vector stores doesn't load the optional backends' dependencies"""
+    code = "import sys, cyto_ml.data.vectorstore; print(sorted({'chromadb', 'sklearn', 'torch'} & set(sys.modules)))"
+    assert subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True).stdout.strip() == "[]"
+
+
+def test_register_backend(temp_dir, monkeypatch):
+    # Registered for this test only
+    monkeypatch.setitem(vectorstore.BACKENDS, "custom", None)
+    register_backend("custom", InMemoryStore)
+    store = vector_store("custom", embedding_len=8)
+    assert isinstance(store, InMemoryStore)
+    with pytest.raises(ValueError):
+        vector_store("unknown")
+
+
+def test_register_backend_lazy(temp_dir, monkeypatch):
+    monkeypatch.setitem(vectorstore.BACKENDS, "lazy", None)
+    register_backend("lazy", "cyto_ml.data.vectorstore:InMemoryStore")
+    assert vectorstore.BACKENDS["lazy"] == "cyto_ml.data.vectorstore:InMemoryStore"
+    assert isinstance(vector_store("lazy", embedding_len=8), InMemoryStore)
+    # resolved on first use, and kept
+    assert vectorstore.BACKENDS["lazy"] is InMemoryStore
+
+    monkeypatch.setitem(vectorstore.BACKENDS, "missing", "cyto_ml.data.no_such_module:Store")
+    with pytest.raises(ImportError):
+        vector_store("missing")
+
+
 def test_serialize_deserialize():
     """Round trip into compact format for sqlite-vec, back for working with floats"""
 